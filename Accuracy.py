@@ -0,0 +1,123 @@
+import logging
+import threading
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+RECORD_COLUMNS = ['user_id', 'model_version',
+                  'date', 'horizon', 'real_b', 'predicted_b']
+
+
+class AccuracyLog:
+    '''Буфер записей точности прогноза. Записи копятся в памяти и сохраняются в базу пачками.
+
+    Attributes:
+        batch_size: количество записей, при котором буфер сохраняется автоматически.
+        written: сколько записей сохранено в базу.
+    '''
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self.written = 0
+        self.__buffer = []
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+    def add(self, db_engine, records):
+        '''Добавляет записи в буфер. Если в буфере набралось batch_size записей, сохраняет их.
+        Вызывается при обработке сообщения пользователя, поэтому ошибка сохранения только логируется:
+        записи остаются в буфере до следующего flush.
+
+        Args:
+            db_engine: объект для работы с базой данных.
+            records: датафрейм записей, см. User.get_accuracy_records.
+        '''
+        if len(records) == 0:
+            return
+
+        with self.__lock:
+            self.__buffer.append(records[RECORD_COLUMNS])
+            self.__size += len(records)
+            full = self.__size >= self.batch_size
+
+        if full:
+            try:
+                self.flush(db_engine)
+            except Exception:
+                logger.exception('forecast accuracy flush failed')
+
+    def flush(self, db_engine):
+        '''Сохраняет все записи из буфера одним запросом.
+
+        Returns:
+            Количество сохраненных записей.
+        '''
+        with self.__lock:
+            buffer, self.__buffer, self.__size = self.__buffer, [], 0
+
+        if len(buffer) == 0:
+            return 0
+
+        records = pd.concat(buffer, ignore_index=True)
+        try:
+            db_engine.upload_forecast_accuracy(records)
+        except Exception:
+            # Записи возвращаются в буфер, чтобы сохранить их при следующей попытке
+            with self.__lock:
+                self.__buffer.insert(0, records)
+                self.__size += len(records)
+            raise
+
+        self.written += len(records)
+        return len(records)
+
+
+LOG = AccuracyLog()
+
+
+def detect_drift(summary, ratio=1.5, relative_error=.2, min_count=5):
+    '''Отмечает пользователей, чьи модели стали прогнозировать хуже и нуждаются в переобучении.
+
+    Модель считается деградировавшей, если за последний период набралось не меньше min_count записей и
+    средняя ошибка выросла больше чем в ratio раз относительно предыдущего периода,
+    или, если записей за предыдущий период нет, превышает relative_error от среднего баланса.
+
+    Args:
+        summary: датафрейм ошибок по пользователям, см. DB_Engine.download_accuracy_drift.
+        ratio: допустимый рост ошибки относительно предыдущего периода.
+        relative_error: допустимая ошибка относительно среднего баланса.
+        min_count: минимальное количество записей за последний период.
+
+    Returns:
+        Копия summary с колонками 'drift' (bool) и 'reason'.
+    '''
+    summary = summary.copy()
+    recent_mae = summary['recent_mae'].astype(float)
+    baseline_mae = summary['baseline_mae'].astype(float)
+    enough = summary['recent_count'] >= min_count
+    has_baseline = summary['baseline_count'] >= min_count
+
+    grown = enough & has_baseline & (recent_mae > ratio * baseline_mae)
+    large = enough & ~has_baseline & (
+        recent_mae > relative_error * summary['mean_balance'].astype(float))
+
+    summary['drift'] = grown | large
+    summary['reason'] = None
+    summary.loc[grown, 'reason'] = 'error growth'
+    summary.loc[large, 'reason'] = 'large error'
+    return summary
+
+
+def drift_report(db_engine, recent_days=14, baseline_days=90, max_horizon=7, **kwargs):
+    '''Загружает ошибки прогноза всех пользователей из базы и отмечает деградировавшие модели.
+
+    Args:
+        db_engine: объект для работы с базой данных.
+        recent_days, baseline_days, max_horizon: см. DB_Engine.download_accuracy_drift.
+        kwargs: параметры detect_drift.
+
+    Returns:
+        Датафрейм, см. detect_drift.
+    '''
+    return detect_drift(db_engine.download_accuracy_drift(recent_days, baseline_days, max_horizon), **kwargs)
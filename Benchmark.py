@@ -0,0 +1,235 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+import DataLoader as dl
+import ML as ml
+import Discovery
+
+
+def measure(func, *args, repeat=3):
+    '''Возвращает наименьшее время выполнения функции в секундах из нескольких запусков.'''
+    result = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func(*args)
+        result.append(time.perf_counter() - start_time)
+    return min(result)
+
+
+def generate_parser_inputs(size, random_state=0):
+    '''Генерирует строки сумм и дат в форматах, которые вводят пользователи.
+
+    Args:
+        size: количество строк.
+        random_state: seed генератора случайных чисел.
+
+    Returns:
+        Кортеж серий (amounts, dates).
+    '''
+    rng = np.random.default_rng(random_state)
+    values = rng.integers(-10 ** 6, 10 ** 6, size) / 100
+    amount_formats = np.array(['{:.2f}', '{:,.2f}', '{:.0f}'])[
+        rng.integers(0, 3, size)]
+    amounts = pd.Series([f.format(v).replace(',', ' ') for f, v in zip(amount_formats, values)])
+
+    dates = pd.Timestamp('2020-01-01') + pd.to_timedelta(
+        rng.integers(0, 3 * 365 * 24 * 60, size), unit='m')
+    date_formats = np.array(['%d.%m', '%d.%m.%y', '%d.%m.%Y', '%d.%m.%Y %H:%M'])[
+        rng.integers(0, 4, size)]
+    dates = pd.Series([d.strftime(f) for f, d in zip(date_formats, dates)])
+
+    return amounts, dates
+
+
+def parsers_benchmark(size=1000000, calls=10000):
+    '''Замеряет парсеры сумм и дат: задержку одного вызова, как при разборе команды пользователя,
+    и разбор size строк по одной и векторизованной версией. Векторизованная версия есть только у ru_datetime_parser,
+    для сумм разбор серией оказался медленнее разбора по одной.
+
+    Args:
+        size: количество строк.
+        calls: количество одиночных вызовов для замера задержки.
+
+    Returns:
+        Датафрейм с колонками ['single_call_us', 'single_s', 'vectorized_s', 'speedup'], индекс - парсеры.
+    '''
+    amounts, dates = generate_parser_inputs(size)
+    amount_calls, date_calls = amounts[:calls].tolist(), dates[:calls].tolist()
+
+    result = pd.DataFrame({
+        'single_call_us': [
+            1e6 * measure(lambda: [dl.amount_parser(a) for a in amount_calls]) / len(amount_calls),
+            1e6 * measure(lambda: [dl.ru_datetime_parser(d) for d in date_calls]) / len(date_calls),
+        ],
+        'single_s': [
+            measure(lambda: amounts.map(dl.amount_parser), repeat=1),
+            measure(lambda: dates.map(dl.ru_datetime_parser), repeat=1),
+        ],
+        'vectorized_s': [
+            np.nan,
+            measure(dl.ru_datetime_parser_series, dates),
+        ],
+    }, index=['amount_parser', 'ru_datetime_parser'])
+    result['speedup'] = result['single_s'] / result['vectorized_s']
+
+    return result
+
+
+def generate_daily_series(users_count, days=730, random_state=0):
+    '''Генерирует ежедневные ряды расходов пользователей с недельной и месячной сезонностью,
+    в том же виде, что возвращает ML.preprocessing_for_ml.
+
+    Args:
+        users_count: количество пользователей.
+        days: длина ряда в днях.
+        random_state: seed генератора случайных чисел.
+
+    Returns:
+        Словарь {номер пользователя: датафрейм с колонкой 'amount'}.
+    '''
+    rng = np.random.default_rng(random_state)
+    index = pd.date_range('2020-01-01', periods=days, freq='D', name='date')
+    result = {}
+    for user_id in range(users_count):
+        level = rng.uniform(500, 5000)
+        weekly = 1 + rng.uniform(0, .5) * (index.dayofweek >= 5)
+        monthly = 1 + rng.uniform(0, .3) * (index.day <= 5)
+        noise = rng.gamma(2., .5, days)
+        result[user_id] = pd.DataFrame(
+            {'amount': -level * weekly * monthly * noise}, index=index)
+    return result
+
+
+def users_series(db_engine, users_id):
+    '''Загружает из базы ежедневные ряды расходов пользователей для сравнения бэкендов на реальных данных.
+
+    Args:
+        db_engine: объект для работы с базой данных.
+        users_id: список id пользователей.
+
+    Returns:
+        Словарь {id пользователя: датафрейм временного ряда}.
+    '''
+    return {user_id: ml.preprocessing_for_ml(db_engine.download_transactions(user_id), db_engine.download_regular(user_id))
+            for user_id in users_id}
+
+
+def backends_benchmark(series, backends=('numpy', 'ridge', 'sklearn', 'gbm'), test_days=30, list_mf_rules=None):
+    '''Сравнивает бэкенды SbsModel на одних и тех же пользователях:
+    время обучения, время рекурсивного прогноза на test_days дней и точность этого прогноза.
+
+    Args:
+        series: словарь {пользователь: датафрейм временного ряда}, см. generate_daily_series и users_series.
+        backends: названия бэкендов из ML.BACKENDS.
+        test_days: сколько последних дней ряда откладывается для проверки прогноза.
+        list_mf_rules: правила генерации фичей. Если None, используются правила по умолчанию из Users.
+
+    Returns:
+        Датафрейм с колонками ['fit_ms', 'predict_ms', 'mae', 'sum_error'], индекс - бэкенды.
+        Время - медиана по пользователям, ошибки - средние. sum_error - модуль ошибки суммы расходов за test_days.
+    '''
+    if list_mf_rules is None:
+        list_mf_rules = {'amount': [
+            {'column': 'amount', 'lag': [2, 4], 'rm': [2, 1, 4, 3]}]}
+
+    result = {}
+    for backend in backends:
+        fit_ms, predict_ms, mae, sum_error = [], [], [], []
+        for data in series.values():
+            train, test = data[:-test_days], data[-test_days:]
+            model = ml.SbsModel('amount', False, list_mf_rules, backend)
+
+            fit_ms.append(1000 * measure(model.fit, train, repeat=1))
+            start_time = time.perf_counter()
+            predicted = model.predict(train, test.index[-1], only_negative=False)
+            predict_ms.append(1000 * (time.perf_counter() - start_time))
+
+            mae.append(np.abs(predicted.values - test['amount'].values).mean())
+            sum_error.append(abs(predicted.sum() - test['amount'].sum()))
+
+        result[backend] = {
+            'fit_ms': np.median(fit_ms),
+            'predict_ms': np.median(predict_ms),
+            'mae': np.mean(mae),
+            'sum_error': np.mean(sum_error),
+        }
+
+    return pd.DataFrame.from_dict(result, orient='index')
+
+
+def generate_histories(users_count, days=3 * 365, random_state=0):
+    '''Генерирует истории транзакций пользователей со случайными покупками и известными регулярными платежами:
+    зарплатой 5 и 20 числа, ежемесячной подпиской и ежегодной страховкой.
+
+    Args:
+        users_count: количество пользователей.
+        days: длина истории в днях.
+        random_state: seed генератора случайных чисел.
+
+    Returns:
+        Датафрейм с колонками ['user_id', 'date', 'amount', 'description'].
+    '''
+    rng = np.random.default_rng(random_state)
+    index = pd.date_range('2020-01-01', periods=days, freq='D')
+    shops = np.array(['Пятерочка', 'Перекресток', 'Яндекс.Такси', 'Кофейня', 'Аптека', 'Ozon', 'Перевод'])
+    result = []
+    for user_id in range(users_count):
+        counts = rng.poisson(3, days)
+        result.append(pd.DataFrame({
+            'user_id': user_id,
+            'date': np.repeat(index, counts),
+            'amount': -np.round(rng.lognormal(6, 1, counts.sum()), 2),
+            'description': rng.choice(shops, counts.sum()),
+        }))
+
+        subscription_day = rng.integers(1, 29)
+        regular = [
+            (index[index.day.isin([5, 20])], 50000., 'Зарплата'),
+            (index[index.day == subscription_day], -299., f'Подписка {user_id}'),
+            (index[(index.month == 3) & (index.day == 15)], -8000., 'Страховка ОСАГО'),
+        ]
+        result += [pd.DataFrame({'user_id': user_id, 'date': dates, 'amount': amount, 'description': description})
+                   for dates, amount, description in regular]
+
+    return pd.concat(result, ignore_index=True)
+
+
+def discovery_benchmark(history):
+    '''Измеряет время поиска регулярных платежей по одному пользователю и по всем пользователям одним проходом,
+    долю найденных заложенных в generate_histories платежей и долю заложенных платежей среди предложений.
+
+    Returns:
+        Датафрейм с колонками ['time_ms', 'users', 'transactions', 'proposals', 'recall', 'precision'].
+    '''
+    one_user = history[history['user_id'] == history['user_id'].iloc[0]].drop('user_id', axis=1)
+    proposals = Discovery.discover_regular(history)
+    expected = history[history['description'].str.startswith(
+        ('Зарплата', 'Подписка', 'Страховка'))].groupby(['user_id', 'description']).size()
+    proposed = pd.MultiIndex.from_frame(proposals[['user_id', 'description']])
+    found = proposed.unique()
+
+    return pd.DataFrame({
+        'time_ms': [1000 * measure(Discovery.discover_regular, one_user),
+                    1000 * measure(Discovery.discover_regular, history)],
+        'users': [1, history['user_id'].nunique()],
+        'transactions': [len(one_user), len(history)],
+        'proposals': [len(Discovery.discover_regular(one_user)), len(proposals)],
+        'recall': [np.nan, expected.index.isin(found).mean()],
+        'precision': [np.nan, proposed.isin(expected.index).mean()],
+    }, index=['one_user', 'all_users'])
+
+
+if __name__ == '__main__':
+    # python Benchmark.py [parsers] [size], python Benchmark.py backends [users_count]
+    # или python Benchmark.py discovery [users_count]
+    if len(sys.argv) > 1 and sys.argv[1] == 'discovery':
+        users_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+        print(discovery_benchmark(generate_histories(users_count)).to_string())
+    elif len(sys.argv) > 1 and sys.argv[1] == 'backends':
+        users_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+        print(backends_benchmark(generate_daily_series(users_count)).to_string())
+    else:
+        args = [a for a in sys.argv[1:] if a != 'parsers']
+        size = int(args[0]) if len(args) > 0 else 1000000
+        print(parsers_benchmark(size).to_string())
@@ -0,0 +1,131 @@
+import logging
+import re
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+MATCH_EXACT = 'exact'
+MATCH_PREFIX = 'prefix'
+MATCH_REGEX = 'regex'
+
+
+class CategoryRules:
+    '''Скомпилированные правила замены категорий по описанию транзакции.
+
+    Правила проверяются в порядке: точное совпадение, самый длинный префикс, первое подходящее регулярное выражение.
+    Префиксы и регулярные выражения без групп объединены в одно регулярное выражение с альтернативами,
+    поэтому каждое уникальное описание обычно проверяется одним вызовом. Регулярные выражения с группами
+    проверяются отдельно: в объединенном выражении номера групп сдвигаются, а имена могут повторяться.
+
+    Attributes:
+        rule_count: количество правил.
+    '''
+
+    def __init__(self, rules):
+        '''
+        Args:
+            rules: список правил (key, value, match_type), где match_type - одно из
+                [MATCH_EXACT, MATCH_PREFIX, MATCH_REGEX]. Для совпадающих ключей действует последнее правило.
+        '''
+        self.rule_count = len(rules)
+        self.__exact = {}
+        prefixes = {}
+        regexes = []
+
+        for key, value, match_type in rules:
+            if match_type == MATCH_PREFIX:
+                prefixes[key] = value
+            elif match_type == MATCH_REGEX:
+                try:
+                    pattern = re.compile(key, re.DOTALL)
+                except re.error:
+                    logger.warning(f'Invalid category rule regex "{key}"')
+                    continue
+                regexes.append((pattern, value))
+            else:
+                self.__exact[key] = value
+
+        # Список (выражение, значения): значения - список для объединенного выражения,
+        # где номер альтернативы берется из имени группы, или одно значение для отдельного выражения, которое ищется через search.
+        # Альтернативы (текст, отдельное выражение, значение) проверяются слева направо, поэтому длинные префиксы идут первыми
+        self.__matchers = []
+        alternatives = [(re.escape(key), re.compile(r'\A' + re.escape(key)), prefixes[key])
+                        for key in sorted(prefixes, key=len, reverse=True)]
+        for pattern, value in regexes:
+            if pattern.groups == 0:
+                alternatives.append((f'.*?(?:{pattern.pattern})', pattern, value))
+                continue
+            self.__add_alternatives(alternatives)
+            alternatives = []
+            self.__matchers.append((pattern, value))
+        self.__add_alternatives(alternatives)
+
+    def __add_alternatives(self, alternatives):
+        '''Объединяет альтернативы в одно выражение. Если выражение не компилируется, например из-за флагов
+        вида (?i), допустимых только в начале выражения, альтернативы проверяются по отдельности.'''
+        if not alternatives:
+            return
+        try:
+            self.__matchers.append((re.compile('|'.join(f'(?P<r{i}>{a})' for i, (a, _, _) in enumerate(alternatives)),
+                                               re.DOTALL), [value for _, _, value in alternatives]))
+        except re.error:
+            self.__matchers.extend((pattern, value) for _, pattern, value in alternatives)
+
+    def match(self, description):
+        '''Находит категорию для одного описания.
+
+        Args:
+            description: описание транзакции.
+
+        Returns:
+            Категория или None, если ни одно правило не подошло.
+        '''
+        if description in self.__exact:
+            return self.__exact[description]
+        if not isinstance(description, str):
+            return None
+
+        for pattern, values in self.__matchers:
+            if isinstance(values, list):
+                result = pattern.match(description)
+                if result is not None:
+                    return values[int(result.lastgroup[1:])]
+            elif pattern.search(description) is not None:
+                return values
+        return None
+
+    def classify(self, descriptions):
+        '''Находит категории для всей колонки описаний. Каждое уникальное описание проверяется один раз.
+
+        Args:
+            descriptions: серия описаний.
+
+        Returns:
+            Серия категорий с тем же индексом, None там, где ни одно правило не подошло.
+        '''
+        codes, uniques = pd.factorize(descriptions)
+        categories = np.array([self.match(d) for d in uniques] + [None], dtype=object)
+        # Код -1 (пропущенное описание) указывает на последний элемент - None
+        return pd.Series(categories[codes], index=descriptions.index)
+
+    def apply(self, data, column='description', target='category'):
+        '''Заменяет категории транзакций, для которых подошло правило.
+
+        Args:
+            data: датафрейм транзакций.
+            column: колонка описаний.
+            target: колонка категорий.
+
+        Returns:
+            Копия датафрейма с замененными категориями.
+        '''
+        data = data.copy()
+        if self.rule_count == 0 or len(data) == 0:
+            return data
+
+        categories = self.classify(data[column])
+        matched = categories.notna()
+        data.loc[matched, target] = categories[matched]
+        return data
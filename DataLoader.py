@@ -1,8 +1,15 @@
 import pandas as pd
+import numpy as np
 import sqlalchemy as sqla
 import pickle
 import re
-from datetime import date, datetime
+import threading
+from datetime import date, datetime, timedelta
+import Categories
+
+# updated_at заполняется временем начала транзакции базы, поэтому строка может стать видна позже строк
+# с большим updated_at. Изменения загружаются с таким запасом до последнего загруженного updated_at
+CHANGES_LAG = timedelta(minutes=5)
 
 
 def tinkoff_file_parse(path, db_engine, user_id, account_id=-1):
@@ -29,47 +36,107 @@ def tinkoff_file_parse(path, db_engine, user_id, account_id=-1):
     df_for_sql = df.reindex(index=df.index[::-1]).reset_index(drop=True)
     df_for_sql.columns = ['date', 'amount', 'category', 'description']
 
-    for k, v in db_engine.download_c_rules(user_id=user_id):
-        df_for_sql.loc[df_for_sql['description'] == k, 'category'] = v
+    df_for_sql = db_engine.get_category_rules(user_id).apply(df_for_sql)
     df_for_sql['account_id'] = account_id
 
     return df_for_sql[['date', 'account_id', 'amount', 'category', 'description']]
 
 
+AMOUNT_PATTERN = re.compile(r"-?(?:\d{1,3}[ `'])*\d+(?:[\.\,]\d+)?")
+AMOUNT_SEPARATORS = str.maketrans({' ': None, '`': None, "'": None, ',': '.'})
+# День и месяц в начале строки без года, год добавляется перед разбором, чтобы 29.02 разбиралось в високосный год
+YEARLESS_PATTERN = re.compile(r'^(\d+\.\d+)')
+
+# Форматы дат: (минимальная длина, максимальная длина, количество точек, количество двоеточий или None, формат, без года).
+# Проверяются по порядку, выбирается первый подходящий.
+RU_DATETIME_FORMATS = [
+    (4, 5, 1, None, '%d.%m', True),
+    (6, 8, 2, None, '%d.%m.%y', False),
+    (8, 10, 2, None, '%d.%m.%Y', False),
+    (7, 11, 1, 1, '%d.%m %H:%M', True),
+    (10, 14, 2, 1, '%d.%m.%y %H:%M', False),
+    (16, 16, 2, 1, '%d.%m.%Y %H:%M', False),
+]
+
+
 def amount_parser(string):
-    sep = (" ", "`", "'")
-    result = re.search("-?(\d{1,3}[ `'])*\d+([\.\,]\d+)?", string).group(0)
-    result = result.replace(',', '.')
-    for s in sep:
-        result = result.replace(s, '')
+    '''Находит сумму в строке. Разделители разрядов - пробел, ` и ', дробной части - точка или запятая.
 
-    return float(result)
+    Args:
+        string: строка.
+
+    Returns:
+        Сумма или NaN, если сумма не найдена.
+    '''
+    result = AMOUNT_PATTERN.search(string)
+    if result is None:
+        return float('nan')
+
+    return float(result.group(0).translate(AMOUNT_SEPARATORS))
 
 
 def ru_datetime_parser(string):
+    '''Разбирает дату в одном из форматов RU_DATETIME_FORMATS. Вместо точки можно использовать запятую.
+    Если год не указан, используется текущий.
+
+    Args:
+        string: строка.
+
+    Returns:
+        datetime или NaT, если строка не подходит ни под один формат.
+    '''
     l = len(string)
     string = string.replace(',', '.')
     dotC = string.count('.')
     сolonC = string.count(':')
 
-    if 4 <= l <= 5 and dotC == 1:
-        result = datetime.strptime(string, '%d.%m').replace(
-            year=datetime.today().year)
-    elif 6 <= l <= 8 and dotC == 2:
-        result = datetime.strptime(string, '%d.%m.%y')
-    elif 8 <= l <= 10 and dotC == 2:
-        result = datetime.strptime(string, '%d.%m.%Y')
-
-    elif 7 <= l <= 11 and dotC == 1 and сolonC == 1:
-        result = datetime.strptime(string, '%d.%m %H:%M').replace(
-            year=datetime.today().year)
-    elif 10 <= l <= 14 and dotC == 2 and сolonC == 1:
-        result = datetime.strptime(string, '%d.%m.%y %H:%M')
-    elif l == 16 and dotC == 2 and сolonC == 1:
-        result = datetime.strptime(string, '%d.%m.%Y %H:%M')
-
-    else:
-        result = 'NaT'
+    for min_l, max_l, dots, colons, date_format, without_year in RU_DATETIME_FORMATS:
+        if min_l <= l <= max_l and dotC == dots and (colons is None or сolonC == colons):
+            if without_year:
+                string = YEARLESS_PATTERN.sub(
+                    r'\1.' + str(datetime.today().year), string, count=1)
+                date_format = date_format.replace('%d.%m', '%d.%m.%Y', 1)
+            try:
+                return datetime.strptime(string, date_format)
+            except ValueError:
+                return pd.NaT
+
+    return pd.NaT
+
+
+def ru_datetime_parser_series(values):
+    '''Векторизованная версия ru_datetime_parser. Формат определяется для всех строк сразу,
+    затем строки каждого формата разбираются одним вызовом pd.to_datetime.
+
+    Args:
+        values: серия или массив строк.
+
+    Returns:
+        Серия datetime64, NaT для строк, не подходящих ни под один формат.
+    '''
+    values = pd.Series(values, dtype=object)
+    values = values.where(values.notna(), '').astype(str)
+    l = values.str.len()
+    values = values.str.replace(',', '.', regex=False)
+    dotC = values.str.count(r'\.')
+    сolonC = values.str.count(':')
+
+    conditions = [(l >= min_l) & (l <= max_l) & (dotC == dots) & ((сolonC == colons) if colons is not None else True)
+                  for min_l, max_l, dots, colons, _, _ in RU_DATETIME_FORMATS]
+    format_id = np.select(conditions, list(range(len(RU_DATETIME_FORMATS))), -1)
+
+    result = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    year = str(datetime.today().year)
+    for i in np.unique(format_id[format_id >= 0]):
+        _, _, _, _, date_format, without_year = RU_DATETIME_FORMATS[i]
+        mask = format_id == i
+        subset = values[mask]
+        if without_year:
+            subset = subset.str.replace(
+                YEARLESS_PATTERN, r'\1.' + year, n=1, regex=True)
+            date_format = date_format.replace('%d.%m', '%d.%m.%Y', 1)
+        result[mask] = pd.to_datetime(
+            subset, format=date_format, errors='coerce')
 
     return result
 
@@ -79,6 +146,8 @@ class DB_Engine:
         self.connector = sqla.create_engine(
             f"postgresql://{user}:{password}@{host}:{port}/{db_name}")
         self.schema = schema
+        self.__category_rules = {}
+        self.__category_rules_lock = threading.Lock()
         metadata_obj = sqla.MetaData()
 
         self.tables = {
@@ -93,6 +162,8 @@ class DB_Engine:
                                        sqla.Column('description', sqla.String),
                                        sqla.Column('balance', sqla.Integer),
                                        sqla.Column('is_del', sqla.Boolean),
+                                       sqla.Column(
+                                           'updated_at', sqla.DateTime),
                                        schema=self.schema
                                        ),
             'regular': sqla.Table('regular', metadata_obj,
@@ -112,6 +183,7 @@ class DB_Engine:
                                   sqla.Column('adjust_date', sqla.Boolean),
                                   sqla.Column('follow_overdue', sqla.Boolean),
                                   sqla.Column('is_del', sqla.Boolean),
+                                  sqla.Column('updated_at', sqla.DateTime),
                                   schema=self.schema
                                   ),
             'onetime': sqla.Table('onetime', metadata_obj,
@@ -122,6 +194,7 @@ class DB_Engine:
                                   sqla.Column('amount', sqla.Numeric),
                                   sqla.Column('date', sqla.Date),
                                   sqla.Column('is_del', sqla.Boolean),
+                                  sqla.Column('updated_at', sqla.DateTime),
                                   schema=self.schema
                                   ),
             'accounts': sqla.Table('accounts', metadata_obj,
@@ -133,13 +206,141 @@ class DB_Engine:
                                    sqla.Column('credit_limit', sqla.Numeric),
                                    sqla.Column('discharge_day',
                                                sqla.SmallInteger),
+                                   sqla.Column('updated_at', sqla.DateTime),
                                    schema=self.schema),
+            'daily_aggregates': sqla.Table('daily_aggregates', metadata_obj,
+                                           sqla.Column('user_id', sqla.Integer,
+                                                       primary_key=True),
+                                           sqla.Column('account_id', sqla.Integer,
+                                                       primary_key=True),
+                                           sqla.Column('date', sqla.Date,
+                                                       primary_key=True),
+                                           sqla.Column('spend', sqla.Numeric),
+                                           sqla.Column('income', sqla.Numeric),
+                                           sqla.Column('balance', sqla.Numeric),
+                                           schema=self.schema),
+            'sbs_models': sqla.Table('sbs_models', metadata_obj,
+                                     sqla.Column('id', sqla.Integer,
+                                                 primary_key=True),
+                                     sqla.Column('user_id', sqla.Integer),
+                                     sqla.Column('dump', sqla.LargeBinary),
+                                     sqla.Column('created_at', sqla.DateTime),
+                                     sqla.Column('event_count', sqla.Integer),
+                                     sqla.Column(
+                                         'ml_event_count', sqla.Integer),
+                                     sqla.Column('partial', sqla.Boolean),
+                                     schema=self.schema),
 
         }
 
         self.sql_queries = {
-            'get_c_rules': sqla.sql.text(f"SELECT key, value FROM {self.schema}.dictionary_categories WHERE user_id = :user_id"),
-            'get_last_model': sqla.sql.text(f"SELECT dump FROM {self.schema}.sbs_models WHERE user_id = :user_id ORDER BY id DESC LIMIT 1"),
+            'get_c_rules': sqla.sql.text(f"SELECT key, value, match_type FROM {self.schema}.dictionary_categories WHERE user_id = :user_id ORDER BY id"),
+            # У dictionary_categories нет updated_at, добавление и удаление правил меняют количество строк или max(id)
+            'get_c_rules_watermark': sqla.sql.text(f"SELECT count(*), max(id) FROM {self.schema}.dictionary_categories WHERE user_id = :user_id"),
+            'add_c_rule': sqla.sql.text(f"INSERT INTO {self.schema}.dictionary_categories (user_id, key, value, match_type) VALUES (:user_id, :key, :value, :match_type)"),
+            'get_last_model': sqla.sql.text(f"SELECT id, dump FROM {self.schema}.sbs_models WHERE user_id = :user_id ORDER BY id DESC LIMIT 1"),
+            'get_last_model_version': sqla.sql.text(f"SELECT max(id) FROM {self.schema}.sbs_models WHERE user_id = :user_id"),
+            # Для каждого пользователя с транзакциями: текущее количество транзакций и параметры последней модели
+            'get_retrain_candidates': sqla.sql.text(f"""
+                WITH last_models AS (
+                    SELECT DISTINCT ON (user_id) user_id, created_at, event_count
+                    FROM {self.schema}.sbs_models
+                    ORDER BY user_id, id DESC
+                ), counts AS (
+                    SELECT user_id, count(*) AS event_count
+                    FROM {self.schema}.transactions
+                    WHERE NOT is_del
+                    GROUP BY user_id
+                )
+                SELECT c.user_id, c.event_count, m.event_count AS model_event_count, m.created_at AS model_created_at
+                FROM counts AS c
+                LEFT JOIN last_models AS m USING (user_id)
+                ORDER BY c.user_id"""),
+            'add_forecast_accuracy': sqla.sql.text(f"INSERT INTO {self.schema}.forecast_accuracy (user_id, model_version, date, horizon, real_b, predicted_b) VALUES (:user_id, :model_version, :date, :horizon, :real_b, :predicted_b)"),
+            # Ошибки прогноза за последние recent_days дней сравниваются с ошибками за предыдущий период до baseline_days дней.
+            # Последний период учитывает только прогнозы моделей начиная с последнего полного обучения,
+            # иначе переобученная модель отвечала бы за ошибки старой и переобучалась бы снова каждую ночь
+            'get_accuracy_drift': sqla.sql.text(f"""
+                WITH last_full AS (
+                    SELECT user_id, max(id) AS version
+                    FROM {self.schema}.sbs_models
+                    WHERE NOT coalesce(partial, false)
+                    GROUP BY user_id
+                ), errors AS (
+                    SELECT a.user_id, a.model_version, a.created_at, a.real_b, a.predicted_b,
+                        a.created_at >= now() - make_interval(days => :recent_days) AS recent,
+                        a.model_version >= coalesce(m.version, 0) AS current_model
+                    FROM {self.schema}.forecast_accuracy AS a
+                    LEFT JOIN last_full AS m USING (user_id)
+                    WHERE a.created_at >= now() - make_interval(days => :baseline_days) AND a.horizon <= :max_horizon
+                )
+                SELECT user_id,
+                    (array_agg(model_version ORDER BY created_at DESC))[1] AS model_version,
+                    count(*) FILTER (WHERE recent AND current_model) AS recent_count,
+                    avg(abs(predicted_b - real_b)) FILTER (WHERE recent AND current_model) AS recent_mae,
+                    avg(predicted_b - real_b) FILTER (WHERE recent AND current_model) AS recent_bias,
+                    count(*) FILTER (WHERE NOT recent) AS baseline_count,
+                    avg(abs(predicted_b - real_b)) FILTER (WHERE NOT recent) AS baseline_mae,
+                    avg(abs(real_b)) AS mean_balance
+                FROM errors
+                GROUP BY user_id
+                ORDER BY user_id"""),
+            'get_accuracy_rolling': sqla.sql.text(f"""
+                SELECT day, horizon, mae, bias,
+                    avg(mae) OVER (PARTITION BY horizon ORDER BY day ROWS BETWEEN :window PRECEDING AND CURRENT ROW) AS rolling_mae
+                FROM (
+                    SELECT CAST(created_at AS date) AS day, horizon,
+                        avg(abs(predicted_b - real_b)) AS mae, avg(predicted_b - real_b) AS bias
+                    FROM {self.schema}.forecast_accuracy
+                    WHERE user_id = :user_id
+                    GROUP BY 1, 2
+                ) AS d
+                ORDER BY horizon, day"""),
+            # Даты регулярных событий считаются как start_date + j * интервал, так же как в User.predict_events
+            'get_notification_events': sqla.sql.text(f"""
+                SELECT r.user_id, o.date, r.amount, r.description
+                FROM {self.schema}.regular AS r
+                CROSS JOIN LATERAL generate_series(
+                    0,
+                    (CAST(:end_date AS date) - r.start_date) / NULLIF(r.d_years * 365 + r.d_months * 28 + r.d_days, 0) + 1
+                ) AS s(j)
+                CROSS JOIN LATERAL (SELECT CAST(r.start_date + make_interval(
+                    years => r.d_years * s.j, months => r.d_months * s.j, days => r.d_days * s.j) AS date) AS date) AS o
+                WHERE NOT r.is_del
+                    AND NOT (r.adjust_price OR r.adjust_date OR r.follow_overdue)
+                    AND r.start_date <= :end_date
+                    AND o.date BETWEEN :start_date AND :end_date
+                    AND (r.end_date IS NULL OR o.date < r.end_date)
+                UNION ALL
+                SELECT user_id, date, amount, description
+                FROM {self.schema}.onetime
+                WHERE NOT is_del AND date BETWEEN :start_date AND :end_date
+                ORDER BY user_id, date"""),
+            'get_users_with_adjusted_events': sqla.sql.text(f"""
+                SELECT DISTINCT user_id
+                FROM {self.schema}.regular
+                WHERE NOT is_del
+                    AND (adjust_price OR adjust_date OR follow_overdue)
+                    AND start_date <= :end_date
+                    AND (end_date IS NULL OR end_date > :start_date)"""),
+            # История транзакций всех пользователей для поиска регулярных событий
+            # Фильтр по шарду совпадает с Sharding.shard_of
+            'get_history': sqla.sql.text(f"""
+                SELECT user_id, date, amount, description
+                FROM {self.schema}.transactions
+                WHERE NOT is_del AND date >= :start_date AND user_id % :shards = :shard
+                ORDER BY user_id, date"""),
+            'get_discovery_notices': sqla.sql.text(f"""
+                SELECT user_id, description, period
+                FROM {self.schema}.discovery_notices
+                WHERE user_id % :shards = :shard"""),
+            'add_discovery_notices': sqla.sql.text(f"""
+                INSERT INTO {self.schema}.discovery_notices (user_id, description, period)
+                VALUES (:user_id, :description, :period)
+                ON CONFLICT DO NOTHING"""),
+            'get_all_regular': self.tables['regular'].select().where(
+                self.tables['regular'].c.is_del == False
+            ).order_by(self.tables['regular'].c.user_id, self.tables['regular'].c.start_date),
             'get_regular': self.tables['regular'].select().where(sqla.and_(
                 self.tables['regular'].c.user_id == sqla.bindparam('user_id'),
                 self.tables['regular'].c.is_del == False
@@ -160,33 +361,174 @@ class DB_Engine:
                 self.tables['transactions'].c.is_del == False
             )).order_by(self.tables['transactions'].c.date),
 
-            'add_transactions': self.tables['transactions'].insert().returning(self.tables['transactions'].c.id),
-            'add_regular': self.tables['regular'].insert().returning(self.tables['regular'].c.id),
-            'add_onetime': self.tables['onetime'].insert().returning(self.tables['onetime'].c.id),
-            'add_accounts': self.tables['accounts'].insert().returning(self.tables['accounts'].c.id),
+            'get_transactions_range': self.tables['transactions'].select().where(sqla.and_(
+                self.tables['transactions'].c.user_id == sqla.bindparam(
+                    'user_id'),
+                self.tables['transactions'].c.is_del == False,
+                self.tables['transactions'].c.date >= sqla.bindparam(
+                    'start_date'),
+                self.tables['transactions'].c.date < sqla.bindparam(
+                    'end_date')
+            )).order_by(self.tables['transactions'].c.date),
+
+            'get_daily_aggregates': self.tables['daily_aggregates'].select().where(
+                self.tables['daily_aggregates'].c.user_id == sqla.bindparam(
+                    'user_id')
+            ).order_by(self.tables['daily_aggregates'].c.date),
+
+            **{'get_changes_' + table: self.tables[table].select().where(sqla.and_(
+                self.tables[table].c.user_id == sqla.bindparam('user_id'),
+                sqla.or_(
+                    self.tables[table].c.id > sqla.bindparam('last_id'),
+                    self.tables[table].c.updated_at > sqla.bindparam(
+                        'last_updated')
+                )
+            )) for table in ['transactions', 'regular', 'onetime', 'accounts']},
+
+            'add_transactions': self.tables['transactions'].insert().returning(self.tables['transactions'].c.id, self.tables['transactions'].c.updated_at),
+            'add_regular': self.tables['regular'].insert().returning(self.tables['regular'].c.id, self.tables['regular'].c.updated_at),
+            'add_onetime': self.tables['onetime'].insert().returning(self.tables['onetime'].c.id, self.tables['onetime'].c.updated_at),
+            'add_accounts': self.tables['accounts'].insert().returning(self.tables['accounts'].c.id, self.tables['accounts'].c.updated_at),
+            'add_daily_aggregates': self.tables['daily_aggregates'].insert(),
 
             # 'delete_transactions': self.tables['transactions'].update().where(self.tables['transactions'].c.user_id == sqla.bindparam('user_id')).values(is_del=True),
+            # Диапазон дат счета, по индексу (user_id, account_id, date) WHERE NOT is_del
             'delete_transactions': self.tables['transactions'].update().where(sqla.and_(
                 self.tables['transactions'].c.user_id ==
                 sqla.bindparam('b_user_id'),
                 self.tables['transactions'].c.account_id ==
-                sqla.bindparam('account_id')
+                sqla.bindparam('b_account_id'),
+                self.tables['transactions'].c.is_del == False,
+                self.tables['transactions'].c.date >=
+                sqla.bindparam('b_start_date'),
+                self.tables['transactions'].c.date <=
+                sqla.bindparam('b_end_date')
             )).values(is_del=True),
             'delete_regular': self.tables['regular'].update().where(self.tables['regular'].c.id.in_(sqla.bindparam('db_id', expanding=True))).values(is_del=True),
             'delete_onetime': self.tables['onetime'].update().where(self.tables['onetime'].c.id.in_(sqla.bindparam('db_id', expanding=True))).values(is_del=True),
+            'delete_daily_aggregates': self.tables['daily_aggregates'].delete().where(sqla.and_(
+                self.tables['daily_aggregates'].c.user_id ==
+                sqla.bindparam('b_user_id'),
+                self.tables['daily_aggregates'].c.account_id ==
+                sqla.bindparam('b_account_id'),
+                self.tables['daily_aggregates'].c.date >=
+                sqla.bindparam('b_start_date')
+            )),
 
             'update_regular': self.tables['regular'].update().where(self.tables['regular'].c.id == sqla.bindparam('db_id')),
             'update_onetime': self.tables['onetime'].update().where(self.tables['onetime'].c.id == sqla.bindparam('db_id')),
+            'update_transactions_category': self.tables['transactions'].update().where(
+                self.tables['transactions'].c.id == sqla.bindparam('b_id')).values(category=sqla.bindparam('b_category')),
 
         }
 
     def download_c_rules(self, user_id):
         return self.__read_sql('get_c_rules',
-                               {'user_id': user_id}, drop_uid=False)[['key', 'value']].values.tolist()
+                               {'user_id': user_id}, drop_uid=False)[['key', 'value', 'match_type']].values.tolist()
+
+    def get_category_rules(self, user_id):
+        '''Возвращает скомпилированные правила категорий пользователя. Правила загружаются из базы один раз и кэшируются
+        до изменения, см. refresh_category_rules.
+
+        Args:
+            user_id: id пользователя.
+
+        Returns:
+            Объект Categories.CategoryRules.
+        '''
+        with self.__category_rules_lock:
+            if user_id not in self.__category_rules:
+                watermark = self.__get_c_rules_watermark(user_id)
+                self.__category_rules[user_id] = (watermark, Categories.CategoryRules(
+                    self.download_c_rules(user_id)))
+            return self.__category_rules[user_id][1]
+
+    def refresh_category_rules(self, user_id):
+        '''Сбрасывает кэш правил категорий пользователя, если правила изменились в базе в обход add_category_rule.
+
+        Returns:
+            True, если кэш сброшен.
+        '''
+        with self.__category_rules_lock:
+            cached = self.__category_rules.get(user_id)
+            if cached is None or cached[0] == self.__get_c_rules_watermark(user_id):
+                return False
+            del self.__category_rules[user_id]
+            return True
+
+    def __get_c_rules_watermark(self, user_id):
+        return tuple(self.connector.execute(self.sql_queries['get_c_rules_watermark'], {'user_id': user_id}).one())
+
+    def add_category_rule(self, user_id, key, value, match_type=Categories.MATCH_EXACT):
+        '''Добавляет правило категории и сбрасывает кэш правил пользователя.
+
+        Args:
+            user_id: id пользователя.
+            key: описание, префикс описания или регулярное выражение.
+            value: категория.
+            match_type: одно из [Categories.MATCH_EXACT, Categories.MATCH_PREFIX, Categories.MATCH_REGEX].
+        '''
+        self.connector.execute(self.sql_queries['add_c_rule'], {
+            'user_id': user_id, 'key': key, 'value': value, 'match_type': match_type})
+        with self.__category_rules_lock:
+            self.__category_rules.pop(user_id, None)
+
+    def update_categories(self, categories):
+        '''Обновляет категории транзакций одним пакетным запросом.
+
+        Args:
+            categories: серия новых категорий, индекс - id транзакций в базе.
+        '''
+        if len(categories) == 0:
+            return
+        self.connector.execute(self.sql_queries['update_transactions_category'], [
+            {'b_id': int(db_id), 'b_category': category} for db_id, category in categories.items()])
 
     def download_regular(self, user_id):
         return self.__read_sql('get_regular', {'user_id': user_id})
 
+    def download_all_regular(self):
+        '''Загружает регулярные события всех пользователей, с колонкой 'user_id'.'''
+        return self.__read_sql('get_all_regular', {}, drop_uid=False)
+
+    def download_history(self, start_date, shard=None):
+        '''Загружает транзакции всех пользователей начиная с start_date одним запросом.
+
+        Args:
+            start_date: первая дата истории.
+            shard: кортеж (номер шарда, количество шардов), чтобы загрузить только пользователей шарда.
+                Если None, загружаются все пользователи.
+
+        Returns:
+            Датафрейм с колонками ['user_id', 'date', 'amount', 'description'].
+        '''
+        shard, shards = (0, 1) if shard is None else shard
+        return self.__read_sql('get_history', {
+            'start_date': start_date, 'shard': shard, 'shards': shards}, parse_dates=['date'], drop_uid=False)
+
+    def download_discovery_notices(self, shard=None):
+        '''Загружает найденные регулярные платежи, о которых пользователи уже получили уведомление.
+
+        Args:
+            shard: см. download_history.
+
+        Returns:
+            Датафрейм с колонками ['user_id', 'description', 'period'].
+        '''
+        shard, shards = (0, 1) if shard is None else shard
+        return self.__read_sql('get_discovery_notices', {'shard': shard, 'shards': shards}, drop_uid=False)
+
+    def add_discovery_notices(self, notices):
+        '''Запоминает уведомления о найденных регулярных платежах. Повторные записи пропускаются.
+
+        Args:
+            notices: датафрейм с колонками ['user_id', 'description', 'period'].
+        '''
+        if len(notices) == 0:
+            return
+        self.connector.execute(self.sql_queries['add_discovery_notices'], notices[
+            ['user_id', 'description', 'period']].astype(object).to_dict(orient='records'))
+
     def download_onetime(self, user_id):
         data = self.__read_sql(
             'get_onetime', {'user_id': user_id}, parse_dates=['date'])
@@ -196,8 +538,64 @@ class DB_Engine:
     def download_accounts(self, user_id):
         return self.__read_sql('get_accounts', {'user_id': user_id})
 
-    def download_transactions(self, user_id):
-        return self.__read_sql('get_transactions', {'user_id': user_id})
+    def download_transactions(self, user_id, start_date=None, end_date=None):
+        '''Загружает транзакции пользователя. Если задан диапазон дат, фильтрация выполняется в базе
+        по индексу (user_id, date) и загружаются только транзакции с датой из [start_date, end_date).
+
+        Args:
+            user_id: id пользователя.
+            start_date: первая дата диапазона. Если None, с начала истории.
+            end_date: дата после диапазона. Если None, до конца истории.
+        '''
+        if start_date is None and end_date is None:
+            return self.__read_sql('get_transactions', {'user_id': user_id})
+
+        return self.__read_sql('get_transactions_range', {
+            'user_id': user_id,
+            'start_date': date(1, 1, 1) if start_date is None else start_date,
+            'end_date': date(9999, 12, 31) if end_date is None else end_date,
+        })
+
+    def download_changes(self, table, user_id, last_id, last_updated):
+        '''Загружает строки таблицы, добавленные или измененные после последней загрузки, включая удаленные.
+
+        Args:
+            table: одна из таблиц ['transactions', 'regular', 'onetime', 'accounts'].
+            user_id: id пользователя.
+            last_id: наибольший id из уже загруженных строк.
+            last_updated: наибольшее время изменения из уже загруженных строк. Загружаются изменения
+                начиная с last_updated - CHANGES_LAG, поэтому часть строк может прийти повторно.
+
+        Returns:
+            Датафрейм измененных строк.
+        '''
+        parse_dates = {
+            'transactions': ['date', 'updated_at'],
+            'onetime': ['date', 'updated_at'],
+        }.get(table, ['updated_at'])
+
+        return self.__read_sql('get_changes_' + table, {
+            'user_id': user_id, 'last_id': last_id, 'last_updated': last_updated - CHANGES_LAG}, parse_dates=parse_dates)
+
+    def download_daily_aggregates(self, user_id):
+        return self.__read_sql('get_daily_aggregates', {'user_id': user_id}, parse_dates=['date'])
+
+    def replace_daily_aggregates(self, user_id, account_id, start_date, data):
+        '''Заменяет ежедневные агрегаты счета, начиная с указанной даты, в одной транзакции.
+
+        Args:
+            user_id: id пользователя.
+            account_id: id счета.
+            start_date: дата, начиная с которой агрегаты пересчитаны.
+            data: датафрейм новых агрегатов с колонками ['account_id', 'date', 'spend', 'income', 'balance'].
+        '''
+        rows = data.assign(user_id=user_id).to_dict(orient='records')
+        with self.connector.begin() as connection:
+            connection.execute(self.sql_queries['delete_daily_aggregates'], {
+                'b_user_id': user_id, 'b_account_id': int(account_id), 'b_start_date': start_date})
+            if len(rows) > 0:
+                connection.execute(
+                    self.sql_queries['add_daily_aggregates'], rows)
 
     def download_last_model(self, user_id):
         df = self.__read_sql('get_last_model',
@@ -205,34 +603,167 @@ class DB_Engine:
         if df.empty:
             return None
 
-        return pickle.loads(
+        model = pickle.loads(
             df.loc[0, 'dump']
         )
-
-    def upload_model(self, user_id, model, table='sbs_models'):
-        pd.DataFrame([[
-            user_id,
-            pickle.dumps(model)
-        ]], columns=[
-            'user_id',
-            'dump'
-        ]).to_sql(table, self.connector, schema=self.schema, if_exists='append', index=False)
+        # id записи в базе - версия модели, см. Accuracy
+        model.version_id = int(df.loc[0, 'db_id'])
+        return model
+
+    def upload_model(self, user_id, model, table='sbs_models', event_count=None, ml_event_count=None, partial=False):
+        '''Сохраняет модель пользователя.
+
+        Args:
+            event_count, ml_event_count: количество транзакций пользователя и событий, на которых обучена модель.
+                По event_count планировщик переобучения определяет объем новых данных, см. Scheduler.retrain_models.
+            partial: модель дообучена, см. SbsModel.partial_fit. Ошибки прогноза отсчитываются
+                от последнего полного обучения, см. download_accuracy_drift.
+
+        Returns:
+            id новой записи, он же версия модели. Записывается в model.version_id.
+        '''
+        return self.upload_models([{'user_id': user_id, 'model': model, 'event_count': event_count,
+                                    'ml_event_count': ml_event_count, 'partial': partial}], table)[0]
+
+    def upload_models(self, models, table='sbs_models'):
+        '''Сохраняет несколько моделей одним запросом.
+
+        Args:
+            models: список словарей {'user_id', 'model', 'event_count', 'ml_event_count', 'partial'}.
+
+        Returns:
+            Список id новых записей в том же порядке. Каждый id записывается в model.version_id.
+        '''
+        if len(models) == 0:
+            return []
+
+        rows = [{'user_id': m['user_id'], 'dump': pickle.dumps(m['model']),
+                 'event_count': m.get('event_count'), 'ml_event_count': m.get('ml_event_count'),
+                 'partial': m.get('partial', False)} for m in models]
+        result = self.connector.execute(self.tables[table].insert().values(rows).returning(
+            self.tables[table].c.id))
+        # Postgres возвращает строки RETURNING в порядке VALUES
+        versions = [r for r, in result]
+        for m, version_id in zip(models, versions):
+            m['model'].version_id = version_id
+        return versions
+
+    def get_last_model_version(self, user_id):
+        '''Возвращает id последней сохраненной модели пользователя или None.'''
+        return self.connector.execute(self.sql_queries['get_last_model_version'], {'user_id': user_id}).scalar()
+
+    def download_retrain_candidates(self):
+        '''Возвращает для каждого пользователя количество транзакций сейчас и на момент обучения последней модели.
+
+        Returns:
+            Датафрейм с колонками ['user_id', 'event_count', 'model_event_count', 'model_created_at'].
+            Для пользователей без модели и моделей, сохраненных до появления этих колонок, значения модели пустые.
+        '''
+        return self.__read_sql('get_retrain_candidates', {}, parse_dates=['model_created_at'], drop_uid=False)
+
+    def upload_forecast_accuracy(self, records):
+        '''Сохраняет пачку записей точности прогноза одним запросом.
+
+        Args:
+            records: датафрейм с колонками ['user_id', 'model_version', 'date', 'horizon', 'real_b', 'predicted_b'].
+        '''
+        if len(records) == 0:
+            return
+        rows = records.astype(object).where(records.notna(), None).to_dict(orient='records')
+        self.connector.execute(self.sql_queries['add_forecast_accuracy'], rows)
+
+    def download_accuracy_drift(self, recent_days=14, baseline_days=90, max_horizon=7):
+        '''Считает на стороне базы ошибки прогноза всех пользователей за последний и предыдущий периоды.
+
+        Args:
+            recent_days: длина последнего периода в днях.
+            baseline_days: длина всего рассматриваемого периода в днях.
+            max_horizon: учитываются только прогнозы не дальше этого количества дней,
+                чтобы ошибки разных загрузок были сравнимы.
+
+        Returns:
+            Датафрейм с колонками ['user_id', 'model_version', 'recent_count', 'recent_mae', 'recent_bias',
+            'baseline_count', 'baseline_mae', 'mean_balance']. В recent_* входят только прогнозы моделей,
+            сохраненных начиная с последнего полного обучения, после переобучения recent_count обнуляется.
+        '''
+        return self.__read_sql('get_accuracy_drift', {
+            'recent_days': recent_days, 'baseline_days': baseline_days, 'max_horizon': max_horizon}, drop_uid=False)
+
+    def download_accuracy_rolling(self, user_id, window=7):
+        '''Возвращает ежедневные ошибки прогноза пользователя по горизонтам и их скользящее среднее.
+
+        Args:
+            user_id: id пользователя.
+            window: размер окна скользящего среднего в днях с записями.
+
+        Returns:
+            Датафрейм с колонками ['day', 'horizon', 'mae', 'bias', 'rolling_mae'].
+        '''
+        return self.__read_sql('get_accuracy_rolling', {
+            'user_id': user_id, 'window': window - 1}, parse_dates=['day'], drop_uid=False)
 
     def delete_transactions(self, user_id, account_id, start_date, end_date='end'):
-        query = self.sql_queries['delete_transactions']
-        if end_date == 'end':
-            query = query.where(
-                self.tables['transactions'].c.date > start_date)
-        else:
-            query = query.where(
-                self.tables['transactions'].c.date.between(start_date, end_date))
+        '''Помечает удаленными транзакции счета с датой из [start_date, end_date].
+
+        Args:
+            user_id: id пользователя.
+            account_id: id счета.
+            start_date: первая дата диапазона.
+            end_date: последняя дата диапазона или 'end', если до конца истории.
+
+        Returns:
+            Количество помеченных транзакций.
+        '''
+        return self.connector.execute(self.sql_queries['delete_transactions'],
+                                      self.__delete_range(user_id, account_id, start_date, end_date)).rowcount
+
+    def replace_transactions(self, user_id, account_id, start_date, end_date, rows, return_updated_at=False):
+        '''Заменяет транзакции счета за диапазон дат [start_date, end_date] новыми в одной транзакции:
+        старые строки диапазона помечаются удаленными, новые добавляются. Строки вне диапазона не затрагиваются.
+
+        Args:
+            user_id: id пользователя.
+            account_id: id счета.
+            start_date: первая дата диапазона.
+            end_date: последняя дата диапазона или 'end', если до конца истории.
+            rows: список словарей новых транзакций с колонками таблицы transactions.
+            return_updated_at: возвращать ли вместе с id время изменения строк, см. add_event.
+
+        Returns:
+            Список id добавленных транзакций, в порядке rows, или, если return_updated_at, список кортежей (id, updated_at).
+        '''
+        with self.connector.begin() as connection:
+            connection.execute(self.sql_queries['delete_transactions'],
+                               self.__delete_range(user_id, account_id, start_date, end_date))
+            if len(rows) == 0:
+                return []
+            result = connection.execute(self.sql_queries['add_transactions'], rows).fetchall()
+            if return_updated_at:
+                return [(db_id, updated_at) for db_id, updated_at in result]
+            return [db_id for db_id, _ in result]
+
+    def __delete_range(self, user_id, account_id, start_date, end_date):
+        return {
+            'b_user_id': user_id,
+            'b_account_id': int(account_id),
+            'b_start_date': start_date,
+            'b_end_date': datetime(9999, 12, 31) if end_date == 'end' else end_date,
+        }
 
-        self.connector.execute(self.sql_queries['delete_transactions'], {
-                               'user_id': user_id, 'account_id': account_id})
+    def add_event(self, table: str, data: dict, return_updated_at=False):
+        '''Добавляет строку в таблицу.
 
-    def add_event(self, table: str, data: dict):
-        result = self.connector.execute(self.sql_queries['add_'+table], data)
-        return result.first()[0]
+        Args:
+            table: одна из таблиц ['transactions', 'regular', 'onetime', 'accounts'].
+            data: словарь значений колонок.
+            return_updated_at: возвращать ли вместе с id время изменения строки. По нему пользователь
+                сдвигает отметку загруженных изменений, чтобы не загружать свою строку повторно, см. User.refresh.
+
+        Returns:
+            id новой строки или, если return_updated_at, кортеж (id, updated_at).
+        '''
+        result = self.connector.execute(self.sql_queries['add_'+table], data).first()
+        return tuple(result) if return_updated_at else result[0]
 
     def delete_event(self, table, db_id):
         self.connector.execute(
@@ -250,6 +781,36 @@ class DB_Engine:
                         WHERE date > now()"))
         return [r for r, in result]
 
+    def download_notification_events(self, start_date, end_date):
+        '''Рассчитывает на стороне базы регулярные и разовые события всех пользователей в указанном окне.
+        Регулярные события с adjust_price, adjust_date или follow_overdue не рассчитываются,
+        так как зависят от истории транзакций, см. get_users_with_adjusted_events.
+
+        Args:
+            start_date: первый день окна.
+            end_date: последний день окна.
+
+        Returns:
+            Датафрейм с колонками ['user_id', 'date', 'amount', 'description']
+        '''
+        return self.__read_sql('get_notification_events', {
+            'start_date': start_date, 'end_date': end_date}, parse_dates=['date'], drop_uid=False)
+
+    def get_users_with_adjusted_events(self, start_date, end_date):
+        '''Возвращает пользователей, у которых в указанном окне действуют регулярные события,
+        требующие пересчета по истории транзакций.
+
+        Args:
+            start_date: первый день окна.
+            end_date: последний день окна.
+
+        Returns:
+            Список id пользователей.
+        '''
+        result = self.connector.execute(self.sql_queries['get_users_with_adjusted_events'], {
+            'start_date': start_date, 'end_date': end_date})
+        return [r for r, in result]
+
     def __read_sql(self, quory_name: str, values: dict, parse_dates=None, drop_uid=True):
         data = pd.read_sql(
             sql=self.sql_queries[quory_name],
@@ -0,0 +1,115 @@
+import dbm
+import json
+import threading
+import time
+
+
+class DialogState:
+    '''Состояние диалога пользователя. Содержит только то, что нужно, чтобы заново создать диалог.
+
+    Attributes:
+        cmd: команда диалога, например '/regular'.
+        step: название шага, на котором диалог ждет ответ пользователя, или None.
+        args: аргументы шага. Только значения, которые можно сохранить в JSON.
+        expires: время time.time(), после которого состояние устаревает.
+    '''
+    __slots__ = ('cmd', 'step', 'args', 'expires')
+
+    def __init__(self, cmd, step=None, args=None, expires=None):
+        self.cmd = cmd
+        self.step = step
+        self.args = args or {}
+        self.expires = expires
+
+    def to_json(self):
+        return json.dumps({'cmd': self.cmd, 'step': self.step, 'args': self.args, 'expires': self.expires})
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**json.loads(data))
+
+
+class DialogStateStore:
+    '''Хранилище состояний диалогов с истечением срока. Хранит состояния в памяти
+    или, если указан путь, в локальном файле ключ-значение, общем для перезапусков процесса.
+    '''
+
+    def __init__(self, ttl=3600, path=None):
+        '''
+        Args:
+            ttl: через сколько секунд без сообщений состояние диалога удаляется.
+            path: путь к файлу dbm. Если None, состояния хранятся в памяти.
+        '''
+        self.ttl = ttl
+        self.__path = path
+        self.__states = {}
+        self.__lock = threading.Lock()
+
+    def get(self, user_id):
+        '''Возвращает состояние диалога пользователя или None, если его нет или оно устарело.
+        Устаревшее состояние удаляется.'''
+        now = time.time()
+        with self.__lock:
+            if self.__path is None:
+                state = self.__states.get(user_id)
+                if state is not None and state.expires < now:
+                    del self.__states[user_id]
+                    state = None
+            else:
+                with dbm.open(self.__path, 'c') as db:
+                    data = db.get(str(user_id))
+                    state = DialogState.from_json(data) if data is not None else None
+                    if state is not None and state.expires < now:
+                        del db[str(user_id)]
+                        state = None
+
+        return state
+
+    def set(self, user_id, state):
+        '''Сохраняет состояние диалога и продлевает срок его хранения.
+        Состояние сериализуется в JSON в обоих режимах, чтобы аргументы, которые нельзя сохранить в файл,
+        отклонялись и при хранении в памяти. В памяти хранится копия, восстановленная из JSON.'''
+        state.expires = time.time() + self.ttl
+        try:
+            data = state.to_json()
+        except (TypeError, ValueError) as e:
+            raise Exception(f'Dialog state args are not JSON serializable /"{state.cmd} {state.step}/": {e}')
+
+        with self.__lock:
+            if self.__path is None:
+                self.__states[user_id] = DialogState.from_json(data)
+            else:
+                with dbm.open(self.__path, 'c') as db:
+                    db[str(user_id)] = data
+
+    def pop(self, user_id):
+        '''Удаляет состояние диалога пользователя.'''
+        with self.__lock:
+            if self.__path is None:
+                self.__states.pop(user_id, None)
+            else:
+                with dbm.open(self.__path, 'c') as db:
+                    if str(user_id) in db:
+                        del db[str(user_id)]
+
+    def cleanup(self):
+        '''Удаляет все устаревшие состояния.
+
+        Returns:
+            Количество удаленных состояний.
+        '''
+        now = time.time()
+        with self.__lock:
+            if self.__path is None:
+                expired = [k for k, v in self.__states.items()
+                           if v.expires < now]
+                for k in expired:
+                    del self.__states[k]
+            else:
+                with dbm.open(self.__path, 'c') as db:
+                    expired = [k for k in db.keys()
+                               if DialogState.from_json(db[k]).expires < now]
+                    for k in expired:
+                        del db[k]
+
+        return len(expired)
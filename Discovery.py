@@ -0,0 +1,197 @@
+import numpy as np
+import pandas as pd
+
+
+# Периоды регулярных событий: (название, длина в днях, d_years, d_months, d_days, phases, tolerance).
+# Платеж два раза в месяц нельзя описать одним событием, он предлагается как phases событий с интервалом в месяц.
+# tolerance - допустимое отклонение интервала от периода в днях: разная длина месяцев и перенос платежа с выходных
+PERIODS = pd.DataFrame([
+    ('неделя', 7., 0, 0, 7, 1, 1),
+    ('2 недели', 14., 0, 0, 14, 1, 2),
+    ('2 раза в месяц', 15.22, 0, 1, 0, 2, 3),
+    ('месяц', 30.44, 0, 1, 0, 1, 4),
+    ('квартал', 91.31, 0, 3, 0, 1, 5),
+    ('полгода', 182.62, 0, 6, 0, 1, 6),
+    ('год', 365.25, 1, 0, 0, 1, 7),
+], columns=['name', 'days', 'd_years', 'd_months', 'd_days', 'phases', 'tolerance'])
+
+RESULT_COLUMNS = ['description', 'search_f', 'arg_sf', 'amount', 'start_date', 'end_date', 'd_years', 'd_months',
+                  'd_days', 'adjust_price', 'adjust_date', 'follow_overdue', 'period', 'occurrences', 'share']
+
+# Поиск по описанию, для которого arg_sf - список описаний через запятую
+DESCRIPTION_SEARCH = ['description', 'amount_description', 'amount<_description']
+
+
+def normalize_descriptions(descriptions):
+    '''Приводит описания транзакций к виду, в котором совпадают описания одного получателя:
+    нижний регистр, без цифр (номеров заказов, дат) и знаков препинания.'''
+    return descriptions.fillna('').astype(str).str.lower().str.replace(
+        r'[\d\W_]+', ' ', regex=True).str.strip()
+
+
+def covered_keys(regular):
+    '''Возвращает нормализованные описания, которые уже ищут существующие регулярные события.
+
+    Args:
+        regular: датафрейм регулярных событий, с колонкой 'user_id' для нескольких пользователей.
+
+    Returns:
+        MultiIndex пар (user_id, описание). Для одного пользователя user_id равен 0.
+    '''
+    if regular is None or len(regular) == 0:
+        return pd.MultiIndex.from_arrays([[], []])
+
+    users = regular['user_id'].values if 'user_id' in regular.columns else np.zeros(
+        len(regular), dtype=np.int64)
+    keys = [pd.DataFrame({'user_id': users, 'description': regular['description'].values})]
+
+    by_description = regular['search_f'].isin(DESCRIPTION_SEARCH).values
+    arg_sf = regular.loc[by_description, 'arg_sf'].fillna('').astype(str)
+    # Для 'amount<_description' первый элемент arg_sf - сумма, она отбросится при нормализации
+    keys.append(pd.DataFrame({
+        'user_id': users[by_description],
+        'description': arg_sf.str.split(',').values,
+    }).explode('description'))
+
+    keys = pd.concat(keys, ignore_index=True)
+    keys['description'] = normalize_descriptions(keys['description'])
+    return pd.MultiIndex.from_frame(keys[keys['description'] != ''])
+
+
+def discover_regular(transactions, regular=None, min_occurrences=3, band_width=.1, tolerance=None,
+                     min_share=.75, max_missed=1.5):
+    '''Находит в истории транзакций повторяющиеся платежи и предлагает для них регулярные события.
+
+    Транзакции группируются по нормализованному описанию, знаку и полосе суммы относительно медианы описания.
+    Для каждой группы строится гистограмма интервалов между транзакциями по периодам PERIODS,
+    группа считается регулярной, если большая часть интервалов попадает в один период.
+    Все группы всех пользователей обрабатываются за один проход.
+
+    Args:
+        transactions: датафрейм транзакций с колонками ['date', 'amount', 'description'],
+            с колонкой 'user_id' для нескольких пользователей.
+        regular: существующие регулярные события. Описания, которые они уже ищут, пропускаются.
+        min_occurrences: минимальное количество транзакций в группе.
+        band_width: ширина полосы суммы, как доля от медианы.
+        tolerance: допустимое отклонение интервала от периода в днях. Если None, PERIODS['tolerance'].
+        min_share: минимальная доля интервалов, попадающих в период.
+        max_missed: группа считается закончившейся, если после последней транзакции прошло больше
+            max_missed периодов до конца истории пользователя.
+
+    Returns:
+        Датафрейм предложений с колонками таблицы regular ['description', 'search_f', 'arg_sf', 'amount',
+        'start_date', 'end_date', 'd_years', 'd_months', 'd_days', 'adjust_price', 'adjust_date', 'follow_overdue']
+        и ['period', 'occurrences', 'share'], с колонкой 'user_id' для нескольких пользователей.
+        Упорядочен по пользователю и сумме. Платеж два раза в месяц дает две строки с d_months=1.
+    '''
+    has_user = 'user_id' in transactions.columns
+    data = pd.DataFrame({
+        'user_id': transactions['user_id'].values if has_user else 0,
+        'date': pd.to_datetime(transactions['date']).values,
+        'amount': transactions['amount'].astype(float).values,
+        'description': transactions['description'].values,
+        'key': normalize_descriptions(transactions['description']).values,
+    })
+    # Конец истории считается по каждому пользователю, чтобы старая выписка не отбрасывала все группы
+    history_end = data.groupby('user_id')['date'].max()
+    data = data[(data['amount'] != 0) & (data['key'] != '')]
+    data = data[~pd.MultiIndex.from_frame(
+        data[['user_id', 'key']]).isin(covered_keys(regular))]
+
+    empty = pd.DataFrame([], columns=(['user_id'] if has_user else []) + RESULT_COLUMNS)
+    if data.empty:
+        return empty
+
+    # Полоса суммы считается от медианы описания, чтобы одинаковые суммы не разбивались границей полосы
+    data['sign'] = np.sign(data['amount'])
+    median = data['amount'].abs().groupby(
+        [data['user_id'], data['key'], data['sign']]).transform('median')
+    data['band'] = np.round(np.log(data['amount'].abs() / median) / np.log1p(band_width))
+    data['group'] = data.groupby(
+        ['user_id', 'key', 'sign', 'band'], sort=False).ngroup()
+    data = data.sort_values(['group', 'date'], kind='stable')
+
+    groups = data['group'].values
+    days = data['date'].values.astype('datetime64[D]').astype(np.int64)
+    group_count = groups.max() + 1 if len(groups) > 0 else 0
+
+    # Интервалы между соседними транзакциями одной группы, несколько транзакций за день считаются одной
+    same = groups[1:] == groups[:-1]
+    intervals = np.diff(days)[same]
+    interval_groups = groups[1:][same]
+    interval_groups = interval_groups[intervals > 0]
+    intervals = intervals[intervals > 0]
+
+    # Относительный допуск растет с периодом и для года пропускал бы случайные покупки через 10-14 месяцев,
+    # поэтому интервал должен отличаться от периода не больше, чем на фиксированное количество дней
+    tolerance = PERIODS['tolerance'].values if tolerance is None else np.full(len(PERIODS), tolerance)
+    distance = np.abs(intervals[:, np.newaxis] - PERIODS['days'].values[np.newaxis, :])
+    distance[distance > tolerance[np.newaxis, :]] = np.inf
+    bins = distance.argmin(axis=1)
+    valid = np.isfinite(distance.min(axis=1))
+    histogram = np.zeros((group_count, len(PERIODS)))
+    np.add.at(histogram, (interval_groups[valid], bins[valid]), 1)
+    interval_count = np.bincount(interval_groups, minlength=group_count)
+
+    stats = data.groupby('group').agg(
+        user_id=('user_id', 'first'),
+        occurrences=('amount', 'size'),
+        amount=('amount', 'median'),
+        amount_min=('amount', 'min'),
+        amount_max=('amount', 'max'),
+        last_date=('date', 'max'),
+        description=('description', 'last'),
+        descriptions=('description', 'unique'),
+    )
+    stats['period'] = histogram.argmax(axis=1)
+    stats['share'] = histogram.max(axis=1) / np.maximum(interval_count, 1)
+
+    period_days = PERIODS['days'].values[stats['period'].values]
+    missed = (stats['user_id'].map(history_end) - stats['last_date']).dt.days / period_days
+
+    stats = stats[(stats['occurrences'] >= min_occurrences) & (stats['share'] >= min_share) &
+                  (interval_count >= min_occurrences - 1) & (missed <= max_missed)]
+    if stats.empty:
+        return empty
+
+    periods = PERIODS.iloc[stats['period'].values].reset_index(drop=True)
+    constant = (stats['amount_min'] == stats['amount_max']).values
+    single = (stats['descriptions'].map(len) == 1).values
+    arg_sf = stats['descriptions'].map(','.join).values
+    searchable = ~stats['descriptions'].map(
+        lambda d: any(',' in s for s in d)).values
+
+    result = pd.DataFrame({
+        'user_id': stats['user_id'].values,
+        'description': stats['description'].astype(str).str[:25].values,
+        'search_f': np.select([~searchable, constant & single], ['dont_search', 'amount_description'], 'description'),
+        'arg_sf': np.where(searchable, arg_sf, None),
+        'amount': stats['amount'].round(2).values,
+        'start_date': stats['last_date'].dt.floor('D').values,
+        'end_date': None,
+        'd_years': periods['d_years'].values,
+        'd_months': periods['d_months'].values,
+        'd_days': periods['d_days'].values,
+        # Если сумма менялась, она пересчитывается по последним транзакциям
+        'adjust_price': ~constant & searchable,
+        'adjust_date': False,
+        'follow_overdue': False,
+        'period': periods['name'].values,
+        'occurrences': stats['occurrences'].values,
+        'share': stats['share'].values,
+    })
+
+    # Второе событие платежа два раза в месяц начинается с предпоследней транзакции
+    twice = periods['phases'].values == 2
+    if twice.any():
+        previous_date = data.assign(day=data['date'].dt.floor('D')).drop_duplicates(
+            ['group', 'day']).groupby('group')['day'].nth(-2)
+        second = result[twice].copy()
+        second['start_date'] = previous_date.reindex(stats.index[twice]).values
+        result = pd.concat([result, second])
+
+    result = result.sort_values(['user_id', 'amount', 'start_date']).reset_index(drop=True)
+
+    if not has_user:
+        result = result.drop('user_id', axis=1)
+    return result
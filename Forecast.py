@@ -0,0 +1,202 @@
+import numpy as np
+import pandas as pd
+
+
+ACCOUNT_DEBIT = 1
+ACCOUNT_CREDIT = 2
+
+
+def discharge_markers(days, discharge_day):
+    '''Отмечает дни выписки кредитных счетов. Если в месяце меньше дней, чем день выписки, выписка происходит в последний день месяца.
+
+    Args:
+        days: ежедневный DatetimeIndex прогноза.
+        discharge_day: массив дней выписки для каждого счета. 0 или NaN для счетов без выписки.
+
+    Returns:
+        Булев массив (дни × счета), True в дни выписки.
+    '''
+    discharge_day = np.nan_to_num(
+        np.asarray(discharge_day, dtype=float)).astype(np.int64)
+    day = np.asarray(days.day)[:, None]
+    days_in_month = np.asarray(days.days_in_month)[:, None]
+
+    return (day == np.minimum(discharge_day[None, :], days_in_month)) & (discharge_day[None, :] > 0)
+
+
+def project_balances(flows, start_balance, credit_limit, discharge, primary=None):
+    '''Проецирует балансы всех счетов за один векторизованный проход по массиву (дни × счета).
+
+    Кредитный счет не может уйти ниже -credit_limit: превышение списывается с основного счета.
+    В день выписки долг кредитного счета гасится переводом с основного счета.
+
+    Args:
+        flows: массив (дни × счета) ежедневных сумм по счетам.
+        start_balance: массив балансов счетов на начало прогноза.
+        credit_limit: массив кредитных лимитов. NaN для дебетовых счетов.
+        discharge: булев массив (дни × счета) дней выписки, см. discharge_markers.
+        primary: индекс основного дебетового счета. Если None, лимиты и выписки не применяются.
+
+    Returns:
+        Кортеж (balance, moved) массивов (дни × счета):
+        balance: баланс каждого счета на конец дня.
+        moved: накопленная сумма, переведенная на счет с основного счета.
+    '''
+    flows = np.asarray(flows, dtype=float)
+    n_days, n_accounts = flows.shape
+    start_balance = np.asarray(start_balance, dtype=float)
+    credit_limit = np.asarray(credit_limit, dtype=float)
+    discharge = np.asarray(discharge, dtype=bool)
+
+    if primary is None:
+        credit_limit = np.full(n_accounts, np.nan)
+        discharge = np.zeros_like(discharge)
+
+    lower = np.where(np.isnan(credit_limit), -np.inf, -credit_limit)
+    # День выписки завершает свой расчетный период
+    segment = np.cumsum(discharge, axis=0) - discharge
+    columns = np.arange(n_accounts)
+
+    balance = np.zeros((n_days, n_accounts))
+    moved = np.zeros((n_days, n_accounts))
+    segment_start = start_balance.copy()
+    total_moved = np.zeros(n_accounts)
+
+    for k in range(int(segment.max()) + 1 if n_days > 0 else 0):
+        in_segment = segment == k
+        current = segment_start + \
+            np.where(in_segment, flows, 0).cumsum(axis=0)
+        spill = np.maximum.accumulate(
+            np.maximum(lower - current, 0), axis=0)
+
+        balance = np.where(in_segment, current + spill, balance)
+        moved = np.where(in_segment, total_moved + spill, moved)
+
+        ends = in_segment & discharge
+        has_end = ends.any(axis=0)
+        end_row = np.argmax(ends, axis=0)
+        end_balance = balance[end_row, columns]
+        transfer = np.where(has_end, np.maximum(-end_balance, 0), 0)
+
+        balance[end_row[has_end], columns[has_end]] += transfer[has_end]
+        moved[end_row[has_end], columns[has_end]] += transfer[has_end]
+        total_moved = np.where(
+            has_end, moved[end_row, columns], total_moved)
+        segment_start = np.where(
+            has_end, end_balance + transfer, segment_start)
+
+    if primary is not None:
+        balance[:, primary] -= moved.sum(axis=1)
+
+    return balance, moved
+
+
+def project_accounts(model_amounts, event_amounts, start_balance, accounts, spend_share, primary_id=None):
+    '''Распределяет прогноз по счетам и строит балансы каждого счета и общий баланс.
+
+    Прогноз модели делится между счетами пропорционально их доле в расходах,
+    регулярные и разовые события относятся на основной счет.
+
+    Args:
+        model_amounts: серия ежедневного прогноза модели.
+        event_amounts: серия ежедневных сумм регулярных и разовых событий, с тем же индексом.
+        start_balance: серия балансов на начало прогноза, индекс - id счета.
+        accounts: датафрейм счетов с колонками ['db_id', 'type', 'credit_limit', 'discharge_day'].
+        spend_share: серия расходов по счетам за последний период, индекс - id счета.
+        primary_id: id основного дебетового счета. Если None, лимиты и выписки не применяются.
+
+    Returns:
+        Кортеж (balances, total):
+        balances: датафрейм балансов, колонки - id счетов.
+        total: серия общего баланса.
+    '''
+    index = model_amounts.index
+    account_ids = list(pd.Index(start_balance.index).union(
+        pd.Index(accounts['db_id'] if len(accounts) > 0 else [])))
+    if len(account_ids) == 0:
+        account_ids = [primary_id if primary_id is not None else 0]
+
+    accounts = accounts.set_index('db_id').reindex(account_ids)
+    is_credit = (accounts['type'] == ACCOUNT_CREDIT).values
+    credit_limit = np.where(
+        is_credit, accounts['credit_limit'].astype(float).fillna(0).values, np.nan)
+    discharge_day = np.where(
+        is_credit, accounts['discharge_day'].astype(float).fillna(0).values, 0)
+
+    share = spend_share.reindex(account_ids).fillna(0).values.astype(float)
+    if share.sum() == 0:
+        share = np.ones(len(account_ids))
+    share = share / share.sum()
+
+    primary = account_ids.index(
+        primary_id) if primary_id in account_ids else None
+    events_column = primary if primary is not None else 0
+
+    flows = np.outer(model_amounts.values.astype(float), share)
+    flows[:, events_column] += event_amounts.values.astype(float)
+
+    balance, _ = project_balances(
+        flows,
+        start_balance.reindex(account_ids).fillna(0).values,
+        credit_limit,
+        discharge_markers(index, discharge_day),
+        primary
+    )
+
+    balances = pd.DataFrame(balance, index=index, columns=account_ids)
+    return balances, balances.sum(axis=1)
+
+
+def simulate_balance(model_amounts, event_amounts, start_balance, residuals, n_paths=2000, percentiles=(5, 25, 50, 75, 95), random_state=None):
+    '''Симулирует возможные траектории общего баланса методом Монте-Карло.
+    Ко всем дням прогноза модели сразу добавляются остатки, случайно выбранные из остатков обучающей выборки.
+    Вся симуляция - один массив (траектории × дни).
+
+    Args:
+        model_amounts: серия ежедневного прогноза модели.
+        event_amounts: серия ежедневных сумм регулярных и разовых событий, с тем же индексом.
+        start_balance: общий баланс на начало прогноза.
+        residuals: массив остатков модели на обучающей выборке.
+        n_paths: количество траекторий.
+        percentiles: перцентили, по которым строятся полосы.
+        random_state: seed генератора случайных чисел.
+
+    Returns:
+        Кортеж (bands, paths):
+        bands: датафрейм перцентилей баланса, колонки 'p5', 'p25' и т.д.
+        paths: массив (траектории × дни) симулированных балансов.
+    '''
+    rng = np.random.default_rng(random_state)
+    residuals = np.asarray(residuals, dtype=float)
+    n_days = len(model_amounts)
+
+    noise = rng.choice(residuals, size=(n_paths, n_days)) if len(
+        residuals) > 0 else np.zeros((n_paths, n_days))
+    # Как и в SbsModel.predict, прогноз расходов не может быть положительным
+    spend = np.minimum(model_amounts.values.astype(float)[None, :] + noise, 0)
+    paths = start_balance + \
+        np.cumsum(spend + event_amounts.values.astype(float)[None, :], axis=1)
+
+    bands = pd.DataFrame(np.percentile(paths, percentiles, axis=0).T,
+                         index=model_amounts.index, columns=[f'p{p}' for p in percentiles])
+    return bands, paths
+
+
+def probability_below(paths, index, before_date=None, level=0):
+    '''Считает вероятность того, что баланс опустится ниже уровня до указанной даты.
+
+    Args:
+        paths: массив (траектории × дни) симулированных балансов.
+        index: ежедневный индекс траекторий.
+        before_date: дата, до которой проверять баланс включительно. Если None, весь прогноз.
+        level: уровень баланса.
+
+    Returns:
+        Доля траекторий, опустившихся ниже уровня.
+    '''
+    n_days = len(index) if before_date is None else int(
+        index.searchsorted(pd.to_datetime(before_date), side='right'))
+    if n_days == 0:
+        return 0.
+
+    return float((paths[:, :n_days].min(axis=1) < level).mean())
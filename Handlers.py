@@ -0,0 +1,201 @@
+from telegram import Update
+from telegram.ext import CommandHandler, CallbackContext, CallbackQueryHandler, MessageHandler, Filters
+import logging
+import os
+from datetime import time
+from Manager import UserManager
+import Scheduler
+import Visual
+import Accuracy
+
+
+logger = logging.getLogger(__name__)
+
+# Заполняются процессом бота перед регистрацией обработчиков, см. bot.main и Sharding.BotHandler
+settings = {}
+manager = None
+
+
+def ping(update: Update, context: CallbackContext) -> None:
+    update.message.reply_text(
+        f'pong {update.effective_user.first_name}', quote=True)
+
+
+def reset(update: Update, context: CallbackContext) -> None:
+    if update.message.from_user.id == settings['trusted_chat_id']:
+        global manager
+        manager = UserManager(context.bot, settings['db_connector'], manager.shard,
+                              dialog_store_path=settings.get('dialog_store_path'))
+
+
+def forecast(update: Update, context: CallbackContext) -> None:
+    user_id = update.message.from_user.id
+
+    if len(context.args) > 0 and context.args[0].isdigit():
+        months = int(context.args[0])
+        if months > 9 or months < 1:
+            months = 1
+    else:
+        months = 1
+
+    bands = 'bands' in context.args
+    categories = 'categories' in context.args
+
+    report_obj = manager.report_forecast(user_id, months, bands, categories)
+    sent = update.message.reply_photo(
+        photo=Visual.PLOT_CACHE.photo(report_obj['plot']), quote=True)
+    Visual.PLOT_CACHE.remember_upload(report_obj['plot'], sent)
+    for page in report_obj['message'] + report_obj.get('categories', []):
+        update.message.reply_text(
+            text=page, quote=False, parse_mode='html')
+
+
+def refit(update: Update, context: CallbackContext) -> None:
+    user_id = update.message.from_user.id
+
+    result = manager.fit_new_model(user_id)
+    update.message.reply_text(f'OK!\n{result}')
+
+
+def recategorize(update: Update, context: CallbackContext) -> None:
+    user_id = update.message.from_user.id
+
+    result = manager.recategorize(user_id)
+    update.message.reply_text(f'OK!\n{result}')
+
+
+def category_rule(update: Update, context: CallbackContext) -> None:
+    user_id = update.message.from_user.id
+
+    if len(context.args) < 3:
+        update.message.reply_text(
+            'Формат: /category exact|prefix|regex <категория> <описание>')
+        return
+
+    try:
+        result = manager.add_category_rule(
+            user_id, context.args[0], context.args[1], ' '.join(context.args[2:]))
+    except Exception as e:
+        update.message.reply_text(f'Ошибка: {e}')
+        return
+    update.message.reply_text(f'OK!\n{result}')
+
+
+def refresh(update: Update, context: CallbackContext) -> None:
+    user_id = update.message.from_user.id
+
+    if 'all' in context.args and user_id == settings['trusted_chat_id']:
+        result = manager.refresh_all()
+    else:
+        result = manager.refresh_user(user_id)
+    update.message.reply_text(f'OK!\n{result}')
+
+
+def plot_stats(update: Update, context: CallbackContext) -> None:
+    if update.message.from_user.id == settings['trusted_chat_id']:
+        update.message.reply_text(f'plot_cache\n{Visual.PLOT_CACHE.stats()}')
+
+
+def precompute(context: CallbackContext) -> None:
+    report = Scheduler.precompute_forecasts(manager)
+    context.bot.send_message(
+        settings['trusted_chat_id'], f'precompute_forecasts\n{report}')
+
+
+def flush_accuracy(context: CallbackContext) -> None:
+    Accuracy.LOG.flush(manager.db_engine)
+
+
+def refit_degraded(context: CallbackContext) -> None:
+    report = Scheduler.refit_degraded(manager)
+    context.bot.send_message(
+        settings['trusted_chat_id'], f'refit_degraded\n{report}')
+
+
+def retrain(context: CallbackContext) -> None:
+    Scheduler.retrain_models(manager)
+
+
+def daily_notice(context: CallbackContext) -> None:
+    report = manager.daily_notice()
+    context.bot.send_message(
+        settings['trusted_chat_id'], f'daily_notice\n{report}')
+
+
+def cleanup_dialogs(context: CallbackContext) -> None:
+    removed = manager.dialog_states.cleanup()
+    logger.info(f'cleanup_dialogs: {removed} expired dialog states removed')
+
+
+def evict_users(context: CallbackContext) -> None:
+    evicted = manager.evict_idle_users()
+    logger.info(f'evict_users: {evicted} idle users unloaded')
+
+
+def discover_regular(context: CallbackContext) -> None:
+    report = manager.discover_regular_notice()
+    context.bot.send_message(
+        settings['trusted_chat_id'], f'discover_regular\n{report}')
+
+
+def bot_dialog(update: Update, context: CallbackContext) -> None:
+    user_id = update.message.from_user.id
+    manager.bot_dialog(user_id, update)
+
+
+def keyboard_callback(update: Update, context: CallbackContext) -> None:
+    user_id = update.callback_query.message.chat_id
+    manager.bot_dialog_keyboard(user_id, update)
+
+
+def message(update: Update, context: CallbackContext) -> None:
+    user_id = update.message.from_user.id
+    manager.bot_dialog(user_id, update)
+
+
+def add_handlers(dispatcher) -> None:
+    dispatcher.add_handler(CommandHandler('pred', forecast))
+    dispatcher.add_handler(CommandHandler('ping', ping))
+    dispatcher.add_handler(CommandHandler('reset', reset))
+    dispatcher.add_handler(CommandHandler('refit', refit))
+    dispatcher.add_handler(CommandHandler('refresh', refresh))
+    dispatcher.add_handler(CommandHandler('recategorize', recategorize))
+    dispatcher.add_handler(CommandHandler('category', category_rule))
+    dispatcher.add_handler(CommandHandler('plotstats', plot_stats))
+    dispatcher.add_handler(
+        CommandHandler(['regular', 'onetime', 'accounts', 'transactions', 'tr'], bot_dialog))
+    dispatcher.add_handler(MessageHandler(Filters.text, message))
+    dispatcher.add_handler(CallbackQueryHandler(keyboard_callback))
+
+
+def add_jobs(job_queue) -> None:
+    job_queue.run_daily(precompute, time=time(hour=1))
+    job_queue.run_daily(refit_degraded, time=time(hour=2))
+    job_queue.run_repeating(flush_accuracy, interval=300)
+    job_queue.run_repeating(cleanup_dialogs, interval=3600)
+    job_queue.run_repeating(evict_users, interval=3600)
+    # Переобучение можно вынести в отдельный процесс: python Scheduler.py retrain 60
+    if os.getenv('ICYB_RETRAIN', 'bot') == 'bot':
+        job_queue.run_repeating(retrain, interval=3600, first=600)
+    job_queue.run_daily(daily_notice, time=time(hour=6))
+    # Раз в неделю, по воскресеньям
+    job_queue.run_daily(discover_regular, time=time(hour=12), days=(6,))
+
+
+def setup(dispatcher, job_queue, bot, db_settings, bot_settings, shard=None) -> None:
+    '''Создает UserManager процесса и регистрирует обработчики команд и задачи.
+
+    Args:
+        dispatcher: Dispatcher, в котором регистрируются обработчики.
+        job_queue: JobQueue для периодических задач.
+        bot: telegram.Bot для отправки сообщений.
+        db_settings: параметры подключения к базе данных.
+        bot_settings: словарь настроек из settings.np.json.
+        shard: кортеж (номер шарда, количество шардов) или None.
+    '''
+    global settings, manager
+    settings = bot_settings
+    add_handlers(dispatcher)
+    manager = UserManager(bot, db_settings, shard,
+                          dialog_store_path=settings.get('dialog_store_path'))
+    add_jobs(job_queue)
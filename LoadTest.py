@@ -0,0 +1,541 @@
+import os
+import pickle
+import random
+import shlex
+import shutil
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+from Manager import UserManager
+import Categories
+import Scheduler
+import Webhook
+
+
+# Доли команд в сценарии пользователя
+DEFAULT_MIX = {
+    '/regular add': 0.15,
+    '/onetime show': 0.3,
+    '/tr add': 0.1,
+    '/pred 3': 0.35,
+    '/refit': 0.1,
+}
+
+DESCRIPTIONS = ['Пятерочка', 'Перекресток', 'Яндекс.Такси', 'Кофейня', 'Аптека',
+                'Макдоналдс', 'Метро', 'Ozon', 'Wildberries', 'Перевод']
+CATEGORIES = ['Супермаркеты', 'Супермаркеты', 'Такси', 'Рестораны', 'Аптеки',
+              'Фастфуд', 'Транспорт', 'Маркетплейсы', 'Маркетплейсы', 'Переводы']
+
+
+class FakeDBEngine:
+    '''Хранит таблицы базы данных в памяти процесса. Повторяет интерфейс DataLoader.DB_Engine,
+    который используют User и UserManager.
+    '''
+
+    columns = {
+        'transactions': ['id', 'user_id', 'date', 'account_id', 'amount', 'category', 'description', 'balance', 'is_del'],
+        'regular': ['id', 'user_id', 'description', 'search_f', 'arg_sf', 'amount', 'start_date', 'end_date', 'd_years',
+                    'd_months', 'd_days', 'adjust_price', 'adjust_date', 'follow_overdue', 'is_del'],
+        'onetime': ['id', 'user_id', 'description', 'amount', 'date', 'is_del'],
+        'accounts': ['id', 'user_id', 'type', 'description', 'credit_limit', 'discharge_day'],
+        'daily_aggregates': ['user_id', 'account_id', 'date', 'spend', 'income', 'balance'],
+    }
+
+    def __init__(self):
+        self.schema = 'fake'
+        self.tables = {table: pd.DataFrame(columns=columns)
+                       for table, columns in self.columns.items()}
+        self.models = {}
+        self.forecast_accuracy = []
+        self.discovery_notices = pd.DataFrame(columns=['user_id', 'description', 'period'])
+        self.category_rules = {}
+        self.__last_model_id = 0
+        self.__last_id = {table: 0 for table in self.columns}
+        self.__lock = threading.RLock()
+
+    def get_category_rules(self, user_id):
+        return Categories.CategoryRules(self.category_rules.get(user_id, []))
+
+    def add_category_rule(self, user_id, key, value, match_type=Categories.MATCH_EXACT):
+        with self.__lock:
+            self.category_rules.setdefault(user_id, []).append((key, value, match_type))
+
+    def refresh_category_rules(self, user_id):
+        return False
+
+    def update_categories(self, categories):
+        with self.__lock:
+            table = self.tables['transactions']
+            table['category'] = table['id'].map(
+                categories).fillna(table['category'])
+
+    def download_regular(self, user_id):
+        return self.__read('regular', user_id, 'start_date')
+
+    def download_onetime(self, user_id):
+        return self.__read('onetime', user_id, 'date')
+
+    def download_accounts(self, user_id):
+        return self.__read('accounts', user_id, 'id')
+
+    def download_transactions(self, user_id, start_date=None, end_date=None):
+        data = self.__read('transactions', user_id, 'date')
+        if start_date is not None:
+            data = data[pd.to_datetime(data['date']) >= pd.to_datetime(start_date)]
+        if end_date is not None:
+            data = data[pd.to_datetime(data['date']) < pd.to_datetime(end_date)]
+        return data.reset_index(drop=True)
+
+    def download_history(self, start_date, shard=None):
+        with self.__lock:
+            data = self.tables['transactions']
+        data = data[~data['is_del'].astype(bool) & (pd.to_datetime(data['date']) >= pd.to_datetime(start_date))]
+        if shard is not None:
+            data = data[data['user_id'].astype(int) % shard[1] == shard[0]]
+        return self.__cast(data[['user_id', 'date', 'amount', 'description']].sort_values(
+            ['user_id', 'date']).reset_index(drop=True))
+
+    def download_all_regular(self):
+        with self.__lock:
+            data = self.tables['regular']
+        return data[~data['is_del'].astype(bool)].sort_values(['user_id', 'start_date']).reset_index(
+            drop=True).rename(columns={'id': 'db_id'})
+
+    def download_changes(self, table, user_id, last_id, last_updated):
+        return self.__read(table, user_id, 'id').iloc[0:0]
+
+    def download_daily_aggregates(self, user_id):
+        return self.__read('daily_aggregates', user_id, 'date')
+
+    def replace_daily_aggregates(self, user_id, account_id, start_date, data):
+        with self.__lock:
+            table = self.tables['daily_aggregates']
+            table = table[~((table['user_id'] == user_id) & (table['account_id'] == account_id) &
+                            (table['date'] >= start_date))]
+            self.tables['daily_aggregates'] = pd.concat(
+                [table, data.assign(user_id=user_id)], ignore_index=True)
+
+    def download_last_model(self, user_id):
+        if user_id not in self.models:
+            return None
+        version_id, dump = self.models[user_id]
+        model = pickle.loads(dump)
+        model.version_id = version_id
+        return model
+
+    def upload_model(self, user_id, model, table='sbs_models', event_count=None, ml_event_count=None, partial=False):
+        return self.upload_models([{'user_id': user_id, 'model': model, 'event_count': event_count,
+                                    'ml_event_count': ml_event_count, 'partial': partial}], table)[0]
+
+    def upload_models(self, models, table='sbs_models'):
+        versions = []
+        with self.__lock:
+            for m in models:
+                self.__last_model_id += 1
+                self.models[m['user_id']] = (
+                    self.__last_model_id, pickle.dumps(m['model']))
+                m['model'].version_id = self.__last_model_id
+                versions.append(self.__last_model_id)
+        return versions
+
+    def get_last_model_version(self, user_id):
+        return self.models[user_id][0] if user_id in self.models else None
+
+    def upload_forecast_accuracy(self, records):
+        with self.__lock:
+            self.forecast_accuracy.append(records)
+
+    def download_discovery_notices(self, shard=None):
+        with self.__lock:
+            data = self.discovery_notices
+        if shard is not None:
+            data = data[data['user_id'].astype(int) % shard[1] == shard[0]]
+        return data.reset_index(drop=True)
+
+    def add_discovery_notices(self, notices):
+        with self.__lock:
+            self.discovery_notices = pd.concat([self.discovery_notices, notices[
+                ['user_id', 'description', 'period']]]).drop_duplicates(ignore_index=True)
+
+    def delete_transactions(self, user_id, account_id, start_date, end_date='end'):
+        with self.__lock:
+            table = self.tables['transactions']
+            mask = (table['user_id'] == user_id) & (table['account_id'] == account_id) & \
+                ~table['is_del'].astype(bool) & (table['date'] >= start_date)
+            if end_date != 'end':
+                mask &= table['date'] <= end_date
+            table.loc[mask, 'is_del'] = True
+            return int(mask.sum())
+
+    def replace_transactions(self, user_id, account_id, start_date, end_date, rows, return_updated_at=False):
+        with self.__lock:
+            self.delete_transactions(user_id, account_id, start_date, end_date)
+            if len(rows) == 0:
+                return []
+            first_id = self.add_event('transactions', rows)
+        ids = list(range(first_id, first_id + len(rows)))
+        return [(i, pd.Timestamp.now()) for i in ids] if return_updated_at else ids
+
+    def add_event(self, table: str, data: dict, return_updated_at=False):
+        rows = data if isinstance(data, list) else [data]
+        with self.__lock:
+            first_id = self.__last_id[table] + 1
+            self.__last_id[table] += len(rows)
+            new_rows = pd.DataFrame(rows).assign(
+                id=range(first_id, first_id + len(rows)))
+            if 'is_del' in self.columns[table]:
+                new_rows['is_del'] = False
+            self.tables[table] = pd.concat(
+                [self.tables[table], new_rows], ignore_index=True)
+        return (first_id, pd.Timestamp.now()) if return_updated_at else first_id
+
+    def delete_event(self, table, db_id):
+        with self.__lock:
+            db_id = [int(i) for i in db_id]
+            self.tables[table].loc[self.tables[table]
+                                   ['id'].isin(db_id), 'is_del'] = True
+
+    def edit_event(self, table, db_id, column, value):
+        with self.__lock:
+            self.tables[table].loc[self.tables[table]
+                                   ['id'] == int(db_id), column] = value
+
+    def get_users_for_notifications(self):
+        return list(set(self.tables['regular']['user_id']) | set(self.tables['onetime']['user_id']))
+
+    def download_notification_events(self, start_date, end_date):
+        onetime = self.tables['onetime']
+        onetime = onetime[(~onetime['is_del'].astype(bool)) & (onetime['date'] >= pd.to_datetime(start_date)) &
+                          (onetime['date'] <= pd.to_datetime(end_date))]
+        return onetime[['user_id', 'date', 'amount', 'description']].reset_index(drop=True)
+
+    def get_users_with_adjusted_events(self, start_date, end_date):
+        return list(self.tables['regular']['user_id'].unique())
+
+    def __read(self, table, user_id, sort_column):
+        with self.__lock:
+            data = self.tables[table]
+            data = data[data['user_id'] == user_id]
+        if 'is_del' in data.columns:
+            data = data[~data['is_del'].astype(bool)]
+        return self.__cast(data.sort_values(sort_column).reset_index(drop=True).rename(
+            columns={'id': 'db_id'}).drop('user_id', axis=1))
+
+    @staticmethod
+    def __cast(data):
+        '''Приводит типы колонок к тем, что возвращает DB_Engine: timestamp и parse_dates - datetime64, numeric - float.'''
+        data = data.copy()
+        for column in data.columns.intersection(['date', 'updated_at']):
+            data[column] = pd.to_datetime(data[column])
+        for column in data.columns.intersection(['amount', 'balance', 'spend', 'income', 'credit_limit']):
+            data[column] = data[column].astype(float)
+        return data
+
+
+class FakeBot:
+    '''Вместо отправки в Telegram считает отправленные сообщения.'''
+
+    def __init__(self):
+        self.sent = 0
+        self.__lock = threading.Lock()
+
+    def record(self, *args, **kwargs):
+        with self.__lock:
+            self.sent += 1
+
+    send_message = record
+    send_photo = record
+
+    def get_file(self, file_id):
+        return FakeFile(file_id)
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.first_name = f'user{user_id}'
+
+
+class FakeFile:
+    def __init__(self, source_path):
+        self.source_path = source_path
+
+    def download(self, custom_path):
+        shutil.copyfile(self.source_path, custom_path)
+
+
+class FakeDocument:
+    def __init__(self, source_path):
+        # id файла - путь к сгенерированной выгрузке, см. FakeBot.get_file
+        self.file_id = source_path
+        self.file_name = os.path.basename(source_path)
+
+
+class FakeMessage:
+    def __init__(self, bot, user_id, text, document=None):
+        self.bot = bot
+        self.from_user = FakeUser(user_id)
+        self.chat_id = user_id
+        self.text = text
+        self.document = document
+        self.reply_to_message = None
+
+    def reply_text(self, *args, **kwargs):
+        self.bot.record()
+
+    def reply_photo(self, photo, **kwargs):
+        photo.read()
+        self.bot.record()
+
+    def edit_text(self, *args, **kwargs):
+        self.bot.record()
+
+
+class FakeUpdate:
+    def __init__(self, message):
+        self.message = message
+        self.effective_message = message
+        self.effective_user = message.from_user
+        self.callback_query = None
+
+
+def generate_transactions(start_date, days, rng, account_id=0):
+    '''Генерирует похожую на реальную историю транзакций: ежедневные покупки и зарплата два раза в месяц.
+
+    Args:
+        start_date: дата первой транзакции.
+        days: количество дней.
+        rng: генератор numpy.random.Generator.
+        account_id: id счета.
+
+    Returns:
+        Датафрейм с колонками ['date', 'account_id', 'amount', 'category', 'description']
+    '''
+    counts = rng.poisson(3, days)
+    dates = pd.to_datetime(start_date) + pd.to_timedelta(np.repeat(np.arange(days), counts), unit='D') + \
+        pd.to_timedelta(rng.integers(8 * 60, 23 * 60, counts.sum()), unit='m')
+    kind = rng.integers(0, len(DESCRIPTIONS), counts.sum())
+    spend = pd.DataFrame({
+        'date': dates,
+        'account_id': account_id,
+        'amount': -np.round(rng.lognormal(6, 1, counts.sum()), 2),
+        'category': np.array(CATEGORIES)[kind],
+        'description': np.array(DESCRIPTIONS)[kind],
+    })
+
+    paydays = pd.date_range(start_date, periods=days, freq='D')
+    paydays = paydays[paydays.day.isin([5, 20])] + pd.Timedelta(hours=10)
+    salary = pd.DataFrame({
+        'date': paydays,
+        'account_id': account_id,
+        'amount': 50000.,
+        'category': 'Пополнения',
+        'description': 'Зарплата',
+    })
+
+    return pd.concat([spend, salary]).sort_values('date').reset_index(drop=True)
+
+
+def write_tinkoff_csv(transactions, path):
+    '''Сохраняет транзакции в формате выгрузки Тинькофф, который читает DataLoader.tinkoff_file_parse.
+
+    Args:
+        transactions: датафрейм с колонками ['date', 'amount', 'category', 'description'].
+        path: путь файла.
+    '''
+    data = transactions.iloc[::-1]
+    pd.DataFrame({
+        'Дата операции': data['date'].dt.strftime('%d.%m.%Y %H:%M:%S'),
+        'Дата платежа': data['date'].dt.strftime('%d.%m.%Y'),
+        'Номер карты': '*1234',
+        'Статус': 'OK',
+        'Сумма операции': data['amount'],
+        'Валюта операции': 'RUB',
+        'Сумма платежа': data['amount'],
+        'Валюта платежа': 'RUB',
+        'Категория': data['category'],
+        'Описание': data['description'],
+    }).to_csv(path, sep=';', decimal=',', index=False, encoding='cp1251')
+
+
+class LoadTest:
+    '''Нагрузочный тест команд бота на фиктивном транспорте Telegram и базе данных в памяти.
+
+    Attributes:
+        db_engine: объект FakeDBEngine.
+        bot: объект FakeBot.
+        manager: UserManager, работающий с db_engine.
+        results: список замеров команд, словари формата {'command', 'time', 'memory', 'error'}.
+    '''
+
+    def __init__(self, user_count=1000, history_days=180, upload_days=14, random_state=0, work_dir='./temp/load_test'):
+        '''Создает пользователей с историей транзакций и дебетовым счетом в базе данных в памяти.
+
+        Args:
+            user_count: количество пользователей.
+            history_days: длина истории транзакций каждого пользователя в днях.
+            upload_days: сколько последних дней приходит в файлах /tr add.
+            random_state: seed генераторов случайных чисел.
+            work_dir: папка для сгенерированных файлов выгрузки.
+        '''
+        self.db_engine = FakeDBEngine()
+        self.bot = FakeBot()
+        self.manager = UserManager(self.bot, None, db_engine=self.db_engine)
+        self.results = []
+        self.__lock = threading.Lock()
+        self.__random_state = random_state
+        self.__work_dir = work_dir
+        os.makedirs(work_dir, exist_ok=True)
+        # BotDialogTransactions сохраняет файлы в ./temp/
+        os.makedirs('./temp', exist_ok=True)
+
+        rng = np.random.default_rng(random_state)
+        start_date = datetime.today() - relativedelta(days=history_days)
+        self.users_id = list(range(1, user_count + 1))
+        self.__uploads = {}
+
+        for user_id in self.users_id:
+            account_id = self.db_engine.add_event(
+                'accounts', {'user_id': user_id, 'type': 1, 'description': 'Основной'})
+            history = generate_transactions(
+                start_date, history_days, rng, account_id)
+            history['balance'] = history['amount'].cumsum() + 10000
+            history['user_id'] = user_id
+            self.db_engine.add_event(
+                'transactions', history.to_dict(orient='records'))
+
+            upload = generate_transactions(
+                start_date + relativedelta(days=history_days - upload_days), upload_days, rng, account_id)
+            path = os.path.join(work_dir, f'{user_id}.csv')
+            write_tinkoff_csv(upload, path)
+            self.__uploads[user_id] = path
+
+    def run(self, commands_per_user=5, mix=None, workers=1, measure_memory=True):
+        '''Выполняет для каждого пользователя /refit и случайную последовательность команд.
+
+        Команды одного пользователя выполняются последовательно, разные пользователи - параллельно.
+        Прирост памяти точен только при workers=1.
+
+        Args:
+            commands_per_user: количество случайных команд на пользователя.
+            mix: словарь {команда: доля}. Если None, DEFAULT_MIX.
+            workers: количество потоков.
+            measure_memory: замерять ли прирост памяти через tracemalloc. Замедляет выполнение команд.
+
+        Returns:
+            Отчет, см. report.
+        '''
+        mix = mix or DEFAULT_MIX
+        rng = random.Random(self.__random_state)
+        scripts = {user_id: ['/refit'] + rng.choices(list(mix), weights=list(mix.values()), k=commands_per_user)
+                   for user_id in self.users_id}
+
+        def run_script(user_id):
+            for command in scripts[user_id]:
+                self.run_command(user_id, command, measure_memory)
+
+        if measure_memory:
+            tracemalloc.start()
+        start_time = time.time()
+        Scheduler.run_for_users(
+            self.users_id, run_script, workers, rate=None)
+        time_passed = time.time() - start_time
+        if measure_memory:
+            tracemalloc.stop()
+
+        return self.report(time_passed)
+
+    def run_command(self, user_id, command, measure_memory=False):
+        '''Выполняет одну команду пользователя так же, как обработчики bot.py, и сохраняет замер.
+
+        Args:
+            user_id: id пользователя.
+            command: команда, например '/pred 3' или '/tr add'.
+            measure_memory: замерять ли прирост памяти.
+        '''
+        message = self.__build_message(user_id, command)
+        update = FakeUpdate(message)
+        args = shlex.split(message.text)[1:]
+        error = None
+
+        memory_before = tracemalloc.get_traced_memory()[
+            0] if measure_memory else 0
+        start_time = time.perf_counter()
+        try:
+            if command.startswith('/pred'):
+                months = int(args[0]) if len(args) > 0 else 1
+                report_obj = self.manager.report_forecast(user_id, months)
+                message.reply_photo(photo=report_obj['plot'], quote=True)
+                for page in report_obj['message']:
+                    message.reply_text(
+                        text=page, quote=False, parse_mode='html')
+            elif command == '/refit':
+                message.reply_text(
+                    f'OK!\n{self.manager.fit_new_model(user_id)}')
+            else:
+                self.manager.bot_dialog(user_id, update)
+        except Exception as e:
+            error = repr(e)
+        time_passed = time.perf_counter() - start_time
+        memory = tracemalloc.get_traced_memory()[
+            0] - memory_before if measure_memory else 0
+
+        with self.__lock:
+            self.results.append({'command': command, 'time': time_passed,
+                                 'memory': memory, 'error': error})
+
+    def report(self, time_passed=None):
+        '''Собирает отчет по командам.
+
+        Args:
+            time_passed: общее время теста в секундах, для расчета пропускной способности.
+
+        Returns:
+            Датафрейм, индекс - команды, колонки
+            ['count', 'error_count', 'per_s', 'p50_ms', 'p95_ms', 'p99_ms', 'memory_kb'],
+            где memory_kb - средний прирост памяти на команду.
+        '''
+        results = pd.DataFrame(self.results)
+        rows = {}
+        for command, group in results.groupby('command'):
+            latency = Webhook.latency_report(group['time'])
+            rows[command] = {
+                'count': len(group),
+                'error_count': int(group['error'].notna().sum()),
+                'per_s': len(group) / group['time'].sum(),
+                'p50_ms': latency['p50_ms'],
+                'p95_ms': latency['p95_ms'],
+                'p99_ms': latency['p99_ms'],
+                'memory_kb': group['memory'].mean() / 1024,
+            }
+
+        report = pd.DataFrame.from_dict(rows, orient='index')
+        if time_passed is not None:
+            report.loc['total', ['count', 'per_s']] = [
+                len(results), len(results) / time_passed]
+        return report
+
+    def __build_message(self, user_id, command):
+        if command == '/regular add':
+            text = f'/regular add {datetime.today():%d.%m.%Y} 0,1,0 -990 Подписка'
+        elif command == '/tr add':
+            balance = round(random.uniform(1000, 100000), 2)
+            text = f'/tr add {balance} Основной'
+            return FakeMessage(self.bot, user_id, text, FakeDocument(self.__uploads[user_id]))
+        else:
+            text = command
+
+        return FakeMessage(self.bot, user_id, text)
+
+
+if __name__ == '__main__':
+    import sys
+
+    user_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    load_test = LoadTest(user_count)
+    print(load_test.run().to_string())
+    print(f'messages sent: {load_test.bot.sent}')
@@ -1,12 +1,15 @@
-from sklearn.linear_model import LinearRegression
+import hashlib
 import pandas as pd
+import numpy as np
 
 
 class SbsModel:
     '''Класс модели, выполняющий прогноз построчно, позволяя использовать результаты предыдущего прогноза, для расчета признаков следующего.
 
     Attributes:
-        models: словарь моделией под каждую фичу.
+        models: словарь моделией под каждую фичу. Модели реализуют протокол fit(x, y) / predict(x), см. BACKENDS.
+        backend: название бэкенда моделей из BACKENDS.
+        backend_params: параметры, передаваемые в конструктор бэкенда.
         target_column: имя колонки целевого признака.
         column_adding_method: медод генерации новых фич.
         list_mf_rules: список правил для генерации фичей, под каждую модель, формата:
@@ -26,12 +29,41 @@ class SbsModel:
 
             lag: список сдвигов.
             rm: список размеров скользящего среднего.
+        residuals: словарь остатков обучающей выборки под каждую фичу. Нужен для симуляции прогноза.
+            None, если модель дообучалась через partial_fit и остатки нужно пересчитать.
+        statistics: достаточные статистики обучающей выборки для дообучения через partial_fit, формата:
+            {
+                'frozen_until': последний день, статистики до которого больше не пересчитываются.
+                'start': первый день ряда, на котором обучена модель.
+                'threshold': порог выбросов, с которым построен ряд, см. outlier_threshold.
+                'days': количество и хэш исходных транзакций по дням до frozen_until включительно, см. day_digests.
+                'regular_hash': хэш регулярных событий, см. regular_hash.
+                'frozen_hash': если модель обучалась без исходных транзакций, вместо 'days' и 'regular_hash'
+                    хранится хэш временного ряда до frozen_until.
+                'columns': {'column_name_1': статистики, см. sufficient_statistics, ...}
+            }
     '''
 
-    def __init__(self, target_column, column_adding_method, list_mf_rules):
+    # Сколько последних дней ряда не замораживается в статистиках: данные за них еще могут измениться,
+    # например последний день выписки обычно неполный
+    tail_days = 7
+
+    def __init__(self, target_column, column_adding_method, list_mf_rules, backend='numpy', backend_params=None):
         self.target_column = target_column
         self.column_adding_method = column_adding_method
         self.list_mf_rules = list_mf_rules
+        self.backend = backend
+        self.backend_params = backend_params or {}
+
+    def get_parameters(self):
+        '''Возвращает параметры конструктора, чтобы создать новую необученную модель с теми же настройками.'''
+        return {
+            'target_column': self.target_column,
+            'column_adding_method': self.column_adding_method,
+            'list_mf_rules': self.list_mf_rules,
+            'backend': getattr(self, 'backend', 'numpy'),
+            'backend_params': getattr(self, 'backend_params', {}),
+        }
 
     def predict(self, old_data, end_date, only_negative=True):
         '''Выполнят прогноз построчно, позволяя использовать результаты предыдущего прогноза, для расчета признаков следующего. 
@@ -58,22 +90,28 @@ class SbsModel:
         Returns:
             Спрогнозированные значения, для всех фич.
         '''
-        working_columns = self.models.keys()
-        data = old_data[working_columns].copy()
-        days_index = pd.date_range(data.index[-1], end_date)[1:]
-        data = pd.concat(
-            [data, pd.DataFrame([], columns=working_columns, index=days_index)])
+        working_columns = list(self.models.keys())
+        models = {column: as_backend(model)
+                  for column, model in self.models.items()}
+        position = {column: i for i, column in enumerate(working_columns)}
+        history = old_data[working_columns]
+        days_index = pd.date_range(history.index[-1], end_date)[1:]
 
-        for day in days_index:
+        # Признаки нового дня считаются по массиву значений, без пересчета make_features по всей истории
+        values = np.full((len(history) + len(days_index),
+                         len(working_columns)), np.nan)
+        values[:len(history)] = history.values.astype(float)
+        for t, day in enumerate(days_index, len(history)):
             for column in working_columns:
-                row = self.make_features(data.loc[:day], self.list_mf_rules[column]
-                                         ).loc[[day]].drop(working_columns, axis=1)
+                row = self.feature_row(
+                    values, t, day, self.list_mf_rules[column], position)
+                values[t, position[column]] = models[column].predict(
+                    row[np.newaxis])[0]
 
-                data.loc[day, column] = self.models[column].predict(row)[0]
-
-        result = data.loc[days_index, working_columns]
+        result = pd.DataFrame(
+            values[len(history):], index=days_index, columns=working_columns)
         if only_negative:
-            result[self.target_column][result[self.target_column] > 0] = 0
+            result.loc[result[self.target_column] > 0, self.target_column] = 0
         return result
 
     def make_features(self, data, mf_rules):
@@ -114,19 +152,839 @@ class SbsModel:
 
         return data
 
-    def fit(self, data):
+    def feature_row(self, values, t, day, mf_rules, position):
+        '''Рассчитывает признаки одного дня так же, как make_features, но по массиву значений.
+
+        Args:
+            values: массив значений временного ряда, строки - дни, колонки - фичи.
+            t: номер строки дня в values.
+            day: дата дня.
+            mf_rules: список правил для генерации фичей, см. make_features.
+            position: словарь {имя колонки: номер колонки в values}.
+
+        Returns:
+            Массив признаков в порядке колонок make_features.
+        '''
+        features = [day.year, day.month, day.day, day.dayofweek]
+        for rule in mf_rules:
+            column_values = values[:, position[rule['column']]]
+            for l in rule['lag']:
+                features.append(column_values[t - l] if t >= l else np.nan)
+
+            for r in rule['rm']:
+                features.append(column_values[t - r:t].mean() if t >= r else np.nan)
+
+        return np.array(features, dtype=float)
+
+    def fit(self, data, source=None, threshold=None):
         '''Генерирует признаки, создает и обучает новую модель под каждую фичу.
 
         Args:
             data: датафрейм временного ряда.
+            source: кортеж (транзакции, регулярные события), из которых построен ряд, см. partial_fit.
+            threshold: порог выбросов, с которым построен ряд. partial_fit строит новые дни ряда с тем же порогом.
         '''
         models = {}
+        residuals = {}
         for column in self.list_mf_rules.keys():
             train = self.make_features(
                 data, self.list_mf_rules[column]).dropna()
-            models[column] = LinearRegression(
-                n_jobs=-1).fit(train.drop(self.list_mf_rules.keys(), axis=1), train[column])
+            x = train.drop(self.list_mf_rules.keys(), axis=1)
+            models[column] = make_backend(
+                getattr(self, 'backend', 'numpy'), **getattr(self, 'backend_params', {})).fit(x, train[column])
+            residuals[column] = (
+                train[column] - models[column].predict(x)).values
 
         self.models = models
+        self.residuals = residuals
+        self.statistics = {'columns': {}, 'start': data.index[0], 'threshold': threshold}
+        self.__freeze(data, source)
 
         return self
+
+    def partial_start(self):
+        '''Возвращает день, с которого partial_fit нужны ряд и транзакции: дни после frozen_until
+        с запасом на самый длинный сдвиг или скользящее среднее. Более старая история не нужна.
+
+        Returns:
+            Дата или None, если модель нельзя дообучить по части истории и нужно полное обучение.
+        '''
+        statistics = getattr(self, 'statistics', None)
+        if statistics is None or 'days' not in statistics or not self.__is_linear():
+            return None
+        lookback = max(feature_lookback(mf_rules)
+                       for mf_rules in self.list_mf_rules.values())
+        return statistics['frozen_until'] + pd.Timedelta(days=1 - lookback)
+
+    def partial_fit(self, data, source=None, refit=True):
+        '''Дообучает модель на новых днях временного ряда без полного переобучения.
+        Для каждой фичи к сохраненным статистикам XᵀX и Xᵀy добавляются только дни после frozen_until,
+        после чего заново решаются нормальные уравнения.
+
+        Если передан source, ряд и транзакции могут начинаться с любого дня не позже partial_start.
+        Замороженные дни начиная с первого дня ряда сверяются по количеству и хэшу транзакций каждого дня,
+        сохраненным при заморозке, см. day_digests. Новые дни ряда должны быть построены с порогом выбросов
+        statistics['threshold'], тогда результат совпадает с fit на ряде всей истории с тем же порогом.
+        Без source ряд передается целиком и сверяется сам, и результат совпадает с fit на том же ряде.
+
+        Если замороженная часть изменилась (например, загружены транзакции за старые даты или изменены регулярные события),
+        у модели нет статистик или бэкенд не линейный, выполняется полное обучение fit.
+
+        Args:
+            data: датафрейм временного ряда.
+            source: кортеж (транзакции, регулярные события), из которых построен ряд, с тех же дней, что и ряд.
+            refit: выполнять ли полное обучение, если дообучить модель нельзя. False, если ряд построен не по всей истории.
+
+        Returns:
+            True, если модель дообучена. False, если выполнено полное обучение или, при refit=False, модель не изменилась.
+        '''
+        statistics = getattr(self, 'statistics', None)
+        totals = None
+        hashes = None
+        if statistics is not None and len(data) > 0 and data.index[-1] >= statistics['frozen_until'] and \
+                self.__is_linear():
+            hashes = self.__frozen_hashes(data, source)
+        if hashes is not None:
+            start_date = statistics['frozen_until'] + pd.Timedelta(days=1)
+            tails = {column: self.__tail_train(data, column, start_date)
+                     for column in self.list_mf_rules.keys()}
+            totals = {column: merge_statistics(statistics['columns'][column], sufficient_statistics(x.values, y.values))
+                      for column, (x, y) in tails.items()}
+            if any(total['n'] == 0 for total in totals.values()):
+                totals = None
+
+        if totals is None:
+            if refit:
+                self.fit(data, source, (statistics or {}).get('threshold'))
+            return False
+
+        for column, total in totals.items():
+            self.models[column].fit_statistics(total)
+
+        self.residuals = None
+        self.__freeze(data, source, tails, hashes)
+
+        return True
+
+    def history_counts(self, data, transactions):
+        '''Возвращает размер истории дообученной модели, как если бы она была обучена через fit на всей истории.
+
+        Args:
+            data: ряд, переданный в partial_fit.
+            transactions: транзакции, переданные в partial_fit.
+
+        Returns:
+            Кортеж (количество транзакций, количество дней ряда).
+        '''
+        statistics = self.statistics
+        newer = pd.to_datetime(transactions['date']) >= statistics['frozen_until'] + pd.Timedelta(days=1)
+        return int(statistics['days']['count'].sum() + newer.sum()), (data.index[-1] - statistics['start']).days + 1
+
+    def __is_linear(self):
+        return all(hasattr(model, 'fit_statistics') for model in self.models.values())
+
+    def __tail_train(self, data, column, start_date):
+        '''Возвращает обучающую выборку (x, y) для дней начиная со start_date.
+        Признаки считаются только по хвосту ряда с запасом на самый длинный сдвиг или скользящее среднее.'''
+        lookback = feature_lookback(self.list_mf_rules[column])
+        train = self.make_features(
+            data[start_date - pd.Timedelta(days=lookback):], self.list_mf_rules[column])
+        train = train[start_date:].dropna()
+        x = train.drop(self.list_mf_rules.keys(), axis=1)
+        return x, train[column]
+
+    def __frozen_hashes(self, data, source):
+        '''Проверяет, что замороженные дни ряда или исходных транзакций не изменились с момента заморозки.
+
+        Returns:
+            None, если изменились. Иначе хэши, посчитанные при проверке, для __freeze:
+            {'days': хэши всех дней транзакций начиная с первого дня ряда, 'regular_hash': хэш регулярных событий}
+            или пустой словарь, если source не передан.
+        '''
+        statistics = self.statistics
+        frozen_until = statistics['frozen_until']
+        if source is None:
+            return {} if statistics.get('frozen_hash') == series_hash(data[:frozen_until]) else None
+
+        transactions, regular_list = source
+        lookback = max(feature_lookback(mf_rules)
+                       for mf_rules in self.list_mf_rules.values())
+        if 'days' not in statistics or data.index[0] > frozen_until + pd.Timedelta(days=1 - lookback):
+            return None
+        hashes = {'regular_hash': regular_hash(regular_list)}
+        if statistics['regular_hash'] != hashes['regular_hash']:
+            return None
+
+        hashes['days'] = day_digests(transactions, data.index[0])
+        current = hashes['days'][:frozen_until]
+        frozen = statistics['days'][data.index[0]:]
+        if not (current.index.equals(frozen.index) and np.array_equal(current.values, frozen.values)):
+            return None
+        return hashes
+
+    def __freeze(self, data, source=None, tails=None, hashes=None):
+        '''Переносит в замороженные статистики дни ряда старше tail_days последних дней.
+
+        Args:
+            data: датафрейм временного ряда.
+            source: кортеж (транзакции, регулярные события), из которых построен ряд.
+            tails: уже посчитанные в partial_fit обучающие выборки дней после frozen_until, {column: (x, y)}.
+            hashes: уже посчитанные в partial_fit хэши, см. __frozen_hashes.
+        '''
+        previous = self.statistics.get('frozen_until')
+        frozen_until = data.index[-1] - pd.Timedelta(days=self.tail_days)
+        start_date = data.index[0]
+        if previous is not None:
+            frozen_until = max(frozen_until, previous)
+            start_date = previous + pd.Timedelta(days=1)
+
+        for column in self.list_mf_rules.keys():
+            x, y = self.__tail_train(
+                data, column, start_date) if tails is None else tails[column]
+            self.statistics['columns'][column] = merge_statistics(
+                self.statistics['columns'].get(column),
+                sufficient_statistics(x[:frozen_until].values, y[:frozen_until].values))
+
+        self.statistics['frozen_until'] = frozen_until
+        if source is None:
+            self.statistics['frozen_hash'] = series_hash(data[:frozen_until])
+            self.statistics.pop('days', None)
+            return
+
+        transactions, regular_list = source
+        if hashes is None:
+            hashes = {'days': day_digests(transactions),
+                      'regular_hash': regular_hash(regular_list)}
+        days = hashes['days'][:frozen_until]
+        if previous is not None:
+            days = pd.concat(
+                [self.statistics['days'][:data.index[0] - pd.Timedelta(days=1)], days])
+        self.statistics['days'] = days
+        self.statistics['regular_hash'] = hashes['regular_hash']
+        self.statistics.pop('frozen_hash', None)
+
+    def get_residuals(self, data):
+        '''Рассчитывает остатки обученных моделей на временном ряде.
+
+        Args:
+            data: датафрейм временного ряда.
+
+        Returns:
+            Словарь массивов остатков под каждую фичу.
+        '''
+        residuals = {}
+        for column in self.models.keys():
+            train = self.make_features(
+                data, self.list_mf_rules[column]).dropna()
+            x = train.drop(self.models.keys(), axis=1)
+            residuals[column] = (
+                train[column] - self.models[column].predict(x)).values
+
+        return residuals
+
+
+def feature_lookback(mf_rules):
+    '''Возвращает, сколько предыдущих дней нужно, чтобы посчитать признаки по правилам mf_rules, см. SbsModel.make_features.'''
+    return max([0] + [l for rule in mf_rules for l in rule['lag']] +
+               [r for rule in mf_rules for r in rule['rm']])
+
+
+def enough_history(data, list_mf_rules):
+    '''Проверяет, что в ряде больше дней, чем самый длинный сдвиг или скользящее среднее признаков,
+    то есть после генерации признаков останется хотя бы один день для обучения.'''
+    return len(data) > max([0] + [feature_lookback(mf_rules) for mf_rules in list_mf_rules.values()])
+
+
+def series_hash(data):
+    '''Возвращает хэш значений и индекса временного ряда.'''
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(list(data.columns)).encode())
+    digest.update(np.ascontiguousarray(data.index.asi8).tobytes())
+    digest.update(np.ascontiguousarray(data.values, dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+def day_digests(transactions, start=None, until=None):
+    '''Считает по каждому дню количество транзакций и хэш их содержимого. Хэш дня - сумма хэшей строк,
+    поэтому не зависит от порядка транзакций и их id.
+
+    Args:
+        transactions: датафрейм транзакций с колонками ['date', 'amount', 'category', 'description'].
+        start: первый день. Если None, с начала истории.
+        until: последний день включительно. Если None, до конца истории.
+
+    Returns:
+        Датафрейм с индексом дней и колонками ['count', 'digest'].
+    '''
+    dates = pd.to_datetime(transactions['date'])
+    mask = np.ones(len(transactions), dtype=bool)
+    if start is not None:
+        mask &= (dates >= pd.to_datetime(start)).values
+    if until is not None:
+        mask &= (dates < pd.to_datetime(until) + pd.Timedelta(days=1)).values
+
+    data = pd.DataFrame({
+        'date': dates[mask].values,
+        'amount': transactions.loc[mask, 'amount'].astype(float).round(2).values,
+        'category': transactions.loc[mask, 'category'].fillna('').astype(str).values,
+        'description': transactions.loc[mask, 'description'].fillna('').astype(str).values,
+    })
+    # Старшие 52 бита хэша строки, чтобы сумма за день не переполнялась
+    hashes = (pd.util.hash_pandas_object(data, index=False).values >> np.uint64(12)).astype(np.int64)
+    days, inverse = np.unique(data['date'].values.astype('datetime64[D]'), return_inverse=True)
+    digests = np.zeros(len(days), dtype=np.int64)
+    np.add.at(digests, inverse, hashes)
+    return pd.DataFrame({'count': np.bincount(inverse, minlength=len(days)).astype(np.int64), 'digest': digests},
+                        index=pd.DatetimeIndex(days))
+
+
+def regular_hash(regular_list):
+    '''Возвращает хэш полей регулярных событий, от которых зависит разметка транзакций в preprocessing_for_ml.
+    Порядок событий и их id не учитываются.'''
+    events = regular_list.reindex(columns=['search_f', 'arg_sf', 'amount'])
+    events = sorted(zip(events['search_f'].astype(str), events['arg_sf'].astype(str),
+                        events['amount'].astype(float)))
+    return hashlib.blake2b(repr(events).encode(), digest_size=16).hexdigest()
+
+
+def sufficient_statistics(x, y):
+    '''Считает достаточные статистики линейной регрессии.
+
+    Args:
+        x: матрица признаков.
+        y: массив целевого признака.
+
+    Returns:
+        Словарь {'n', 'sx', 'sy', 'sxx', 'sxy'}: количество строк, суммы x и y, XᵀX и Xᵀy.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    return {
+        'n': len(y),
+        'sx': x.sum(axis=0),
+        'sy': y.sum(),
+        'sxx': x.T @ x,
+        'sxy': x.T @ y,
+    }
+
+
+def merge_statistics(left, right):
+    '''Складывает достаточные статистики двух непересекающихся выборок. left может быть None.'''
+    if left is None or left['n'] == 0:
+        return right
+    if right['n'] == 0:
+        return left
+    return {key: left[key] + right[key] for key in left}
+
+
+def solve_statistics(statistics, alpha=0.):
+    '''Решает нормальные уравнения по достаточным статистикам так же, как LinearRegression и Ridge:
+    признаки центрируются, свободный член не штрафуется, для вырожденной матрицы выбирается решение с наименьшей нормой.
+
+    Args:
+        statistics: статистики, см. sufficient_statistics.
+        alpha: коэффициент L2 регуляризации. 0 - обычный метод наименьших квадратов.
+
+    Returns:
+        Кортеж (coef, intercept).
+    '''
+    n = statistics['n']
+    x_mean = statistics['sx'] / n
+    y_mean = statistics['sy'] / n
+    sxx = statistics['sxx'] - n * np.outer(x_mean, x_mean) + \
+        alpha * np.eye(len(x_mean))
+    sxy = statistics['sxy'] - n * x_mean * y_mean
+
+    coef = np.linalg.lstsq(sxx, sxy, rcond=None)[0]
+    return coef, y_mean - x_mean @ coef
+
+
+class LinearBackend:
+    '''Линейная регрессия (OLS или ridge) на NumPy. Обучается через нормальные уравнения,
+    поэтому поддерживает дообучение по достаточным статистикам, см. SbsModel.partial_fit.
+
+    Attributes:
+        alpha: коэффициент L2 регуляризации.
+        coef_: коэффициенты признаков.
+        intercept_: свободный член.
+    '''
+
+    def __init__(self, alpha=0.):
+        self.alpha = alpha
+
+    def fit(self, x, y):
+        return self.fit_statistics(sufficient_statistics(x, y))
+
+    def fit_statistics(self, statistics):
+        self.coef_, self.intercept_ = solve_statistics(statistics, self.alpha)
+        return self
+
+    def predict(self, x):
+        return np.asarray(x, dtype=float) @ self.coef_ + self.intercept_
+
+
+class SklearnBackend:
+    '''Обертка над моделью sklearn. Передает в модель массивы, а не датафреймы,
+    чтобы в прогнозе можно было подавать строки признаков без названий колонок.'''
+
+    def __init__(self, estimator):
+        self.estimator = estimator
+
+    def fit(self, x, y):
+        self.estimator.fit(np.asarray(x, dtype=float),
+                           np.asarray(y, dtype=float))
+        return self
+
+    def predict(self, x):
+        return self.estimator.predict(np.asarray(x, dtype=float))
+
+
+def sklearn_linear(**params):
+    # sklearn импортируется только при использовании бэкенда
+    from sklearn.linear_model import LinearRegression
+    return SklearnBackend(LinearRegression(**params))
+
+
+def sklearn_gbm(**params):
+    from sklearn.ensemble import HistGradientBoostingRegressor
+    return SklearnBackend(HistGradientBoostingRegressor(**params))
+
+
+def ridge(alpha=1.):
+    return LinearBackend(alpha)
+
+
+# Бэкенды моделей SbsModel: название -> функция, создающая необученную модель
+BACKENDS = {
+    'numpy': LinearBackend,
+    'ridge': ridge,
+    'sklearn': sklearn_linear,
+    'gbm': sklearn_gbm,
+}
+
+
+def make_backend(backend='numpy', **params):
+    '''Создает необученную модель бэкенда.
+
+    Args:
+        backend: название бэкенда из BACKENDS.
+        params: параметры конструктора бэкенда.
+    '''
+    if backend not in BACKENDS:
+        raise Exception(f'The model backend /"{backend}/" does not exist')
+    return BACKENDS[backend](**params)
+
+
+def as_backend(model):
+    '''Приводит модель к протоколу бэкендов. Модели sklearn из сохраненных ранее SbsModel
+    обучены на датафреймах, линейные из них заменяются на LinearBackend с теми же коэффициентами.'''
+    if isinstance(model, (LinearBackend, SklearnBackend)):
+        return model
+    if hasattr(model, 'coef_') and hasattr(model, 'intercept_'):
+        result = LinearBackend()
+        result.coef_ = np.ravel(model.coef_)
+        result.intercept_ = float(np.ravel(model.intercept_)[0])
+        return result
+    return SklearnBackend(model)
+
+
+def drop_paired_markers(amounts):
+    '''Взаимно исключает парные транзакции: покупку и возврат на ту же сумму.
+
+    Для каждой абсолютной суммы исключается по min(списаний, пополнений) транзакций каждого знака,
+    начиная с самых ранних. Нулевые суммы исключаются всегда.
+
+    Args:
+        amounts: массив сумм транзакций, упорядоченный по дате.
+
+    Returns:
+        Булев массив, True для транзакций оставшихся после исключения пар.
+    '''
+    amounts = np.asarray(amounts, dtype=float)
+    n = len(amounts)
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+
+    sign = np.sign(amounts).astype(np.int64)
+    abs_values, group = np.unique(np.abs(amounts), return_inverse=True)
+    n_neg = np.bincount(group, weights=sign < 0, minlength=len(abs_values))
+    n_pos = np.bincount(group, weights=sign > 0, minlength=len(abs_values))
+
+    # Порядковый номер транзакции внутри группы (абсолютная сумма, знак)
+    position = np.arange(n)
+    order = np.lexsort((position, sign, group))
+    key = group[order] * 3 + sign[order]
+    is_start = np.r_[True, key[1:] != key[:-1]]
+    start_position = np.maximum.accumulate(np.where(is_start, position, 0))
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = position - start_position
+
+    return ((sign > 0) & (rank >= n_neg[group])) | ((sign < 0) & (rank >= n_pos[group]))
+
+
+def regular_markers(data, regular_list):
+    '''Отмечает транзакции, которые относятся хотя бы к одному регулярному событию.
+    События группируются по функции поиска, каждая группа проверяется за один проход по данным.
+
+    Args:
+        data: датафрейм транзакций с колонками ['amount', 'category', 'description'].
+        regular_list: список регулярных событий.
+
+    Returns:
+        Булев массив, True для транзакций регулярных событий.
+    '''
+    markers = np.zeros(len(data), dtype=bool)
+    if len(data) == 0 or len(regular_list) == 0:
+        return markers
+
+    amounts = data['amount'].values.astype(float)
+    for search_f, events in regular_list.groupby('search_f'):
+        if search_f == 'description':
+            keys = set()
+            for arg_sf in events['arg_sf']:
+                keys.update(arg_sf.split(','))
+            markers |= data['description'].isin(keys).values
+
+        elif search_f in ('amount_description', 'amount_category'):
+            column = search_f.split('_')[1]
+            pairs = pd.MultiIndex.from_arrays(
+                [events['arg_sf'].values, events['amount'].values.astype(float)])
+            markers |= pd.MultiIndex.from_arrays(
+                [data[column].values, amounts]).isin(pairs)
+
+        elif search_f in ('amount<_description', 'amount<_category'):
+            column = search_f.split('_')[1]
+            arg_sf = [a.split(',') for a in events['arg_sf']]
+            thresholds = pd.Series([int(a[0]) for a in arg_sf], index=[
+                                   a[1] for a in arg_sf]).groupby(level=0).max()
+            markers |= amounts < data[column].map(
+                thresholds).values.astype(float)
+
+        elif search_f == 'dont_search':
+            continue
+
+        else:
+            raise Exception(
+                f'The search function /"{search_f}/" does not exist')
+
+    return markers
+
+
+def resample_daily_sum(dates, values):
+    '''Суммирует значения по дням. Аналог resample('1D').sum(), выполненный через np.bincount.
+
+    Args:
+        dates: серия дат.
+        values: словарь {имя колонки: массив значений}.
+
+    Returns:
+        Датафрейм с ежедневным индексом 'date', от первой до последней даты.
+    '''
+    if len(dates) == 0:
+        return pd.DataFrame(values, index=pd.DatetimeIndex([], name='date', freq='D'))
+
+    days = dates.values.astype('datetime64[D]')
+    first_day = days.min()
+    offsets = (days - first_day).astype(np.int64)
+    size = offsets.max() + 1
+
+    return pd.DataFrame(
+        {column: np.bincount(offsets, weights=np.asarray(v, dtype=float), minlength=size)
+         for column, v in values.items()},
+        index=pd.date_range(first_day, periods=size, freq='D', name='date'))
+
+
+def _spend_markers(data, regular_list):
+    '''Отмечает расходы без парных транзакций и транзакций регулярных событий.'''
+    amounts = data['amount'].values.astype(float)
+    markers = drop_paired_markers(amounts) & (amounts < 0)
+    markers &= ~regular_markers(data, regular_list)
+    return markers
+
+
+def outlier_threshold(data, regular_list, q=0.16):
+    '''Возвращает порог выбросов ml_markers: квантиль q расходов без парных транзакций и регулярных событий.
+
+    Returns:
+        Порог или None, если таких расходов нет.
+    '''
+    amounts = data['amount'].values.astype(float)
+    markers = _spend_markers(data, regular_list)
+    if not markers.any():
+        return None
+    return float(np.quantile(amounts[markers], q))
+
+
+def ml_markers(data, regular_list, q=0.16, threshold=None):
+    '''Отмечает транзакции, по которым обучается модель: расходы без парных транзакций,
+    транзакций регулярных событий и выбросов ниже квантиля q.
+
+    Args:
+        data: датафрейм транзакций с колонками ['date', 'amount', 'category', 'description'].
+        regular_list: список регулярных событий.
+        q: квантиль, ниже которого расходы считаются выбросами.
+        threshold: готовый порог выбросов, см. outlier_threshold. Если None, считается по data.
+
+    Returns:
+        Булев массив.
+    '''
+    amounts = data['amount'].values.astype(float)
+
+    markers = _spend_markers(data, regular_list)
+    if threshold is None and markers.any():
+        threshold = np.quantile(amounts[markers], q)
+    if threshold is not None:
+        markers &= amounts > threshold
+
+    return markers
+
+
+def preprocessing_for_ml(data, regular_list, q=0.16, features=None, threshold=None):
+    '''Подготавливает историю транзакций для модели за один проход:
+    исключает парные транзакции и доходы, транзакции регулярных событий, выбросы ниже квантиля q,
+    после чего суммирует расходы по дням.
+
+    Args:
+        data: датафрейм транзакций с колонками ['date', 'amount', 'category', 'description'].
+        regular_list: список регулярных событий.
+        q: квантиль, ниже которого расходы считаются выбросами.
+        features: функция генерации дополнительных фич. Получает отфильтрованные транзакции с индексом 'date',
+            возвращает датафрейм числовых колонок. Если None, используется только 'amount'.
+        threshold: готовый порог выбросов, см. ml_markers.
+
+    Returns:
+        Датафрейм ежедневного временного ряда.
+    '''
+    amounts = data['amount'].values.astype(float)
+    markers = ml_markers(data, regular_list, q, threshold)
+
+    cleared_df = data[markers]
+    if features is None:
+        columns = {'amount': amounts[markers]}
+    else:
+        columns = features(cleared_df.set_index('date'))
+        columns = {c: columns[c].values for c in columns.columns}
+
+    return resample_daily_sum(cleared_df['date'], columns)
+
+
+def category_matrix(data, regular_list, top_k=8, q=0.16, other='Другое'):
+    '''Строит ежедневный ряд расходов по категориям из тех же транзакций, что и preprocessing_for_ml.
+    Сумма колонок в каждый день равна ряду 'amount' из preprocessing_for_ml.
+
+    Args:
+        data: датафрейм транзакций с колонками ['date', 'amount', 'category', 'description'].
+        regular_list: список регулярных событий.
+        top_k: количество категорий с наибольшими расходами. Остальные категории объединяются в other.
+        q: квантиль, ниже которого расходы считаются выбросами.
+        other: название колонки для остальных категорий.
+
+    Returns:
+        Датафрейм с ежедневным индексом 'date', колонки - категории.
+    '''
+    cleared_df = data[ml_markers(data, regular_list, q)]
+    if len(cleared_df) == 0:
+        return pd.DataFrame([], index=pd.DatetimeIndex([], name='date', freq='D'))
+
+    amounts = cleared_df['amount'].values.astype(float)
+    categories = cleared_df['category'].fillna(other).values
+
+    # Расходы отрицательные, поэтому категории с наибольшими расходами идут первыми при сортировке по возрастанию
+    top = pd.Series(amounts).groupby(categories).sum().sort_values().index[:top_k]
+    codes, columns = pd.factorize(np.where(np.isin(categories, top), categories, other))
+
+    days = cleared_df['date'].values.astype('datetime64[D]')
+    first_day = days.min()
+    offsets = (days - first_day).astype(np.int64)
+    size = offsets.max() + 1
+    width = len(columns)
+
+    matrix = np.bincount(offsets * width + codes, weights=amounts,
+                         minlength=size * width).reshape(size, width)
+    return pd.DataFrame(matrix, columns=columns,
+                        index=pd.date_range(first_day, periods=size, freq='D', name='date'))
+
+
+class CategoryModel:
+    '''Модель прогноза расходов по категориям. Для каждой категории строится линейная регрессия
+    на календарные признаки, сдвиги и скользящие средние ее собственного ряда, как в SbsModel.
+    Все категории обучаются одним пакетным решением нормальных уравнений и прогнозируются одновременно.
+
+    Attributes:
+        lag: список сдвигов.
+        rm: список размеров скользящего среднего.
+        alpha: коэффициент L2 регуляризации. Нужен, потому что календарные признаки могут быть постоянными.
+        columns: категории, на которых обучена модель.
+        coef: массив коэффициентов (категории x признаки).
+        x_mean: средние признаков по каждой категории.
+        y_mean: средние расходы по каждой категории.
+    '''
+
+    def __init__(self, lag=(2, 4), rm=(1, 2, 3, 4), alpha=1.):
+        self.lag = list(lag)
+        self.rm = list(rm)
+        self.alpha = alpha
+        self.lookback = max([0] + self.lag + self.rm)
+
+    def features(self, values, days):
+        '''Рассчитывает признаки всех категорий для каждого дня.
+
+        Args:
+            values: массив расходов (дни x категории).
+            days: DatetimeIndex дней.
+
+        Returns:
+            Массив (дни x категории x признаки). Для первых дней, где не хватает истории, признаки - NaN.
+        '''
+        n, k = values.shape
+        calendar = np.column_stack(
+            [days.year, days.month, days.day, days.dayofweek]).astype(float)
+        blocks = [np.broadcast_to(calendar[:, np.newaxis, :], (n, k, 4))]
+
+        for l in self.lag:
+            shifted = np.full((n, k), np.nan)
+            shifted[l:] = values[:n - l]
+            blocks.append(shifted[..., np.newaxis])
+
+        # cumsum[t] - сумма значений до дня t, не включая его
+        cumsum = np.vstack([np.zeros((1, k)), np.cumsum(values, axis=0)])
+        for r in self.rm:
+            mean = np.full((n, k), np.nan)
+            mean[r:] = (cumsum[r:n] - cumsum[:n - r]) / r
+            blocks.append(mean[..., np.newaxis])
+
+        return np.concatenate(blocks, axis=2)
+
+    def fit(self, history):
+        '''Обучает модели всех категорий.
+
+        Args:
+            history: датафрейм расходов по категориям, см. category_matrix.
+        '''
+        values = history.values.astype(float)
+        self.columns = list(history.columns)
+
+        x = self.features(values, history.index)[self.lookback:].transpose(1, 0, 2)
+        y = values[self.lookback:].T
+        if y.shape[1] == 0:
+            # История короче самого длинного сдвига, прогноз - средние расходы
+            self.coef = np.zeros((len(self.columns), x.shape[2]))
+            self.x_mean = np.zeros_like(self.coef)
+            self.y_mean = values.mean(axis=0) if len(values) > 0 else np.zeros(len(self.columns))
+            return self
+
+        self.x_mean = x.mean(axis=1)
+        self.y_mean = y.mean(axis=1)
+        x = x - self.x_mean[:, np.newaxis, :]
+        y = y - self.y_mean[:, np.newaxis]
+
+        xtx = np.einsum('knp,knq->kpq', x, x) + self.alpha * np.eye(x.shape[2])
+        xty = np.einsum('knp,kn->kp', x, y)
+        self.coef = np.linalg.solve(xtx, xty[..., np.newaxis])[..., 0]
+
+        return self
+
+    def predict(self, history, end_date):
+        '''Прогнозирует расходы всех категорий построчно, используя прогноз предыдущих дней для признаков следующего.
+
+        Args:
+            history: датафрейм расходов по категориям, на котором считаются признаки первых дней прогноза.
+            end_date: дата, до которой рассчитать прогноз. Прогноз начнется со следующего дня после history.
+
+        Returns:
+            Датафрейм прогноза с ежедневным индексом, колонки - категории. Положительные значения обнуляются.
+        '''
+        days_index = pd.date_range(history.index[-1], end_date)[1:]
+        days = history.index.append(days_index)
+        values = np.vstack([history[self.columns].values.astype(float),
+                            np.zeros((len(days_index), len(self.columns)))])
+
+        for t in range(len(history), len(days)):
+            start = max(0, t - self.lookback)
+            x = self.features(values[start:t + 1], days[start:t + 1])[-1]
+            if np.isnan(x).any():
+                prediction = self.y_mean
+            else:
+                prediction = np.einsum(
+                    'kp,kp->k', x - self.x_mean, self.coef) + self.y_mean
+            values[t] = np.minimum(prediction, 0)
+
+        return pd.DataFrame(values[len(history):], index=days_index, columns=self.columns)
+
+
+def reconcile_categories(categories, total, shares):
+    '''Согласует прогноз по категориям с прогнозом общих расходов: в каждый день общий прогноз
+    распределяется между категориями пропорционально их прогнозу.
+
+    Args:
+        categories: датафрейм прогноза по категориям.
+        total: серия прогноза общих расходов с тем же индексом.
+        shares: доли категорий в исторических расходах. Используются в дни, когда прогноз всех категорий нулевой.
+
+    Returns:
+        Датафрейм прогноза по категориям, сумма колонок которого равна total.
+    '''
+    values = categories.values.astype(float)
+    sums = values.sum(axis=1, keepdims=True)
+    proportions = np.tile(shares[categories.columns].values.astype(float), (len(values), 1))
+    np.divide(values, sums, out=proportions, where=sums != 0)
+
+    total = total.reindex(categories.index).fillna(0).values.astype(float)
+    return pd.DataFrame(proportions * total[:, np.newaxis],
+                        index=categories.index, columns=categories.columns)
+
+
+def daily_aggregates(transactions):
+    '''Считает ежедневные расходы, доходы и баланс на конец дня по каждому счету.
+
+    Args:
+        transactions: датафрейм транзакций с колонками ['date', 'account_id', 'amount', 'balance'], упорядоченный по дате.
+
+    Returns:
+        Датафрейм с колонками ['account_id', 'date', 'spend', 'income', 'balance'].
+    '''
+    amounts = transactions['amount'].astype(float)
+
+    return pd.DataFrame({
+        'account_id': transactions['account_id'].values,
+        'date': pd.to_datetime(transactions['date']).dt.floor('D').values,
+        'spend': amounts.where(amounts < 0, 0).values,
+        'income': amounts.where(amounts > 0, 0).values,
+        'balance': transactions['balance'].astype(float).values,
+    }).groupby(['account_id', 'date'], sort=True).agg({
+        'spend': 'sum',
+        'income': 'sum',
+        'balance': 'last'
+    }).reset_index()
+
+
+def daily_balance(aggregates, start_date=None, end_date=None):
+    '''Собирает из ежедневных агрегатов временной ряд по всем счетам.
+    Баланс счета в дни без транзакций равен балансу на конец предыдущего дня.
+
+    Args:
+        aggregates: датафрейм ежедневных агрегатов, см. daily_aggregates.
+        start_date: дата начала ряда. Если None, с первого дня в агрегатах.
+        end_date: дата конца ряда. Если None, до последнего дня в агрегатах.
+
+    Returns:
+        Датафрейм с ежедневным индексом 'date' и колонками ['spend', 'income', 'balance'].
+    '''
+    if aggregates.empty:
+        return pd.DataFrame([], columns=['spend', 'income', 'balance'],
+                            index=pd.DatetimeIndex([], name='date'))
+
+    last_day = aggregates['date'].max()
+    if end_date is not None:
+        last_day = max(last_day, pd.to_datetime(end_date).floor('D'))
+    index = pd.date_range(aggregates['date'].min(),
+                          last_day, freq='D', name='date')
+
+    balances = aggregates.pivot(index='date', columns='account_id', values='balance').reindex(
+        index).fillna(method='ffill').fillna(0)
+
+    result = aggregates.groupby('date')[['spend', 'income']].sum().reindex(
+        index, fill_value=0)
+    result['balance'] = balances.sum(axis=1)
+
+    return result[start_date:end_date]
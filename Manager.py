@@ -1,19 +1,35 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Message, Update
 from telegram.ext.updater import Bot
 import DataLoader as dl
+import logging
+import re
 import shlex
+import time
+import pandas as pd
+import io
 from dateutil.relativedelta import relativedelta
 from datetime import date, datetime
 import Visual
+import Accuracy
+import Discovery
+import Scheduler
+import Notifier
+import DialogStore
+import Categories
+import Sharding
 from Users import User
 
 
+logger = logging.getLogger(__name__)
+
+
 class BotDialog:
-    def __init__(self, user):
+    def __init__(self, user, state=None):
         self.cmd_mask = None
         self.user = user
-        self.is_wait_answer = False
-        self.wait_answer_kwargs = {}
+        # Шаг, на котором диалог ждет ответ, и его аргументы. Сохраняются в DialogStore между сообщениями
+        self.step = state.step if state is not None else None
+        self.step_args = dict(state.args) if state is not None else {}
 
     def is_suitable(self, cmd):
         if self.cmd_mask is None:
@@ -30,6 +46,18 @@ class BotDialog:
         else:
             return self.cmd_mask
 
+    def get_state(self):
+        if self.cmd_mask is None:
+            return None
+        return DialogStore.DialogState(self.get_cmd_mask(), self.step, self.step_args)
+
+    def wait_answer(self, step, **kwargs):
+        self.step = step
+        self.step_args = kwargs
+
+    def get_step(self, step):
+        return {'add': self.reply_add}[step]
+
     def reply_help(self, message: Message, cmd, edit_text=False, **kwargs):
         text = Visual.reply_help(' '.join([self.get_cmd_mask(), cmd]))
 
@@ -40,6 +68,34 @@ class BotDialog:
             message.reply_text(
                 text=text, quote=True, parse_mode='html', **kwargs)
 
+    def get_page(self, args):
+        '''Возвращает номер страницы из аргументов вида [... page N] или 0, если номера нет или это не число.'''
+        if 'page' in args[:-1]:
+            page = args[args.index('page') + 1]
+            if page.isdigit():
+                return int(page)
+        return 0
+
+    def reply_pages(self, update: Update, pages, page=0, command='show'):
+        page = max(0, min(page, len(pages) - 1))
+        keyboard_markup = None
+        if len(pages) > 1:
+            buttons = []
+            if page > 0:
+                buttons.append(InlineKeyboardButton(
+                    f'\u25c0 {page}/{len(pages)}', callback_data=f'{self.get_cmd_mask()} {command} page {page - 1}'))
+            if page < len(pages) - 1:
+                buttons.append(InlineKeyboardButton(
+                    f'{page + 2}/{len(pages)} \u25b6', callback_data=f'{self.get_cmd_mask()} {command} page {page + 1}'))
+            keyboard_markup = InlineKeyboardMarkup([buttons])
+
+        if not update.callback_query is None:
+            update.callback_query.message.edit_text(
+                text=pages[page], parse_mode='html', reply_markup=keyboard_markup)
+        else:
+            update.message.reply_text(
+                text=pages[page], quote=False, parse_mode='html', reply_markup=keyboard_markup)
+
     def reply_error(self, message: Message, path, error_message, edit_text=False, **kwargs):
         if path == '':
             text = f'{self.get_cmd_mask()}: {error_message}'
@@ -58,15 +114,13 @@ class BotDialog:
         if command == '':
             command = shlex.split(update.message.text)
 
-        if self.is_wait_answer:
-            self.is_wait_answer = False
+        if self.step is not None:
+            step, kwargs = self.step, self.step_args
+            self.step, self.step_args = None, {}
             if command[0][0] != '/':
-                self.is_wait_answer = False
-                if 'prefix_command' in self.wait_answer_kwargs:
-                    command = self.wait_answer_kwargs.pop(
-                        'prefix_command') + command
-                self.wait_answer_func(
-                    update, command, db_engine, **self.wait_answer_kwargs)
+                if 'prefix_command' in kwargs:
+                    command = kwargs.pop('prefix_command') + command
+                self.get_step(step)(update, command, db_engine, **kwargs)
                 return False
         else:
             if command[0][0] not in ['\\', '/']:
@@ -80,8 +134,8 @@ class BotDialog:
 
 
 class BotDialogRegular(BotDialog):
-    def __init__(self, user):
-        BotDialog.__init__(self, user)
+    def __init__(self, user, state=None):
+        BotDialog.__init__(self, user, state)
         self.cmd_mask = '/regular'
 
         self.parameters = {
@@ -99,11 +153,10 @@ class BotDialogRegular(BotDialog):
             # 'follow_overdue': ''
         }
 
-    def reply_table(self, update: Update, columns=['description', 'amount'], only_relevant=True):
-        update.message.reply_text(
-            text=Visual.show_regular(
-                self.user.regular_list, only_relevant, columns),
-            quote=False, parse_mode='html')
+    def reply_table(self, update: Update, columns=['description', 'amount'], only_relevant=True, page=0):
+        pages = Visual.show_regular(
+            self.user.regular_list, only_relevant, columns, cache_key=(self.user.id, 'regular', self.user.data_version))
+        self.reply_pages(update, pages, page, 'show' if only_relevant else 'show all')
 
     def reply_row(self, update: Update, index,
                   columns=[
@@ -122,7 +175,7 @@ class BotDialogRegular(BotDialog):
                   ]):
         update.message.reply_text(
             text=Visual.show_regular(
-                self.user.regular_list, False, columns, index),
+                self.user.regular_list, False, columns, index)[0],
             quote=False, parse_mode='html')
 
     def reply_add(self, update: Update, cmd, db_engine: dl.DB_Engine):
@@ -134,13 +187,13 @@ class BotDialogRegular(BotDialog):
             date = cmd[0].split('-')
             start_date = dl.ru_datetime_parser(date[0])
             end_date = dl.ru_datetime_parser(date[1])
-            if start_date == 'NaT' or end_date == 'NaT':
+            if pd.isna(start_date) or pd.isna(end_date):
                 self.reply_help(update.message, 'add')
                 return
         else:
             start_date = dl.ru_datetime_parser(cmd[0])
             end_date = None
-            if start_date == 'NaT':
+            if pd.isna(start_date):
                 self.reply_help(update.message, 'add')
                 return
 
@@ -150,6 +203,9 @@ class BotDialogRegular(BotDialog):
             return
 
         amount = dl.amount_parser(cmd[2])
+        if pd.isna(amount):
+            self.reply_help(update.message, 'add')
+            return
 
         description = cmd[3]
 
@@ -173,6 +229,39 @@ class BotDialogRegular(BotDialog):
                               description, amount, search_f, arg_sf, adjust_price, adjust_date, follow_overdue)
         self.reply_row(update, self.user.regular_list.index[-1])
 
+    def reply_discover(self, update: Update, cmd, db_engine: dl.DB_Engine):
+        proposals = self.user.discover_regular()
+
+        if len(cmd) >= 1 and cmd[0] == 'add':
+            ids = [int(s) for s in cmd[1].split(',') if s.isdigit()] if len(cmd) >= 2 else []
+            if len(ids) == 0 or not all(i in proposals.index for i in ids):
+                self.reply_help(update.message, 'discover')
+                return
+
+            # Предложения выбираются до добавления, так как после него список пересчитывается
+            for _, event in proposals.loc[ids].iterrows():
+                self.user.add_regular(db_engine, event['start_date'].to_pydatetime(), None,
+                                      [int(event['d_years']), int(event['d_months']), int(event['d_days'])],
+                                      event['description'], float(event['amount']), event['search_f'], event['arg_sf'],
+                                      bool(event['adjust_price']), bool(event['adjust_date']), bool(event['follow_overdue']))
+            self.reply_table(update)
+            return
+
+        if len(cmd) >= 1 and cmd[0] == 'help':
+            self.reply_help(update.message, 'discover')
+            return
+
+        if proposals.empty:
+            update.message.reply_text(
+                text='Новых регулярных транзакций не найдено', quote=False)
+            return
+
+        # /regular discover [page N]
+        page = self.get_page(cmd)
+        pages = Visual.show_discovered(
+            proposals, cache_key=(self.user.id, 'discover', self.user.data_version))
+        self.reply_pages(update, pages, page, 'discover')
+
     def reply_delete(self, update: Update, cmd, db_engine: dl.DB_Engine):
         if len(cmd) < 1 or cmd[0] == 'help':
             self.reply_help(update.message, 'del')
@@ -204,16 +293,15 @@ class BotDialogRegular(BotDialog):
 
         if len(command) > 1:
             if command[1] == 'show':
-                if len(command) == 3:
-                    if command[2].isdigit():
-                        self.reply_row(update, int(command[2]))
-                        return
-                    else:
-                        self.reply_table(
-                            update, only_relevant=not (command[2] == 'all'))
-                        return
+                args = command[2:]
+                if len(args) == 1 and args[0].isdigit():
+                    self.reply_row(update, int(args[0]))
+                    return
                 else:
-                    self.reply_table(update)
+                    # /regular show [all] [page N]
+                    page = self.get_page(args)
+                    self.reply_table(
+                        update, only_relevant='all' not in args, page=page)
                     return
 
             elif command[1] == 'add':
@@ -228,6 +316,10 @@ class BotDialogRegular(BotDialog):
                 self.reply_edit(update, command[2:], db_engine)
                 return
 
+            elif command[1] == 'discover':
+                self.reply_discover(update, command[2:], db_engine)
+                return
+
         else:
             self.reply_table(update)
             return
@@ -242,6 +334,11 @@ class BotDialogRegular(BotDialog):
     #         raise Exception(
     #             f"{__class__} does not implement the processing of the '{cmd[1]}' command received from the keyboard.")
 
+    def get_step(self, step):
+        if step == 'edit_parameter':
+            return self.__edit_parameter
+        return BotDialog.get_step(self, step)
+
     def __get_edit_menu(self, id_event, n_cols=2):
         keyboard_markup = InlineKeyboardMarkup([
             [InlineKeyboardButton(name, callback_data=f'{self.get_cmd_mask()} edit {id_event} {name}')
@@ -251,10 +348,8 @@ class BotDialogRegular(BotDialog):
         return keyboard_markup
 
     def __reply_edit_parameter(self, update: Update, id_event, parameter):
-        self.wait_answer_func = self.__edit_parameter
-        self.wait_answer_kwargs = {'id_event': id_event,
-                                   'parameter': parameter}
-        self.is_wait_answer = True
+        self.wait_answer('edit_parameter',
+                         id_event=id_event, parameter=parameter)
 
         keyboard_markup = InlineKeyboardMarkup([[InlineKeyboardButton(
             'Назад', callback_data=f'{self.get_cmd_mask()} edit {id_event}')]])
@@ -277,8 +372,8 @@ class BotDialogRegular(BotDialog):
 
 
 class BotDialogOnetime(BotDialogRegular):
-    def __init__(self, user):
-        BotDialog.__init__(self, user)
+    def __init__(self, user, state=None):
+        BotDialog.__init__(self, user, state)
         self.cmd_mask = '/onetime'
 
         self.parameters = {
@@ -287,16 +382,15 @@ class BotDialogOnetime(BotDialogRegular):
             'amount': 'Сумма\nВ формате: 1000.00',
         }
 
-    def reply_table(self, update: Update, columns=['description', 'date', 'amount'], only_relevant=True):
-        update.message.reply_text(
-            text=Visual.show_onetime(
-                self.user.onetime_transactions, only_relevant, columns),
-            quote=False, parse_mode='html')
+    def reply_table(self, update: Update, columns=['description', 'date', 'amount'], only_relevant=True, page=0):
+        pages = Visual.show_onetime(
+            self.user.onetime_transactions, only_relevant, columns, cache_key=(self.user.id, 'onetime', self.user.data_version))
+        self.reply_pages(update, pages, page, 'show' if only_relevant else 'show all')
 
     def reply_row(self, update: Update, index, columns=['description', 'date', 'amount']):
         update.message.reply_text(
             text=Visual.show_onetime(
-                self.user.onetime_transactions, False, columns, index),
+                self.user.onetime_transactions, False, columns, index)[0],
             quote=False, parse_mode='html')
 
     def reply_add(self, update: Update, cmd, db_engine: dl.DB_Engine):
@@ -305,11 +399,14 @@ class BotDialogOnetime(BotDialogRegular):
             return
 
         date = dl.ru_datetime_parser(cmd[0])
-        if date == 'NaT':
+        if pd.isna(date):
             self.reply_help(update.message, 'add')
             return
 
         amount = dl.amount_parser(cmd[1])
+        if pd.isna(amount):
+            self.reply_help(update.message, 'add')
+            return
 
         description = cmd[2]
 
@@ -326,8 +423,8 @@ class BotDialogOnetime(BotDialogRegular):
 
 
 class BotDialogAccounts(BotDialogOnetime):
-    def __init__(self, user):
-        BotDialog.__init__(self, user)
+    def __init__(self, user, state=None):
+        BotDialog.__init__(self, user, state)
         self.cmd_mask = '/accounts'
 
         self.parameters = {
@@ -337,16 +434,15 @@ class BotDialogAccounts(BotDialogOnetime):
             'discharge_day': 'День выписки\nЦелое число',
         }
 
-    def reply_table(self, update: Update, columns=['type', 'description', 'credit_limit', 'discharge_day']):
-        update.message.reply_text(
-            text=Visual.show_accounts(
-                self.user.accounts, columns),
-            quote=False, parse_mode='html')
+    def reply_table(self, update: Update, columns=['type', 'description', 'credit_limit', 'discharge_day'], only_relevant=True, page=0):
+        pages = Visual.show_accounts(
+            self.user.accounts, columns, cache_key=(self.user.id, 'accounts', self.user.data_version))
+        self.reply_pages(update, pages, page)
 
     def reply_row(self, update: Update, index, columns=['type', 'description', 'credit_limit', 'discharge_day']):
         update.message.reply_text(
             text=Visual.show_accounts(
-                self.user.onetime_transactions, columns, index),
+                self.user.accounts, columns, index)[0],
             quote=False, parse_mode='html')
 
     def reply_add(self, update: Update, cmd, db_engine: dl.DB_Engine):
@@ -381,8 +477,7 @@ class BotDialogAccounts(BotDialogOnetime):
         keyboard_markup = InlineKeyboardMarkup(
             [[InlineKeyboardButton(name, callback_data=f'{self.get_cmd_mask()} add {name}') for name in names]])
 
-        self.wait_answer_func = self.reply_add
-        self.is_wait_answer = True
+        self.wait_answer('add')
 
         edit_text = not update.callback_query is None
         self.reply_error(update.message, 'add', 'description empty',
@@ -398,24 +493,20 @@ class BotDialogAccounts(BotDialogOnetime):
                          edit_text, reply_markup=keyboard_markup)
 
     def __set_credit_limit(self, update: Update, description):
-        self.is_wait_answer = True
-        self.wait_answer_func = self.reply_add
-        self.wait_answer_kwargs = {'prefix_command': [description, 'credit']}
+        self.wait_answer('add', prefix_command=[description, 'credit'])
 
         self.reply_error(update.message, 'add', 'credit_limit empty')
 
     def __set_discharge_day(self, update: Update, description, credit_limit):
-        self.is_wait_answer = True
-        self.wait_answer_func = self.reply_add
-        self.wait_answer_kwargs = {'prefix_command': [description,
-                                                      'credit', credit_limit]}
+        self.wait_answer('add', prefix_command=[
+                         description, 'credit', credit_limit])
 
         self.reply_error(update.message, 'add', 'discharge_day empty')
 
 
 class BotDialogTransactions(BotDialog):
-    def __init__(self, user):
-        BotDialog.__init__(self, user)
+    def __init__(self, user, state=None):
+        BotDialog.__init__(self, user, state)
         self.cmd_mask = ['/transactions', '/tr']
 
     def reply_add(self, update: Update, cmd, db_engine: dl.DB_Engine, file_received=None):
@@ -434,7 +525,9 @@ class BotDialogTransactions(BotDialog):
             else:
                 message = update.message
             if not message.document is None:
-                file_received = message.document
+                # В состоянии диалога хранится только id файла, а не объект Document
+                file_received = {'file_id': message.document.file_id,
+                                 'file_name': message.document.file_name}
             else:
                 self.reply_error(update.message, 'add', 'file empty')
                 return
@@ -446,12 +539,13 @@ class BotDialogTransactions(BotDialog):
             return
 
         new_balance = cmd[0]
+        if pd.isna(dl.amount_parser(new_balance)):
+            self.reply_error(update.message, 'add', 'balance incorrect')
+            return
 
         if len(cmd) < 2:
-            self.is_wait_answer = True
-            self.wait_answer_func = self.reply_add
-            self.wait_answer_kwargs = {'prefix_command': [new_balance],
-                                       'file_received': file_received}
+            self.wait_answer('add', prefix_command=[
+                             new_balance], file_received=file_received)
 
             keyboard_markup = InlineKeyboardMarkup(
                 [[InlineKeyboardButton(account_name, callback_data=f'{self.get_cmd_mask()} add \'{new_balance}\' {account_name}')]
@@ -468,9 +562,7 @@ class BotDialogTransactions(BotDialog):
             if account.any():
                 account_id = self.user.accounts.loc[account, 'db_id'].values[0]
             else:
-                self.is_wait_answer = True
-                self.wait_answer_func = self.reply_add
-                self.wait_answer_kwargs = {'file_received': file_received}
+                self.wait_answer('add', file_received=file_received)
 
                 keyboard_markup = InlineKeyboardMarkup(
                     [[InlineKeyboardButton(account_name, callback_data=f'\'{new_balance}\' {account_name}')]
@@ -479,17 +571,29 @@ class BotDialogTransactions(BotDialog):
                                  reply_markup=keyboard_markup)
                 return
 
-        path = './temp/' + file_received.file_name
+        path = './temp/' + file_received['file_name']
         # TODO Обработать исключение неудачной загрузки
-        file_received.get_file().download(custom_path=path)
+        message.bot.get_file(file_received['file_id']).download(
+            custom_path=path)
         transactions = self.user.load_from_file(
             db_engine, path, account_id, dl.amount_parser(new_balance))
         comparison_data = self.user.get_comparison_data()
+        Accuracy.LOG.add(
+            db_engine, self.user.get_accuracy_records(comparison_data))
 
         message.reply_text(
             text=Visual.successful_adding_transactions(transactions), quote=True)
-        message.reply_photo(
-            photo=Visual.comparison_plot(comparison_data), quote=False)
+        plot = Visual.comparison_plot(comparison_data)
+        sent = message.reply_photo(
+            photo=Visual.PLOT_CACHE.photo(plot), quote=False)
+        Visual.PLOT_CACHE.remember_upload(plot, sent)
+
+        # Сравнение выше строится прогнозом модели без новых данных, поэтому модель дообучается после него.
+        # Транзакции уже сохранены и пользователь получил ответ, поэтому ошибка обучения только логируется
+        try:
+            self.user.update_model(db_engine)
+        except Exception:
+            logger.exception(f'update_model failed for user {self.user.id}')
 
     def new_message(self, update: Update, db_engine: dl.DB_Engine, command=''):
         command = BotDialog.new_message(self, update, db_engine, command)
@@ -507,16 +611,48 @@ class UserManager:
 
     Attributes:
         db_engine: объект для работы с базой данных.
-        user_dict: словарь пользователей.
-        bot_dialog_dict: словарь BotDialog для пользовалетей.
+        user_dict: словарь загруженных пользователей. Пользователи без обращений дольше user_ttl удаляются, см. evict_idle_users.
+        user_ttl: через сколько секунд без обращений пользователь выгружается из памяти.
+        dialog_states: хранилище состояний диалогов пользователей, см. DialogStore.DialogStateStore.
+        forecast_cache: словарь последних рассчитанных отчетов /pred для пользователей.
+        shard: кортеж (номер шарда, количество шардов), если менеджер обслуживает только часть пользователей, иначе None.
 
     '''
 
-    def __init__(self, bot, db_settings):
-        self.db_engine = dl.DB_Engine(**db_settings)
+    def __init__(self, bot, db_settings, shard=None, db_engine=None, dialog_store_path=None, user_ttl=24 * 3600):
+        '''
+        Args:
+            bot: объект telegram.Bot для отправки сообщений.
+            db_settings: параметры подключения к базе данных.
+            shard: см. атрибут shard.
+            db_engine: готовый объект для работы с базой данных. Если передан, db_settings не используются.
+            dialog_store_path: путь к файлу dbm состояний диалогов, чтобы диалоги переживали перезапуск.
+                У каждого шарда свой файл с номером шарда в конце. Если None, состояния хранятся в памяти.
+            user_ttl: см. атрибут user_ttl.
+        '''
+        self.db_engine = db_engine if db_engine is not None else dl.DB_Engine(
+            **db_settings)
         self.user_dict = {}
-        self.bot_dialog_dict = {}
+        self.user_ttl = user_ttl
+        self.__last_access = {}
+        if dialog_store_path is not None and shard is not None:
+            dialog_store_path = f'{dialog_store_path}.{shard[0]}'
+        self.dialog_states = DialogStore.DialogStateStore(
+            path=dialog_store_path)
+        self.forecast_cache = {}
         self.bot = bot
+        self.shard = shard
+
+    def is_own_user(self, user_id):
+        '''Проверяет, обслуживается ли пользователь этим менеджером.
+
+        Args:
+            user_id: id пользователя.
+
+        Returns:
+            True, если пользователь относится к шарду менеджера или менеджер не шардирован.
+        '''
+        return self.shard is None or Sharding.shard_of(user_id, self.shard[1]) == self.shard[0]
 
     def get_user(self, user_id):
         '''Ищет и возвращает объект пользователя по его id
@@ -527,6 +663,7 @@ class UserManager:
         Returns:
             Объект пользователя.
         '''
+        self.__last_access[user_id] = time.time()
         if user_id in self.user_dict:
             return self.user_dict[user_id]
         else:
@@ -534,29 +671,58 @@ class UserManager:
             self.user_dict[user_id] = new_user
             return new_user
 
+    def evict_idle_users(self):
+        '''Выгружает из памяти пользователей, к которым не обращались дольше user_ttl секунд,
+        вместе с их кэшем прогнозов. При следующем обращении пользователь загрузится из базы заново.
+
+        Returns:
+            Количество выгруженных пользователей.
+        '''
+        deadline = time.time() - self.user_ttl
+        idle = [user_id for user_id in list(self.user_dict)
+                if self.__last_access.get(user_id, 0) < deadline]
+        for user_id in idle:
+            self.user_dict.pop(user_id, None)
+            self.__last_access.pop(user_id, None)
+            self.forecast_cache.pop(user_id, None)
+        return len(idle)
+
     def get_dialog(self, user_id, cmd):
-        '''Ищет и возвращает объект диалога по id пользователя
+        '''Создает объект диалога по сохраненному состоянию диалога пользователя.
+        Если состояния нет или пришла команда другого диалога, создается новый диалог.
 
         Args:
             user_id: id пользователя.
             cmd: команда.
 
         Returns:
-            Объект пользователя.
+            Объект диалога.
         '''
         user = self.get_user(user_id)
+        state = self.dialog_states.get(user_id)
 
-        if user_id in self.bot_dialog_dict:
-            bot_dialog = self.bot_dialog_dict[user_id]
+        if state is not None:
+            bot_dialog = self.__create_bot_dialog(state.cmd, user, state)
             if cmd[0] == '/' and not (bot_dialog.is_suitable(cmd)):
                 bot_dialog = self.__create_bot_dialog(cmd, user)
-                self.bot_dialog_dict[user_id] = bot_dialog
         else:
             bot_dialog = self.__create_bot_dialog(cmd, user)
-            self.bot_dialog_dict[user_id] = bot_dialog
 
         return bot_dialog
 
+    def save_dialog(self, user_id, bot_dialog):
+        '''Сохраняет состояние диалога пользователя после обработки сообщения.
+
+        Args:
+            user_id: id пользователя.
+            bot_dialog: объект диалога.
+        '''
+        state = bot_dialog.get_state()
+        if state is None:
+            self.dialog_states.pop(user_id)
+        else:
+            self.dialog_states.set(user_id, state)
+
     def predict_events(self, user_id, end_date):
         '''Прогнозирует регулярные и одноразовые транзакции для пользователя.
 
@@ -595,28 +761,148 @@ class UserManager:
         '''
         return self.get_user(user_id).fit_new_model(self.db_engine)
 
-    def report_events_and_transactions(self, user_id, end_date):
+    def recategorize(self, user_id):
+        '''Применяет правила категорий пользователя ко всей его истории транзакций.
+
+        Args:
+            user_id: id пользователя.
+
+        Returns:
+            Количество транзакций, у которых изменилась категория.
+        '''
+        return self.get_user(user_id).recategorize(self.db_engine)
+
+    def add_category_rule(self, user_id, match_type, value, key):
+        '''Добавляет правило категории и применяет правила пользователя ко всей его истории транзакций.
+
+        Args:
+            user_id: id пользователя.
+            match_type: одно из [Categories.MATCH_EXACT, Categories.MATCH_PREFIX, Categories.MATCH_REGEX].
+            value: категория.
+            key: описание, префикс описания или регулярное выражение.
+
+        Returns:
+            Количество транзакций, у которых изменилась категория.
+        '''
+        if match_type not in [Categories.MATCH_EXACT, Categories.MATCH_PREFIX, Categories.MATCH_REGEX]:
+            raise Exception(f'Unknown match type /"{match_type}/"')
+        if match_type == Categories.MATCH_REGEX:
+            try:
+                re.compile(key)
+            except re.error as e:
+                raise Exception(f'Invalid regex /"{key}/": {e}')
+
+        self.db_engine.add_category_rule(user_id, key, value, match_type)
+        return self.recategorize(user_id)
+
+    def refresh_user(self, user_id):
+        '''Догружает изменения данных пользователя из базы, если пользователь уже загружен.
+
+        Args:
+            user_id: id пользователя.
+
+        Returns:
+            Словарь {таблица: количество измененных строк} или None, если пользователь не загружен.
+        '''
+        if user_id not in self.user_dict:
+            return None
+        return self.user_dict[user_id].refresh(self.db_engine)
+
+    def refresh_all(self, workers=4):
+        '''Догружает изменения данных всех загруженных пользователей.
+
+        Args:
+            workers: количество потоков.
+
+        Returns:
+            Отчет о выполнении, см. Scheduler.run_for_users.
+        '''
+        return Scheduler.run_for_users(
+            list(self.user_dict), self.refresh_user, workers, rate=None)
+
+    def report_events_and_transactions(self, user_id, end_date, bands=False):
         '''Прогнозирует транзакции пользователя, строит графики.
 
         Args:
             user_id: id пользователя.
             end_date: дата до которой строить прогноз.
+            bands: если True, на график добавляются полосы вероятностного прогноза,
+                а в сообщение - вероятность того, что баланс опустится ниже нуля.
 
         Returns:
             {
                 'plot': График прогноза баланса.
-                'message': Список регулярных транзакций и средние расходы в день.
+                'message': Список страниц сообщения: регулярные транзакции и средние расходы в день.
             }
         '''
         events = self.predict_events(user_id, end_date).set_index('date')
 
         full_transactions = self.predict_full(user_id, end_date)
 
+        user = self.get_user(user_id)
+        if bands:
+            probabilistic = user.predict_bands(end_date)
+            return {
+                'plot': Visual.transactions_plot(full_transactions, probabilistic['bands']),
+                'message': Visual.predict_info(events, user.predicted_transactions, probabilistic['p_below_zero'])
+            }
+
         return {
             'plot': Visual.transactions_plot(full_transactions),
-            'message': Visual.predict_info(events, self.get_user(user_id).predicted_transactions)
+            'message': Visual.predict_info(events, user.predicted_transactions)
         }
 
+    def report_forecast(self, user_id, months=1, bands=False, categories=False):
+        '''Возвращает отчет /pred. Отчет без вероятностного прогноза берется из кэша прогнозов,
+        если он рассчитан сегодня и данные пользователя с тех пор не менялись.
+
+        Args:
+            user_id: id пользователя.
+            months: на сколько месяцев строить прогноз.
+            bands: добавить ли вероятностный прогноз, см. report_events_and_transactions.
+            categories: добавить ли прогноз расходов по категориям.
+
+        Returns:
+            {
+                'plot': График прогноза баланса.
+                'message': Список страниц сообщения: регулярные транзакции и средние расходы в день.
+                'categories': Список страниц прогноза расходов по категориям. Только если categories == True.
+            }
+        '''
+        end_date = datetime.today() + relativedelta(months=months)
+        if bands:
+            report = self.report_events_and_transactions(user_id, end_date, bands)
+            if categories:
+                report['categories'] = self.report_categories(user_id, end_date)
+            return report
+
+        key = (date.today(), months, self.get_user(user_id).data_version)
+        cached = self.forecast_cache.get(user_id)
+        if cached is None or cached['key'] != key:
+            report = self.report_events_and_transactions(user_id, end_date)
+            cached = {
+                'key': key,
+                'plot': report['plot'].getvalue(),
+                'plot_key': report['plot'].plot_key,
+                'message': report['message']
+            }
+            self.forecast_cache[user_id] = cached
+
+        plot = io.BytesIO(cached['plot'])
+        # Ключ нужен, чтобы при отправке взять file_id уже загруженной картинки, см. PlotCache
+        plot.plot_key = cached['plot_key']
+        report = {
+            'plot': plot,
+            'message': cached['message']
+        }
+        if categories:
+            report['categories'] = self.report_categories(user_id, end_date)
+        return report
+
+    def report_categories(self, user_id, end_date):
+        '''Возвращает страницы сообщения с прогнозом расходов по категориям до end_date, см. User.predict_categories.'''
+        return Visual.category_breakdown(self.get_user(user_id).predict_categories(end_date))
+
     # def show_onetime(self, user_id, only_relevant=True):
     #     '''Добавляет однократное событие.
 
@@ -628,36 +914,97 @@ class UserManager:
     #     return Visual.show_onetime(user.onetime_transactions, only_relevant)
 
     def bot_dialog(self, user_id, update):
-        self.get_dialog(user_id, update.message.text.split(' ')
-                        [0]).new_message(update, self.db_engine)
+        bot_dialog = self.get_dialog(
+            user_id, update.message.text.split(' ')[0])
+        bot_dialog.new_message(update, self.db_engine)
+        self.save_dialog(user_id, bot_dialog)
 
     def bot_dialog_keyboard(self, user_id, update):
         cmd = update.callback_query.data.split(' ')
-        self.get_dialog(user_id, cmd[0]).keyboard_callback(
-            update, self.db_engine)
-
-    def daily_notice(self):
-        print("daily_notice по расписанию")
-        users_id = self.db_engine.get_users_for_notifications()
-        for id in users_id:
-            user = self.get_user(id)
-            events_today = user.predict_events(
+        bot_dialog = self.get_dialog(user_id, cmd[0])
+        bot_dialog.keyboard_callback(update, self.db_engine)
+        self.save_dialog(user_id, bot_dialog)
+
+    def daily_notice(self, workers=4):
+        '''Отправляет пользователям регулярные и разовые транзакции на сегодня.
+        События на сегодня рассчитываются в базе одним запросом. Полностью загружаются только пользователи
+        с регулярными событиями, зависящими от истории транзакций. Сообщения отправляются параллельно.
+
+        Args:
+            workers: количество потоков для загрузки пользователей.
+
+        Returns:
+            Отчет о рассылке. Словарь формата {'prepare', 'send'}, каждый элемент - отчет Scheduler.run_for_users.
+        '''
+        today = date.today()
+        events = self.db_engine.download_notification_events(today, today)
+        adjusted_users = [user_id for user_id in self.db_engine.get_users_with_adjusted_events(
+            today, today) if self.is_own_user(user_id)]
+        events = events[events['user_id'].map(self.is_own_user)]
+
+        messages = {}
+        for user_id, events_today in events[~events['user_id'].isin(adjusted_users)].groupby('user_id'):
+            messages[user_id] = Visual.show_events(
+                events_today.set_index('date'))
+
+        def prepare_notification(user_id):
+            events_today = self.get_user(user_id).predict_events(
                 datetime.today() - relativedelta(days=1), datetime.today())
-            print(events_today)
-            events_today = events_today.set_index('date')
+            if len(events_today) > 0:
+                messages[user_id] = Visual.show_events(
+                    events_today.set_index('date'))
+
+        prepare_report = Scheduler.run_for_users(
+            adjusted_users, prepare_notification, workers)
+        send_report = Notifier.NotificationDispatcher(
+            self.bot).dispatch(messages, parse_mode='html')
 
-            print(events_today)
-            self.bot.send_message(id, Visual.show_events(
-                events_today), parse_mode='html')
+        return {'prepare': prepare_report, 'send': send_report}
 
-    def __create_bot_dialog(self, cmd, user):
+    def discover_regular_notice(self, history_days=3 * 365):
+        '''Ищет повторяющиеся платежи сразу у всех пользователей и предлагает добавить их как регулярные транзакции.
+        История всех пользователей загружается одним запросом и обрабатывается одним вызовом Discovery.discover_regular.
+        Об одном и том же платеже пользователь получает уведомление один раз, отправленные уведомления хранятся в базе.
+
+        Args:
+            history_days: за сколько последних дней учитывать историю транзакций.
+
+        Returns:
+            Отчет. Словарь формата {'transactions', 'proposals', 'time', 'send'}, send - отчет NotificationDispatcher.dispatch.
+        '''
+        start_time = time.perf_counter()
+        history = self.db_engine.download_history(
+            date.today() - relativedelta(days=history_days), self.shard)
+        regular = self.db_engine.download_all_regular()
+        proposals = Discovery.discover_regular(history, regular)
+        discovery_time = time.perf_counter() - start_time
+
+        key_columns = ['user_id', 'description', 'period']
+        notified = self.db_engine.download_discovery_notices(self.shard)
+        proposals = proposals[~pd.MultiIndex.from_frame(proposals[key_columns]).isin(
+            pd.MultiIndex.from_frame(notified[key_columns]))]
+
+        messages = {}
+        for user_id, user_proposals in proposals.groupby('user_id'):
+            pages = Visual.show_discovered(user_proposals.reset_index(drop=True))
+            messages[user_id] = pages[:-1] + \
+                [pages[-1] + '\n\nЧтобы добавить их, введите /regular discover']
+        dispatcher = Notifier.NotificationDispatcher(self.bot)
+        send_report = dispatcher.dispatch(messages, parse_mode='html')
+        # Пользователи, до которых уведомление не дошло, получат его при следующем поиске
+        self.db_engine.add_discovery_notices(proposals[proposals['user_id'].isin(
+            dispatcher.delivered)].drop_duplicates(key_columns))
+
+        return {'transactions': len(history), 'proposals': len(proposals), 'time': discovery_time, 'send': send_report}
+
+    def __create_bot_dialog(self, cmd, user, state=None):
         if cmd == '/regular':
-            return BotDialogRegular(user)
+            return BotDialogRegular(user, state)
         elif cmd == '/onetime':
-            return BotDialogOnetime(user)
+            return BotDialogOnetime(user, state)
         elif cmd in ['/transactions', '/tr']:
-            return BotDialogTransactions(user)
+            return BotDialogTransactions(user, state)
         elif cmd == '/accounts':
-            return BotDialogAccounts(user)
+            return BotDialogAccounts(user, state)
 
-        return BotDialog(user)
+        return BotDialog(user, state)
@@ -0,0 +1,281 @@
+import json
+import sys
+import time
+import pandas as pd
+import sqlalchemy as sqla
+
+
+# Список миграций схемы: (версия, название, список SQL запросов).
+# Индексы создаются CONCURRENTLY, чтобы не блокировать запись в рабочую базу.
+MIGRATIONS = [
+    (1, 'regular_onetime_is_del', [
+        'ALTER TABLE {schema}.regular ADD COLUMN IF NOT EXISTS is_del boolean NOT NULL DEFAULT false',
+        'ALTER TABLE {schema}.onetime ADD COLUMN IF NOT EXISTS is_del boolean NOT NULL DEFAULT false',
+    ]),
+    (2, 'transactions_user_date_idx', [
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS transactions_user_date_idx ON {schema}.transactions (user_id, date) WHERE NOT is_del',
+    ]),
+    (3, 'transactions_user_account_date_idx', [
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS transactions_user_account_date_idx ON {schema}.transactions (user_id, account_id, date) WHERE NOT is_del',
+    ]),
+    (4, 'events_user_idx', [
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS regular_user_idx ON {schema}.regular (user_id) WHERE NOT is_del',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS onetime_user_date_idx ON {schema}.onetime (user_id, date) WHERE NOT is_del',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS accounts_user_idx ON {schema}.accounts (user_id)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS dictionary_categories_user_idx ON {schema}.dictionary_categories (user_id)',
+    ]),
+    (5, 'sbs_models_user_id_idx', [
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS sbs_models_user_id_idx ON {schema}.sbs_models (user_id, id DESC)',
+    ]),
+    (6, 'updated_at', [
+        '''CREATE OR REPLACE FUNCTION {schema}.set_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at = now();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql''',
+    ] + [
+        query.format(table=table, schema='{schema}') for table in ['transactions', 'regular', 'onetime', 'accounts'] for query in [
+            'ALTER TABLE {schema}.{table} ADD COLUMN IF NOT EXISTS updated_at timestamp without time zone NOT NULL DEFAULT now()',
+            'DROP TRIGGER IF EXISTS {table}_updated_at ON {schema}.{table}',
+            'CREATE TRIGGER {table}_updated_at BEFORE UPDATE ON {schema}.{table} FOR EACH ROW EXECUTE FUNCTION {schema}.set_updated_at()',
+        ]
+    ] + [
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS transactions_user_updated_at_idx ON {schema}.transactions (user_id, updated_at)',
+    ]),
+    (7, 'dictionary_categories_match_type', [
+        "ALTER TABLE {schema}.dictionary_categories ADD COLUMN IF NOT EXISTS match_type character varying(6) NOT NULL DEFAULT 'exact'",
+    ]),
+    (8, 'forecast_accuracy', [
+        '''CREATE TABLE IF NOT EXISTS {schema}.forecast_accuracy (
+            id bigserial NOT NULL,
+            user_id integer NOT NULL,
+            model_version integer,
+            created_at timestamp without time zone NOT NULL DEFAULT now(),
+            date date NOT NULL,
+            horizon smallint NOT NULL,
+            real_b numeric(12, 2) NOT NULL,
+            predicted_b numeric(12, 2) NOT NULL,
+            PRIMARY KEY (id)
+        )''',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS forecast_accuracy_user_created_at_idx ON {schema}.forecast_accuracy (user_id, created_at)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS forecast_accuracy_created_at_idx ON {schema}.forecast_accuracy (created_at)',
+    ]),
+    (9, 'sbs_models_created_at_event_count', [
+        # У старых моделей дата создания неизвестна и остается пустой, такие модели считаются устаревшими
+        'ALTER TABLE {schema}.sbs_models ADD COLUMN IF NOT EXISTS created_at timestamp without time zone',
+        'ALTER TABLE {schema}.sbs_models ALTER COLUMN created_at SET DEFAULT now()',
+        'ALTER TABLE {schema}.sbs_models ADD COLUMN IF NOT EXISTS event_count integer',
+        'ALTER TABLE {schema}.sbs_models ADD COLUMN IF NOT EXISTS ml_event_count integer',
+    ]),
+    (10, 'sbs_models_partial', [
+        # Дообученные модели не сбрасывают ошибки прогноза, см. DB_Engine.download_accuracy_drift
+        'ALTER TABLE {schema}.sbs_models ADD COLUMN IF NOT EXISTS partial boolean NOT NULL DEFAULT false',
+    ]),
+    (11, 'daily_aggregates', [
+        # Таблица заполняется при загрузке транзакций, для старых пользователей - при первой загрузке User
+        '''CREATE TABLE IF NOT EXISTS {schema}.daily_aggregates (
+            user_id integer NOT NULL,
+            account_id integer NOT NULL,
+            date date NOT NULL,
+            spend numeric(10, 2) NOT NULL DEFAULT 0,
+            income numeric(10, 2) NOT NULL DEFAULT 0,
+            balance numeric(9, 2) NOT NULL,
+            PRIMARY KEY (user_id, account_id, date)
+        )''',
+    ]),
+    (12, 'discovery_notices', [
+        # Уведомления о найденных регулярных платежах не повторяются после перезапуска бота
+        '''CREATE TABLE IF NOT EXISTS {schema}.discovery_notices (
+            user_id integer NOT NULL,
+            description character varying(25) NOT NULL,
+            period character varying(15) NOT NULL,
+            created_at timestamp without time zone NOT NULL DEFAULT now(),
+            PRIMARY KEY (user_id, description, period)
+        )''',
+    ]),
+]
+
+PARTITION_VERSION = 1000
+
+BENCHMARK_QUERIES = {
+    'get_transactions': 'SELECT * FROM {schema}.transactions WHERE user_id = :user_id AND is_del = false ORDER BY date',
+    'get_transactions_range': 'SELECT * FROM {schema}.transactions WHERE user_id = :user_id AND is_del = false AND date >= :start_date ORDER BY date',
+    'delete_transactions': 'UPDATE {schema}.transactions SET is_del = true WHERE user_id = :user_id AND account_id = :account_id AND date >= :start_date AND date <= :end_date AND is_del = false',
+}
+
+
+def get_applied_versions(db_engine):
+    '''Возвращает версии миграций, уже примененных к базе.
+
+    Args:
+        db_engine: объект для работы с базой данных.
+
+    Returns:
+        Множество версий.
+    '''
+    with db_engine.connector.begin() as connection:
+        connection.execute(sqla.sql.text(
+            f'CREATE TABLE IF NOT EXISTS {db_engine.schema}.schema_migrations ('
+            'version integer NOT NULL, name character varying(61) NOT NULL, '
+            'applied_at timestamp without time zone NOT NULL DEFAULT now(), PRIMARY KEY (version))'))
+        result = connection.execute(sqla.sql.text(
+            f'SELECT version FROM {db_engine.schema}.schema_migrations'))
+        return {r for r, in result}
+
+
+def apply_migrations(db_engine):
+    '''Применяет к базе все миграции из MIGRATIONS, которые еще не были применены.
+
+    Args:
+        db_engine: объект для работы с базой данных.
+
+    Returns:
+        Список названий примененных миграций.
+    '''
+    applied = get_applied_versions(db_engine)
+    result = []
+
+    for version, name, queries in MIGRATIONS:
+        if version in applied:
+            continue
+
+        # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+        with db_engine.connector.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            for query in queries:
+                connection.execute(sqla.sql.text(
+                    query.format(schema=db_engine.schema)))
+            connection.execute(sqla.sql.text(
+                f'INSERT INTO {db_engine.schema}.schema_migrations (version, name) VALUES (:version, :name)'), {
+                'version': version, 'name': name})
+        result.append(name)
+
+    return result
+
+
+def partition_transactions(db_engine, partitions=16):
+    '''Переводит таблицу transactions на hash-секционирование по user_id.
+    Старая таблица сохраняется под именем transactions_old. Выполняется в одной транзакции.
+    Индексы и триггер updated_at создаются заново, поэтому миграции MIGRATIONS должны быть применены раньше.
+
+    Args:
+        db_engine: объект для работы с базой данных.
+        partitions: количество секций.
+
+    Returns:
+        True, если секционирование выполнено, False если оно было выполнено ранее.
+    '''
+    applied = get_applied_versions(db_engine)
+    if PARTITION_VERSION in applied:
+        return False
+    missing = [version for version, _, _ in MIGRATIONS if version not in applied]
+    if len(missing) > 0:
+        raise Exception(f'Migrations /"{missing}/" are not applied, run migrate first')
+
+    schema = db_engine.schema
+    queries = [
+        f'LOCK TABLE {schema}.transactions IN EXCLUSIVE MODE',
+        f'CREATE TABLE {schema}.transactions_p (LIKE {schema}.transactions INCLUDING DEFAULTS) PARTITION BY HASH (user_id)',
+    ] + [
+        f'CREATE TABLE {schema}.transactions_p_{i} PARTITION OF {schema}.transactions_p FOR VALUES WITH (MODULUS {partitions}, REMAINDER {i})'
+        for i in range(partitions)
+    ] + [
+        # Первичный ключ секционированной таблицы обязан включать ключ секционирования
+        f'ALTER TABLE {schema}.transactions_p ADD PRIMARY KEY (id, user_id)',
+        f'INSERT INTO {schema}.transactions_p SELECT * FROM {schema}.transactions',
+        f'ALTER SEQUENCE {schema}.transactions_id_seq OWNED BY {schema}.transactions_p.id',
+        f'ALTER TABLE {schema}.transactions RENAME TO transactions_old',
+        f'ALTER TABLE {schema}.transactions_p RENAME TO transactions',
+        f'ALTER INDEX IF EXISTS {schema}.transactions_user_date_idx RENAME TO transactions_old_user_date_idx',
+        f'ALTER INDEX IF EXISTS {schema}.transactions_user_account_date_idx RENAME TO transactions_old_user_account_date_idx',
+        f'ALTER INDEX IF EXISTS {schema}.transactions_user_updated_at_idx RENAME TO transactions_old_user_updated_at_idx',
+        f'CREATE INDEX transactions_user_date_idx ON {schema}.transactions (user_id, date) WHERE NOT is_del',
+        f'CREATE INDEX transactions_user_account_date_idx ON {schema}.transactions (user_id, account_id, date) WHERE NOT is_del',
+        f'CREATE INDEX transactions_user_updated_at_idx ON {schema}.transactions (user_id, updated_at)',
+        # LIKE не копирует триггеры, без него updated_at не меняется при обновлении и User.refresh не видит изменений
+        f'CREATE TRIGGER transactions_updated_at BEFORE UPDATE ON {schema}.transactions FOR EACH ROW EXECUTE FUNCTION {schema}.set_updated_at()',
+        f'ANALYZE {schema}.transactions',
+    ]
+
+    with db_engine.connector.begin() as connection:
+        for query in queries:
+            connection.execute(sqla.sql.text(query))
+        connection.execute(sqla.sql.text(
+            f'INSERT INTO {schema}.schema_migrations (version, name) VALUES (:version, :name)'), {
+            'version': PARTITION_VERSION, 'name': f'transactions_hash_partitions_{partitions}'})
+
+    return True
+
+
+def explain_benchmark(db_engine, user_count=5, runs=3):
+    '''Замеряет запросы загрузки и удаления транзакций через EXPLAIN ANALYZE
+    на пользователях с наибольшим количеством транзакций. UPDATE выполняется в транзакции, которая откатывается.
+
+    Args:
+        db_engine: объект для работы с базой данных.
+        user_count: количество пользователей для замера.
+        runs: количество повторов каждого запроса.
+
+    Returns:
+        Датафрейм с колонками ['query', 'user_id', 'rows', 'execution_ms', 'planning_ms', 'nodes'],
+        где nodes - типы узлов плана запроса, например 'Index Scan' или 'Seq Scan'.
+    '''
+    schema = db_engine.schema
+    users = db_engine.connector.execute(sqla.sql.text(
+        f'SELECT user_id, max(account_id), min(date), max(date), count(*) AS c FROM {schema}.transactions '
+        f'WHERE NOT is_del GROUP BY user_id ORDER BY c DESC LIMIT :limit'), {'limit': user_count}).fetchall()
+
+    result = []
+    for user_id, account_id, start_date, end_date, rows in users:
+        params = {'user_id': user_id, 'account_id': account_id,
+                  'start_date': start_date, 'end_date': end_date}
+        for name, query in BENCHMARK_QUERIES.items():
+            for _ in range(runs):
+                connection = db_engine.connector.connect()
+                transaction = connection.begin()
+                try:
+                    plan = connection.execute(sqla.sql.text(
+                        'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query.format(schema=schema)), params).scalar()[0]
+                finally:
+                    transaction.rollback()
+                    connection.close()
+
+                result.append({
+                    'query': name,
+                    'user_id': user_id,
+                    'rows': rows,
+                    'execution_ms': plan['Execution Time'],
+                    'planning_ms': plan['Planning Time'],
+                    'nodes': ', '.join(sorted(_get_plan_nodes(plan['Plan'])))
+                })
+
+    return pd.DataFrame(result)
+
+
+def _get_plan_nodes(plan):
+    nodes = {plan['Node Type']}
+    for child in plan.get('Plans', []):
+        nodes |= _get_plan_nodes(child)
+    return nodes
+
+
+if __name__ == '__main__':
+    import DataLoader as dl
+
+    with open('./settings.np.json') as f:
+        settings = json.load(f)
+    db_engine = dl.DB_Engine(**settings['db_connector'])
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'migrate'
+    start_time = time.time()
+    if command == 'migrate':
+        print(apply_migrations(db_engine))
+    elif command == 'partition':
+        print(partition_transactions(db_engine, *[int(a)
+              for a in sys.argv[2:3]]))
+    elif command == 'benchmark':
+        print(explain_benchmark(db_engine).groupby(
+            ['query', 'nodes'])[['execution_ms', 'planning_ms']].describe().to_string())
+    else:
+        raise Exception(f'Unknown command "{command}"')
+    print(f'{command}: {time.time() - start_time:.2f} s')
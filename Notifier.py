@@ -0,0 +1,90 @@
+import logging
+import time
+from telegram.error import BadRequest, NetworkError, RetryAfter, Unauthorized
+import Scheduler
+
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationDispatcher:
+    '''Параллельно отправляет сообщения пользователям с учетом ограничений Telegram.
+    Неудачные отправки повторяются с экспоненциальной задержкой, ошибка для одного пользователя не влияет на остальных.
+
+    Attributes:
+        bot: объект с методом send_message(chat_id, text, **kwargs), например telegram.Bot.
+        workers: количество потоков отправки.
+        retries: количество повторных попыток отправки.
+        backoff: задержка в секундах перед первой повторной попыткой. Удваивается с каждой попыткой.
+        delivered: id пользователей, которым последний вызов dispatch отправил все сообщения.
+    '''
+
+    def __init__(self, bot, workers=8, rate=25, retries=3, backoff=1.):
+        '''
+        Args:
+            bot: объект с методом send_message(chat_id, text, **kwargs), например telegram.Bot.
+            workers: количество потоков отправки.
+            rate: максимальное количество сообщений в секунду. Telegram допускает около 30 сообщений в секунду для бота.
+            retries: количество повторных попыток отправки.
+            backoff: задержка в секундах перед первой повторной попыткой.
+        '''
+        self.bot = bot
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.delivered = []
+        self.__limiter = Scheduler.RateLimiter(rate)
+
+    def send(self, chat_id, text, **kwargs):
+        '''Отправляет одно сообщение, повторяя попытку при сетевых ошибках и превышении лимитов Telegram.
+        Постоянные ошибки (неверный запрос, бот заблокирован пользователем) не повторяются.
+
+        Args:
+            chat_id: id чата.
+            text: текст сообщения.
+            kwargs: дополнительные аргументы для send_message.
+
+        Returns:
+            Результат send_message.
+        '''
+        for attempt in range(self.retries + 1):
+            self.__limiter.wait()
+            try:
+                return self.bot.send_message(chat_id, text, **kwargs)
+            except (BadRequest, Unauthorized):
+                # BadRequest наследует NetworkError, но повтор не поможет
+                raise
+            except RetryAfter as e:
+                if attempt == self.retries:
+                    raise
+                delay = e.retry_after
+            except NetworkError:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+
+            logger.warning(
+                f'send_message to {chat_id} failed, retry in {delay} s')
+            time.sleep(delay)
+
+    def dispatch(self, messages, **kwargs):
+        '''Отправляет сообщения всем пользователям.
+
+        Args:
+            messages: словарь {id пользователя: текст сообщения или список текстов, отправляемых по порядку}.
+            kwargs: дополнительные аргументы для send_message.
+
+        Returns:
+            Отчет об отправке, см. Scheduler.run_for_users. Пользователи, до которых дошли сообщения, - в delivered.
+        '''
+        delivered = []
+
+        def send_notification(user_id):
+            texts = messages[user_id]
+            for text in [texts] if isinstance(texts, str) else texts:
+                self.send(user_id, text, **kwargs)
+            delivered.append(user_id)
+
+        report = Scheduler.run_for_users(list(messages), send_notification, self.workers, rate=None)
+        self.delivered = delivered
+        return report
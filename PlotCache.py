@@ -0,0 +1,165 @@
+import collections
+import hashlib
+import io
+import threading
+import time
+import pandas as pd
+
+
+def hash_value(digest, value):
+    '''Добавляет значение аргумента графика в хэш. Датафреймы и серии хэшируются по значениям,
+    индексу, названиям колонок и типам данных, остальные значения - по repr.'''
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        digest.update(type(value).__name__.encode())
+        digest.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+        if isinstance(value, pd.DataFrame):
+            digest.update(repr(list(value.columns)).encode())
+            digest.update(repr(list(value.dtypes.astype(str))).encode())
+        else:
+            digest.update(repr((value.name, str(value.dtype))).encode())
+    else:
+        digest.update(repr(value).encode())
+    digest.update(b'\x00')
+
+
+def plot_key(name, args, kwargs, style):
+    '''Возвращает ключ графика: хэш названия функции, входных данных и параметров оформления.
+
+    Args:
+        name: название функции построения графика.
+        args: позиционные аргументы функции.
+        kwargs: именованные аргументы функции.
+        style: параметры оформления, влияющие на картинку.
+
+    Returns:
+        Строка-хэш.
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    hash_value(digest, name)
+    hash_value(digest, style)
+    for value in args:
+        hash_value(digest, value)
+    for name in sorted(kwargs):
+        hash_value(digest, name)
+        hash_value(digest, kwargs[name])
+    return digest.hexdigest()
+
+
+class PlotCache:
+    '''Ограниченный по размеру кэш картинок графиков. Хранит PNG и file_id картинки,
+    уже загруженной в Telegram, чтобы одинаковые графики не рисовались и не загружались повторно.
+
+    Attributes:
+        max_bytes: максимальный суммарный размер картинок в кэше.
+        hits: количество попаданий в кэш.
+        misses: количество промахов.
+        uploads_saved: сколько раз вместо загрузки картинки отправлен file_id.
+        render_times: время построения последних графиков в секундах.
+    '''
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, render_history=1000):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.uploads_saved = 0
+        self.render_times = collections.deque(maxlen=render_history)
+        self.__size = 0
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get_or_render(self, key, render):
+        '''Возвращает картинку из кэша или строит ее.
+
+        Args:
+            key: ключ графика, см. plot_key.
+            render: функция без аргументов, которая строит график и возвращает BytesIO.
+
+        Returns:
+            Новый BytesIO с картинкой. В атрибуте plot_key хранится ключ графика.
+        '''
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                self.__entries.move_to_end(key)
+            else:
+                self.misses += 1
+
+        if entry is None:
+            start_time = time.perf_counter()
+            png = render().getvalue()
+            render_time = time.perf_counter() - start_time
+
+            entry = {'png': png, 'file_id': None}
+            with self.__lock:
+                self.render_times.append(render_time)
+                if key not in self.__entries:
+                    self.__entries[key] = entry
+                    self.__size += len(png)
+                    self.__evict()
+
+        plot = io.BytesIO(entry['png'])
+        plot.plot_key = key
+        return plot
+
+    def __evict(self):
+        while self.__size > self.max_bytes and len(self.__entries) > 1:
+            _, entry = self.__entries.popitem(last=False)
+            self.__size -= len(entry['png'])
+
+    def photo(self, plot):
+        '''Возвращает то, что нужно отправить в Telegram: file_id, если эта картинка уже загружалась,
+        иначе саму картинку.
+
+        Args:
+            plot: BytesIO, полученный из get_or_render.
+        '''
+        key = getattr(plot, 'plot_key', None)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry['file_id'] is not None:
+                self.uploads_saved += 1
+                return entry['file_id']
+        return plot
+
+    def remember_upload(self, plot, message):
+        '''Запоминает file_id картинки после отправки, чтобы в следующий раз не загружать ее снова.
+
+        Args:
+            plot: BytesIO, полученный из get_or_render.
+            message: сообщение telegram.Message, которое вернул reply_photo или send_photo.
+        '''
+        key = getattr(plot, 'plot_key', None)
+        if key is None or message is None or not message.photo:
+            return
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                entry['file_id'] = message.photo[-1].file_id
+
+    def stats(self):
+        '''Возвращает метрики кэша.
+
+        Returns:
+            {
+                'entries': количество картинок в кэше.
+                'size_bytes': суммарный размер картинок.
+                'hits', 'misses': попадания и промахи.
+                'hit_rate': доля попаданий.
+                'uploads_saved': сколько загрузок заменено на file_id.
+                'render_mean_ms', 'render_max_ms': среднее и максимальное время построения графика.
+            }
+        '''
+        with self.__lock:
+            requests = self.hits + self.misses
+            render_times = list(self.render_times)
+            return {
+                'entries': len(self.__entries),
+                'size_bytes': self.__size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests > 0 else 0.,
+                'uploads_saved': self.uploads_saved,
+                'render_mean_ms': 1000 * sum(render_times) / len(render_times) if render_times else 0.,
+                'render_max_ms': 1000 * max(render_times) if render_times else 0.,
+            }
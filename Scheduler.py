@@ -0,0 +1,295 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+import Accuracy
+import DataLoader as dl
+from Users import User
+
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    '''Ограничивает частоту операций. Потокобезопасен.
+
+    Attributes:
+        interval: минимальный интервал в секундах между операциями.
+    '''
+
+    def __init__(self, rate):
+        '''
+        Args:
+            rate: максимальное количество операций в секунду.
+        '''
+        self.interval = 1. / rate
+        self.__lock = threading.Lock()
+        self.__next_time = time.monotonic()
+
+    def wait(self):
+        '''Блокирует поток до момента, когда можно выполнить следующую операцию.'''
+        with self.__lock:
+            now = time.monotonic()
+            delay = self.__next_time - now
+            self.__next_time = max(now, self.__next_time) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+def run_for_users(users_id, func, workers=4, rate=5):
+    '''Выполняет функцию для каждого пользователя в пуле потоков.
+    Ошибка для одного пользователя не прерывает обработку остальных.
+
+    Args:
+        users_id: список id пользователей.
+        func: функция, принимающая id пользователя.
+        workers: количество потоков.
+        rate: максимальное количество запусков функции в секунду. Если None, без ограничения.
+
+    Returns:
+        Отчет о выполнении. Словарь формата {'time', 'user_count', 'error_count'}
+        time: время в секундах, потребовавшиеся для обработки всех пользователей.
+        user_count: количество пользователей.
+        error_count: количество пользователей, для которых функция завершилась с ошибкой.
+    '''
+    start_time = time.time()
+    limiter = RateLimiter(rate) if rate is not None else None
+
+    def job(user_id):
+        if limiter is not None:
+            limiter.wait()
+        return func(user_id)
+
+    error_count = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(job, user_id): user_id for user_id in users_id}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                error_count += 1
+                logger.exception(
+                    f'{func.__name__} failed for user {futures[future]}')
+
+    return {'time': time.time() - start_time, 'user_count': len(users_id), 'error_count': error_count}
+
+
+def precompute_forecasts(manager, months=1, workers=4, rate=5):
+    '''Заранее рассчитывает прогноз /pred по умолчанию для активных пользователей и сохраняет его в кэш прогнозов.
+    Активные пользователи - те же, кому отправляются ежедневные уведомления. Для шардированного менеджера - только пользователи его шарда.
+
+    Args:
+        manager: объект UserManager.
+        months: на сколько месяцев строить прогноз.
+        workers: количество потоков.
+        rate: максимальное количество пользователей, загружаемых из базы в секунду.
+
+    Returns:
+        Отчет о выполнении, см. run_for_users.
+    '''
+    def precompute_forecast(user_id):
+        manager.report_forecast(user_id, months)
+
+    users_id = [user_id for user_id in manager.db_engine.get_users_for_notifications()
+                if manager.is_own_user(user_id)]
+    report = run_for_users(users_id, precompute_forecast, workers, rate)
+    logger.info(f'precompute_forecasts: {report}')
+
+    return report
+
+
+def refit_degraded(manager, workers=2, rate=1, **kwargs):
+    '''Переобучает только те модели, точность которых упала, см. Accuracy.drift_report.
+    Перед проверкой сохраняет накопленные записи журнала точности.
+
+    Args:
+        manager: объект UserManager.
+        workers: количество потоков.
+        rate: максимальное количество переобучений в секунду.
+        kwargs: параметры Accuracy.drift_report.
+
+    Returns:
+        Отчет о выполнении, см. run_for_users.
+    '''
+    Accuracy.LOG.flush(manager.db_engine)
+    drift = Accuracy.drift_report(manager.db_engine, **kwargs)
+    users_id = [user_id for user_id in drift.loc[drift['drift'], 'user_id']
+                if manager.is_own_user(user_id)]
+
+    report = run_for_users(users_id, manager.fit_new_model, workers, rate)
+    logger.info(f'refit_degraded: {report}')
+    return report
+
+
+def select_for_retraining(candidates, min_new_events=30, new_share=.1, max_age_days=30, now=None):
+    '''Выбирает пользователей, модели которых нужно переобучить: по объему новых транзакций
+    с момента обучения последней модели и по возрасту модели.
+
+    Args:
+        candidates: датафрейм, см. DB_Engine.download_retrain_candidates.
+        min_new_events: минимальное количество новых транзакций для переобучения.
+        new_share: доля новых транзакций от обучающих, после которой модель переобучается,
+            если это больше min_new_events.
+        max_age_days: максимальный возраст модели в днях.
+        now: текущее время. Если None, pd.Timestamp.now().
+
+    Returns:
+        Датафрейм выбранных пользователей с колонками candidates и 'reason'. Сначала пользователи
+        без модели или с моделью неизвестного возраста, затем по убыванию количества новых транзакций.
+    '''
+    now = pd.Timestamp.now() if now is None else now
+    candidates = candidates.copy()
+
+    new_events = candidates['event_count'] - candidates['model_event_count']
+    threshold = (new_share * candidates['model_event_count']).clip(lower=min_new_events)
+    unknown = candidates['model_created_at'].isna() | candidates['model_event_count'].isna()
+    old = candidates['model_created_at'] < now - pd.Timedelta(days=max_age_days)
+    new_data = new_events >= threshold
+
+    candidates['new_events'] = new_events
+    candidates['reason'] = None
+    candidates.loc[old, 'reason'] = 'age'
+    candidates.loc[new_data, 'reason'] = 'new data'
+    candidates.loc[unknown, 'reason'] = 'unknown'
+
+    return candidates[unknown | old | new_data].sort_values(
+        ['new_events', 'user_id'], ascending=[False, True], na_position='first').reset_index(drop=True)
+
+
+class ModelUploader:
+    '''Копит обученные модели и сохраняет их пачками через DB_Engine.upload_models.
+    Модель пользователя заменяется только после сохранения, чтобы у нее была версия.
+    Если данные пользователя изменились после начала обучения, например модель уже обновлена через
+    User.update_model, обученная модель устарела и не сохраняется.
+
+    Attributes:
+        batch_size: количество моделей в одной пачке.
+        uploaded: сколько моделей сохранено.
+        skipped: сколько устаревших моделей пропущено.
+    '''
+
+    def __init__(self, db_engine, batch_size=20):
+        self.batch_size = batch_size
+        self.uploaded = 0
+        self.skipped = 0
+        self.__db_engine = db_engine
+        self.__batch = []
+        self.__lock = threading.Lock()
+
+    def add(self, user, sbs_model, report, data_version):
+        '''Добавляет модель в пачку.
+
+        Args:
+            data_version: user.data_version на момент начала обучения.
+        '''
+        with self.__lock:
+            self.__batch.append((user, sbs_model, report, data_version))
+            full = len(self.__batch) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.__lock:
+            batch, self.__batch = self.__batch, []
+        fresh = [item for item in batch if item[0].data_version == item[3]]
+        if len(fresh) < len(batch):
+            logger.info(f'ModelUploader: skipped {len(batch) - len(fresh)} outdated models')
+        if len(fresh) > 0:
+            self.__db_engine.upload_models([{
+                'user_id': user.id,
+                'model': sbs_model,
+                'event_count': report['event_count'],
+                'ml_event_count': report['ml_event_count'],
+            } for user, sbs_model, report, _ in fresh])
+            for user, sbs_model, _, data_version in fresh:
+                # Данные могли измениться, пока пачка сохранялась
+                if user.data_version == data_version:
+                    user.set_model(sbs_model)
+
+        with self.__lock:
+            self.uploaded += len(fresh)
+            self.skipped += len(batch) - len(fresh)
+
+
+def retrain_models(manager, workers=1, rate=1, batch_size=20, **kwargs):
+    '''Переобучает в фоне модели пользователей, выбранных select_for_retraining.
+    Пул потоков небольшой и ограничен по частоте, чтобы не мешать обработке сообщений.
+    Пользователи из кэша менеджера сразу получают новую модель, остальные загружаются временно и в кэш не попадают.
+
+    Args:
+        manager: объект UserManager или StandaloneManager.
+        workers: количество потоков.
+        rate: максимальное количество переобучений в секунду.
+        batch_size: количество моделей, сохраняемых одним запросом.
+        kwargs: параметры select_for_retraining.
+
+    Returns:
+        Отчет о выполнении, см. run_for_users, с дополнительными ключами 'uploaded' - количеством сохраненных моделей,
+        'skipped' - количеством устаревших моделей, см. ModelUploader, и 'not_enough_history' - количеством
+        пользователей, истории которых пока не хватает для обучения.
+    '''
+    candidates = select_for_retraining(
+        manager.db_engine.download_retrain_candidates(), **kwargs)
+    users_id = [user_id for user_id in candidates['user_id']
+                if manager.is_own_user(user_id)]
+    uploader = ModelUploader(manager.db_engine, batch_size)
+    not_enough_history = []
+
+    def retrain_model(user_id):
+        user = manager.user_dict.get(user_id)
+        if user is None:
+            user = User(user_id, manager.db_engine)
+        if not user.enough_history():
+            not_enough_history.append(user_id)
+            return
+        data_version = user.data_version
+        sbs_model, report = user.train_model()
+        uploader.add(user, sbs_model, report, data_version)
+
+    report = run_for_users(users_id, retrain_model, workers, rate)
+    uploader.flush()
+    report['uploaded'] = uploader.uploaded
+    report['skipped'] = uploader.skipped
+    report['not_enough_history'] = len(not_enough_history)
+    logger.info(f'retrain_models: {report}')
+
+    return report
+
+
+class StandaloneManager:
+    '''Минимальная замена UserManager для запуска переобучения отдельным процессом, без бота и кэша пользователей.'''
+
+    def __init__(self, db_engine):
+        self.db_engine = db_engine
+        self.user_dict = {}
+
+    def is_own_user(self, user_id):
+        return True
+
+
+if __name__ == '__main__':
+    # Отдельный процесс переобучения моделей: python Scheduler.py retrain [интервал в минутах]
+    # Без интервала выполняется один проход.
+    logging.basicConfig(format='%(asctime)-12s - %(name)-12s - %(levelname)-8s - %(message)s',
+                        level=logging.INFO)
+    if len(sys.argv) < 2 or sys.argv[1] != 'retrain':
+        print('Usage: python Scheduler.py retrain [interval_minutes]')
+        sys.exit(1)
+
+    # Процесс работает с пониженным приоритетом, чтобы не отнимать процессор у бота
+    os.nice(10)
+    with open('./settings.np.json') as f:
+        settings = json.load(f)
+    manager = StandaloneManager(dl.DB_Engine(**settings['db_connector']))
+    interval = float(sys.argv[2]) * 60 if len(sys.argv) > 2 else None
+
+    while True:
+        retrain_models(manager, workers=2, rate=None)
+        if interval is None:
+            break
+        time.sleep(interval)
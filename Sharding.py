@@ -0,0 +1,323 @@
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(user_id, shards):
+    '''Возвращает номер шарда пользователя. Все обновления одного пользователя попадают в один шард.
+
+    Args:
+        user_id: id пользователя.
+        shards: количество шардов.
+
+    Returns:
+        Номер шарда от 0 до shards - 1.
+    '''
+    return int(user_id) % shards
+
+
+def get_update_user_id(update):
+    '''Находит id пользователя в обновлении Telegram.
+    Для нажатий на клавиатуру используется id чата, как и в bot.keyboard_callback.
+
+    Args:
+        update: обновление в виде словаря, см. telegram.Update.to_dict.
+
+    Returns:
+        id пользователя или None, если обновление не относится к пользователю.
+    '''
+    if 'callback_query' in update:
+        return update['callback_query']['message']['chat']['id']
+
+    for key in ('message', 'edited_message'):
+        if key in update and 'from' in update[key]:
+            return update[key]['from']['id']
+
+    return None
+
+
+def worker_loop(shard, shards, updates_queue, reports_queue, handler_factory):
+    '''Основной цикл процесса шарда: обрабатывает обновления из очереди до получения None.
+
+    Args:
+        shard: номер шарда.
+        shards: количество шардов.
+        updates_queue: очередь обновлений этого шарда.
+        reports_queue: очередь, в которую отправляется номер шарда после готовности и отчет о работе шарда после остановки.
+        handler_factory: вызываемый объект, принимающий (shard, shards) и возвращающий функцию обработки обновления.
+    '''
+    handler = handler_factory(shard, shards)
+    reports_queue.put(shard)
+    start_time = time.time()
+    processed = 0
+    error_count = 0
+    users = set()
+
+    while True:
+        update = updates_queue.get()
+        if update is None:
+            break
+
+        try:
+            handler(update)
+        except Exception:
+            error_count += 1
+            logger.exception(f'Shard {shard} failed to process update')
+        processed += 1
+        users.add(get_update_user_id(update))
+
+    reports_queue.put({
+        'shard': shard,
+        'time': time.time() - start_time,
+        'processed': processed,
+        'error_count': error_count,
+        'users': users - {None},
+    })
+
+
+class ShardRouter:
+    '''Распределяет обновления по процессам-шардам по id пользователя.
+    У каждого шарда своя очередь и свое состояние, поэтому обновления одного пользователя
+    обрабатываются последовательно одним процессом.
+
+    Attributes:
+        shards: количество шардов.
+        routed: количество обновлений, отправленных в каждый шард.
+    '''
+
+    def __init__(self, handler_factory, shards=None, queue_size=1000):
+        '''
+        Args:
+            handler_factory: вызываемый объект, принимающий (shard, shards) и возвращающий функцию обработки обновления.
+                Создается в процессе шарда, поэтому должен поддерживать pickle.
+            shards: количество шардов. Если None, по количеству ядер.
+            queue_size: максимальный размер очереди шарда. При заполнении route блокируется.
+        '''
+        self.shards = shards or os.cpu_count()
+        self.routed = [0] * self.shards
+        self.__handler_factory = handler_factory
+        self.__queue_size = queue_size
+        self.__context = multiprocessing.get_context('spawn')
+        self.__queues = []
+        self.__processes = []
+        self.__reports_queue = None
+
+    def start(self):
+        '''Запускает процессы шардов и ждет, пока все они будут готовы к обработке.'''
+        self.__reports_queue = self.__context.Queue()
+        self.__queues = [self.__context.Queue(self.__queue_size)
+                         for _ in range(self.shards)]
+        self.__processes = [self.__context.Process(
+            target=worker_loop,
+            args=(shard, self.shards, self.__queues[shard],
+                  self.__reports_queue, self.__handler_factory),
+            name=f'shard-{shard}',
+            daemon=True
+        ) for shard in range(self.shards)]
+
+        for process in self.__processes:
+            process.start()
+        for _ in self.__processes:
+            self.__reports_queue.get()
+
+    def route(self, update):
+        '''Отправляет обновление в шард его пользователя. Обновления без пользователя уходят в шард 0.
+
+        Args:
+            update: обновление в виде словаря, см. telegram.Update.to_dict.
+
+        Returns:
+            Номер шарда.
+        '''
+        user_id = get_update_user_id(update)
+        shard = shard_of(user_id, self.shards) if user_id is not None else 0
+        self.__queues[shard].put(update)
+        self.routed[shard] += 1
+        return shard
+
+    def stop(self, timeout=None):
+        '''Останавливает шарды после обработки уже отправленных обновлений.
+
+        Args:
+            timeout: сколько секунд ждать отчет каждого шарда.
+
+        Returns:
+            Список отчетов шардов, отсортированный по номеру шарда.
+            Словари формата {'shard', 'time', 'processed', 'error_count', 'users'}.
+        '''
+        for updates_queue in self.__queues:
+            updates_queue.put(None)
+
+        reports = []
+        for _ in self.__processes:
+            try:
+                reports.append(self.__reports_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        for process in self.__processes:
+            process.join(timeout)
+
+        return sorted(reports, key=lambda r: r['shard'])
+
+
+class BotHandler:
+    '''Фабрика обработчика обновлений для процесса шарда: свой Dispatcher, JobQueue и UserManager шарда.'''
+
+    def __init__(self, token, db_settings, settings=None):
+        self.token = token
+        self.db_settings = db_settings
+        self.settings = settings or {}
+
+    def __call__(self, shard, shards):
+        from telegram import Bot, Update
+        from telegram.ext import Dispatcher, JobQueue
+        import Handlers
+
+        telegram_bot = Bot(self.token)
+        job_queue = JobQueue()
+        dispatcher = Dispatcher(
+            telegram_bot, queue.Queue(), workers=0, job_queue=job_queue)
+        job_queue.set_dispatcher(dispatcher)
+
+        Handlers.setup(dispatcher, job_queue, telegram_bot, self.db_settings, self.settings, shard=(shard, shards))
+        job_queue.start()
+
+        def handle(update):
+            dispatcher.process_update(Update.de_json(update, telegram_bot))
+
+        return handle
+
+
+def run_sharded(token, db_settings, shards=None, poll_timeout=30, settings=None):
+    '''Запускает бота в режиме шардов: текущий процесс получает обновления long polling
+    и распределяет их по процессам-шардам.
+
+    Args:
+        token: токен бота.
+        db_settings: параметры подключения к базе данных.
+        shards: количество шардов. Если None, по количеству ядер.
+        poll_timeout: таймаут long polling в секундах.
+        settings: словарь настроек бота для обработчиков, см. Handlers.setup.
+    '''
+    from telegram import Bot
+    from telegram.error import NetworkError
+
+    router = ShardRouter(BotHandler(token, db_settings, settings), shards)
+    router.start()
+    telegram_bot = Bot(token)
+    offset = None
+
+    try:
+        while True:
+            try:
+                updates = telegram_bot.get_updates(
+                    offset=offset, timeout=poll_timeout)
+            except NetworkError:
+                logger.exception('get_updates failed')
+                time.sleep(1)
+                continue
+
+            for update in updates:
+                router.route(update.to_dict())
+                offset = update.update_id + 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info(f'Sharded bot stopped: {router.stop(timeout=60)}')
+
+
+def fake_updates(user_count, update_count, text='/ping', random_state=None):
+    '''Генерирует обновления Telegram с текстовыми сообщениями от случайных пользователей.
+
+    Args:
+        user_count: количество пользователей.
+        update_count: количество обновлений.
+        text: текст сообщений.
+        random_state: seed генератора случайных чисел.
+
+    Returns:
+        Генератор обновлений в виде словарей.
+    '''
+    rng = random.Random(random_state)
+    for update_id in range(update_count):
+        user_id = rng.randint(1, user_count)
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+        yield {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': user,
+                'text': text,
+            }
+        }
+
+
+class FakeHandler:
+    '''Фабрика обработчика для проверки шардов без Telegram и базы.
+    Каждое обновление нагружает процессор и считает сообщения пользователя в состоянии шарда.
+    '''
+
+    def __init__(self, work=20000):
+        self.work = work
+
+    def __call__(self, shard, shards):
+        counters = {}
+
+        def handle(update):
+            user_id = get_update_user_id(update)
+            if shard_of(user_id, shards) != shard:
+                raise Exception(
+                    f'User {user_id} was routed to the wrong shard {shard}')
+            counters[user_id] = counters.get(user_id, 0) + 1
+            sum(i * i for i in range(self.work))
+
+        return handle
+
+
+def benchmark(shards_list=(1, 2, 4), user_count=100, update_count=2000, work=20000):
+    '''Замеряет пропускную способность шардов на фиктивных обновлениях.
+
+    Args:
+        shards_list: варианты количества шардов.
+        user_count: количество пользователей.
+        update_count: количество обновлений.
+        work: нагрузка на процессор при обработке одного обновления.
+
+    Returns:
+        Список словарей формата {'shards', 'time', 'updates_per_s', 'error_count', 'user_overlap'}
+        user_overlap: количество пользователей, обработанных больше чем одним шардом. Должно быть 0.
+    '''
+    result = []
+    for shards in shards_list:
+        router = ShardRouter(FakeHandler(work), shards)
+        router.start()
+        start_time = time.time()
+        for update in fake_updates(user_count, update_count, random_state=0):
+            router.route(update)
+        reports = router.stop()
+        time_passed = time.time() - start_time
+
+        all_users = [u for r in reports for u in r['users']]
+        result.append({
+            'shards': shards,
+            'time': time_passed,
+            'updates_per_s': update_count / time_passed,
+            'error_count': sum(r['error_count'] for r in reports),
+            'user_overlap': len(all_users) - len(set(all_users)),
+        })
+
+    return result
+
+
+if __name__ == '__main__':
+    for row in benchmark():
+        print(row)
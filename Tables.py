@@ -0,0 +1,200 @@
+import collections
+import threading
+import numpy as np
+import pandas as pd
+
+
+# Максимальная длина сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+DATE_COLUMNS = ['date', 'start_date', 'end_date']
+AMOUNT_COLUMNS = ['amount', 'credit_limit']
+
+
+def escape_html(values):
+    '''Экранирует символы HTML во всей серии строк.'''
+    return values.str.replace('&', '&amp;', regex=False).str.replace(
+        '<', '&lt;', regex=False).str.replace('>', '&gt;', regex=False)
+
+
+def format_column(values, column):
+    '''Форматирует колонку целиком, без функций на каждую ячейку.
+
+    Args:
+        values: серия значений.
+        column: название колонки, по нему выбирается формат.
+
+    Returns:
+        Серия строк с тем же индексом.
+    '''
+    # У пустой серии после форматирования числовой тип, а не строки
+    if len(values) == 0:
+        return pd.Series([], index=values.index, dtype=object)
+
+    if column in DATE_COLUMNS or pd.api.types.is_datetime64_any_dtype(values):
+        return pd.to_datetime(values).dt.strftime('%d.%m.%Y').fillna('NaT')
+
+    if column in AMOUNT_COLUMNS:
+        result = np.char.mod('%.2f', values.astype(float).values)
+        return pd.Series(result, index=values.index, dtype=object).where(values.notna(), 'NaN')
+
+    return escape_html(values.astype(str))
+
+
+def format_lines(data, columns):
+    '''Форматирует датафрейм в строки с выравниванием, как DataFrame.to_string.
+
+    Args:
+        data: датафрейм.
+        columns: выводимые колонки.
+
+    Returns:
+        Кортеж (header, lines): строка заголовка и список строк таблицы.
+    '''
+    index = pd.Series(data.index.astype(str), index=data.index)
+    index_width = index.str.len().max() if len(index) > 0 else 0
+    header = ' ' * index_width
+    lines = index.str.ljust(index_width)
+
+    for column in columns:
+        values = format_column(data[column], column)
+        width = max(len(column), values.str.len().max()
+                    if len(values) > 0 else 0)
+        header += '  ' + column.rjust(width)
+        # Индекс может повторяться, например даты событий, поэтому складываются массивы, а не серии
+        lines = lines + '  ' + values.str.rjust(width).values
+
+    return header, lines.tolist()
+
+
+def paginate(title, header, lines, limit=MESSAGE_LIMIT):
+    '''Разбивает строки таблицы на страницы, каждая из которых помещается в одно сообщение.
+
+    Args:
+        title: заголовок, который повторяется на каждой странице.
+        header: строка заголовка таблицы.
+        lines: строки таблицы.
+        limit: максимальная длина страницы.
+
+    Returns:
+        Список страниц. Хотя бы одна страница, даже для пустой таблицы.
+    '''
+    prefix = f'{title}<pre>{header}'
+    suffix = '</pre>'
+    available = limit - len(prefix) - len(suffix)
+
+    pages = []
+    page = []
+    page_length = 0
+    for line in lines:
+        line = line[:available - 1]
+        if page and page_length + len(line) + 1 > available:
+            pages.append(page)
+            page, page_length = [], 0
+        page.append(line)
+        page_length += len(line) + 1
+    pages.append(page)
+
+    return [prefix + ''.join('\n' + line for line in page) + suffix for page in pages]
+
+
+def render_row(title, data, index, columns):
+    '''Выводит одну строку датафрейма в виде списка "колонка значение".
+
+    Args:
+        title: заголовок.
+        data: датафрейм.
+        index: индекс строки.
+        columns: выводимые колонки.
+
+    Returns:
+        Текст сообщения.
+    '''
+    row = data.loc[[index], columns]
+    width = max(len(column) for column in columns)
+    lines = [f'{column.ljust(width)}  {format_column(row[column], column).iloc[0]}'
+             for column in columns]
+    return f'{title}<pre>' + '\n'.join(lines) + '</pre>'
+
+
+class TableCache:
+    '''Ограниченный кэш отрендеренных страниц таблиц. Вытесняются давно не использованные таблицы.
+
+    Attributes:
+        hits: количество попаданий в кэш.
+        misses: количество промахов.
+    '''
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            if key in self.__entries:
+                self.hits += 1
+                self.__entries.move_to_end(key)
+                return self.__entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self.__lock:
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+
+CACHE = TableCache()
+
+
+def render_pages(title, data, columns, cache_key=None, limit=MESSAGE_LIMIT):
+    '''Форматирует таблицу и разбивает ее на страницы.
+
+    Args:
+        title: заголовок каждой страницы.
+        data: датафрейм.
+        columns: выводимые колонки.
+        cache_key: ключ кэша, должен включать версию данных, например (id пользователя, таблица, data_version).
+            Если None, результат не кэшируется.
+        limit: максимальная длина страницы.
+
+    Returns:
+        Список страниц.
+    '''
+    key = (cache_key, title, tuple(columns), limit)
+    if cache_key is not None:
+        pages = CACHE.get(key)
+        if pages is not None:
+            return pages
+
+    header, lines = format_lines(data, columns)
+    pages = paginate(title, header, lines, limit)
+
+    if cache_key is not None:
+        CACHE.set(key, pages)
+    return pages
+
+
+if __name__ == '__main__':
+    # Проверка рендера: обычная таблица, пустая таблица и таблица на несколько страниц
+    table = pd.DataFrame({
+        'date': pd.to_datetime(['2022-01-01', '2022-01-02']),
+        'amount': [-100.5, None],
+        'description': ['<Кофе>', 'Такси'],
+    })
+    pages = render_pages('Таблица\n', table, ['date', 'amount', 'description'])
+    assert len(pages) == 1 and '&lt;Кофе&gt;' in pages[0] and 'NaN' in pages[0], pages
+
+    empty = table.iloc[0:0]
+    pages = render_pages('Пустая таблица\n', empty, ['date', 'amount', 'description'])
+    assert len(pages) == 1 and pages[0].endswith('</pre>'), pages
+
+    long_table = pd.concat([table] * 500, ignore_index=True)
+    pages = render_pages('Длинная таблица\n', long_table, ['date', 'amount', 'description'])
+    assert len(pages) > 1 and all(len(page) <= MESSAGE_LIMIT for page in pages)
+    print(f'OK, {len(pages)} pages')
@@ -5,6 +5,8 @@ import numpy as np
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
 import ML as ml
+import Forecast as fc
+import Discovery
 
 
 class User:
@@ -12,28 +14,246 @@ class User:
 
     Attributes:
         id: id пользователя.
-        transactions: список транзакций.
+        transactions: список транзакций. Загружаются только транзакции начиная с history_start, см. get_transactions.
+        history_start: дата, с которой загружены транзакции. None, если загружена вся история.
+        history_days: за сколько последних дней транзакции хранятся в transactions.
         sbs_model: список моделей, под каждую фичу, для прогноза транзакций для этого пользователя.
         regular_list: список регулярных транзакций.
         onetime_transactions: список разовых транзакций. 
+        daily_aggregates: ежедневные расходы, доходы и баланс на конец дня по каждому счету.
         predicted_events: рассчитанные регулярные и разовые транзакции до указанной даты.
         predicted_transactions: прогноз транзакций до указанной даты.
+        predicted_balances: прогноз баланса по каждому счету, колонки - id счетов.
+        data_version: номер версии данных. Увеличивается при любом изменении данных пользователя или его модели.
     '''
 
-    def __init__(self, id, db_engine):
+    def __init__(self, id, db_engine, history_days=400):
         '''Загружает всю информацию из базы данных
 
         Args:
             db_engine: объект для работы с базой данных.
+            history_days: за сколько последних дней сразу загружать транзакции. Для прогноза достаточно
+                самого длинного сдвига и скользящего среднего признаков, а за год находятся последние платежи
+                регулярных событий. Более старая история догружается, только когда она нужна. Если None, загружается вся история.
         '''
 
         self.id = id
 
-        self.transactions = db_engine.download_transactions(self.id)
+        self.history_days = history_days
+        self.history_start = None if history_days is None else pd.Timestamp(
+            date.today() - relativedelta(days=history_days))
+        self.transactions = db_engine.download_transactions(
+            self.id, self.history_start)
         self.sbs_model = db_engine.download_last_model(self.id)
         self.regular_list = db_engine.download_regular(self.id)
         self.onetime_transactions = db_engine.download_onetime(self.id)
         self.accounts = db_engine.download_accounts(self.id)
+        self.daily_aggregates = db_engine.download_daily_aggregates(self.id)
+
+        self.data_version = 0
+        self.__db_engine = db_engine
+        self.__preprocessing_cache = {}
+        self.__category_model = None
+        self.__discovered = None
+        self.__watermarks = {table: self.__get_watermark(getattr(self, attribute))
+                             for table, attribute in self.__refresh_tables.items()}
+
+        # Агрегаты еще не рассчитывались для этого пользователя
+        if self.daily_aggregates.empty:
+            history = self.get_transactions()
+            for account_id in history['account_id'].unique():
+                self.__update_daily_aggregates(
+                    db_engine, account_id, transactions=history)
+
+    # Таблица в базе: (атрибут пользователя, колонка сортировки)
+    __refresh_tables = {
+        'transactions': 'transactions',
+        'regular': 'regular_list',
+        'onetime': 'onetime_transactions',
+        'accounts': 'accounts',
+    }
+    __refresh_sort = {
+        'transactions': 'date',
+        'regular': 'start_date',
+        'onetime': 'date',
+        'accounts': 'db_id',
+    }
+
+    def refresh(self, db_engine):
+        '''Догружает из базы только строки, добавленные или измененные после последней загрузки.
+        Удаленные в базе строки убираются из данных пользователя.
+
+        Args:
+            db_engine: объект для работы с базой данных.
+
+        Returns:
+            Словарь {таблица: количество измененных строк}. 'sbs_models' равно 1, если загружена новая модель.
+        '''
+        # Догруженная при загрузке файла старая история больше не нужна
+        self.reset_history()
+
+        result = {}
+        changed_transactions = None
+
+        for table, attribute in self.__refresh_tables.items():
+            last_id, last_updated = self.__watermarks[table]
+            changes = db_engine.download_changes(
+                table, self.id, last_id, last_updated)
+            self.__watermarks[table] = self.__get_watermark(
+                changes, self.__watermarks[table])
+
+            data = getattr(self, attribute)
+            if not changes.empty and 'updated_at' in data.columns:
+                # Строки в пределах запаса DataLoader.CHANGES_LAG приходят повторно, уже известные версии строк пропускаются
+                known = pd.MultiIndex.from_frame(data[['db_id', 'updated_at']].dropna())
+                changes = changes[~pd.MultiIndex.from_frame(
+                    changes[['db_id', 'updated_at']]).isin(known)]
+            result[table] = len(changes)
+            if changes.empty:
+                continue
+
+            data = data[~data['db_id'].isin(changes['db_id'])]
+            new_rows = changes[~changes['is_del']
+                               ] if 'is_del' in changes.columns else changes
+            if table == 'transactions' and self.history_start is not None:
+                # Строки старше загруженного окна догрузятся из базы вместе с остальной историей
+                new_rows = new_rows[new_rows['date'] >= self.history_start]
+            if 'is_new' in data.columns:
+                new_rows = new_rows.assign(is_new=False)
+
+            data = pd.concat([data, new_rows]).sort_values(
+                self.__refresh_sort[table], kind='stable').reset_index(drop=True)
+            setattr(self, attribute, data)
+
+            if table == 'transactions':
+                changed_transactions = changes
+
+        if changed_transactions is not None:
+            # Агрегаты пересчитываются только с первой измененной даты каждого счета
+            start_dates = changed_transactions.groupby('account_id')[
+                'date'].min()
+            for account_id, start_date in start_dates.items():
+                self.__update_daily_aggregates(
+                    db_engine, account_id, start_date)
+
+        # Правила категорий могли быть изменены в базе напрямую, новые правила применятся к следующей загрузке
+        db_engine.refresh_category_rules(self.id)
+
+        # Модель могла быть переобучена в другом процессе, см. Scheduler.retrain_models
+        version_id = db_engine.get_last_model_version(self.id)
+        result['sbs_models'] = 0
+        if version_id is not None and version_id != getattr(self.sbs_model, 'version_id', None):
+            self.sbs_model = db_engine.download_last_model(self.id)
+            result['sbs_models'] = 1
+
+        if sum(result.values()) > 0:
+            self.data_version += 1
+
+        return result
+
+    def load_history(self, start_date=None):
+        '''Догружает из базы транзакции старше уже загруженных. Загружается только недостающий диапазон дат.
+
+        Args:
+            start_date: дата, с которой нужна история. Если None, вся история.
+
+        Returns:
+            Количество догруженных транзакций.
+        '''
+        if self.history_start is None:
+            return 0
+        if start_date is not None:
+            start_date = pd.to_datetime(start_date).floor('D')
+            if start_date >= self.history_start:
+                return 0
+
+        older = self.__db_engine.download_transactions(
+            self.id, start_date, self.history_start)
+        self.history_start = start_date
+        if older.empty:
+            return 0
+
+        if 'is_new' in self.transactions.columns:
+            older['is_new'] = False
+        self.transactions = pd.concat(
+            [older, self.transactions]).reset_index(drop=True)
+        self.data_version += 1
+
+        return len(older)
+
+    def reset_history(self):
+        '''Убирает из transactions транзакции старше history_days последних дней, догруженные load_history.
+
+        Returns:
+            Количество убранных транзакций.
+        '''
+        if self.history_days is None:
+            return 0
+        window_start = pd.Timestamp(
+            date.today() - relativedelta(days=self.history_days))
+        if self.history_start is not None and self.history_start >= window_start:
+            return 0
+
+        keep = self.transactions['date'] >= window_start
+        self.history_start = window_start
+        if keep.all():
+            return 0
+
+        self.transactions = self.transactions[keep].reset_index(drop=True)
+        self.data_version += 1
+        return int((~keep).sum())
+
+    def get_transactions(self, start_date=None):
+        '''Возвращает транзакции начиная со start_date. Недостающая старая история загружается из базы
+        в возвращаемый датафрейм, но не сохраняется в transactions, чтобы память пользователя оставалась ограниченной.
+
+        Args:
+            start_date: первая дата. Если None, вся история.
+        '''
+        if start_date is not None:
+            start_date = pd.to_datetime(start_date).floor('D')
+
+        data = self.transactions
+        if self.history_start is not None and (start_date is None or start_date < self.history_start):
+            older = self.__db_engine.download_transactions(
+                self.id, start_date, self.history_start)
+            if not older.empty:
+                if 'is_new' in data.columns:
+                    older['is_new'] = False
+                data = pd.concat([older, data]).reset_index(drop=True)
+
+        if start_date is None:
+            return data
+        return data[data['date'] >= start_date]
+
+    def recategorize(self, db_engine):
+        '''Применяет текущие правила категорий ко всей истории транзакций и сохраняет изменившиеся категории.
+
+        Args:
+            db_engine: объект для работы с базой данных.
+
+        Returns:
+            Количество транзакций, у которых изменилась категория.
+        '''
+        history = self.get_transactions()
+        recategorized = db_engine.get_category_rules(
+            self.id).apply(history)
+        # Пропущенная категория, оставшаяся пропущенной, не считается изменением
+        changed = (recategorized['category'] != history['category']) & ~(
+            recategorized['category'].isna() & history['category'].isna())
+        if not changed.any():
+            return 0
+
+        db_engine.update_categories(recategorized.loc[changed].set_index('db_id')['category'])
+        # Старая история возвращается первой, в памяти остаются только уже загруженные транзакции
+        self.transactions = recategorized.iloc[len(
+            recategorized) - len(self.transactions):].reset_index(drop=True)
+        if self.sbs_model is not None:
+            # Категории влияют на разметку регулярных событий, а update_model сверяет только последние дни
+            self.sbs_model.statistics = None
+        self.data_version += 1
+
+        return int(changed.sum())
 
     def load_from_file(self, db_engine, file_full_name, account_id, new_balance, ):
         '''Загружает, обрабатывает и сохраняет транзакции из файла. Соединяет новую информацию из файла с транзакциями сохраненными в базу до этого
@@ -79,6 +299,18 @@ class User:
 
         return self.predicted_events
 
+    def get_daily_balance(self, start_date=None, end_date=None):
+        '''Возвращает ежедневный временной ряд по всем счетам, построенный по ежедневным агрегатам.
+
+        Args:
+            start_date: дата начала ряда. Если None, с первой транзакции.
+            end_date: дата конца ряда. Если None, до последней транзакции.
+
+        Returns:
+            Датафрейм с колонками ['spend', 'income', 'balance']
+        '''
+        return ml.daily_balance(self.daily_aggregates, start_date, end_date)
+
     def get_comparison_data(self):
         '''Создаст датафрейм прогнозируемого и фактического баланса, полученного из добавленных в базу транзакций.
         Необходим для сравнения прогнозов с фактическими расходами и доходами.
@@ -86,32 +318,37 @@ class User:
         Returns:
             Датафрейм с колонками ['reab_b', 'predicted_b']
         '''
-        is_new = self.transactions[self.transactions['is_new']]
         not_new = self.transactions[~self.transactions['is_new']]
+        data = self.__preprocessing_for_ml(not_new, cache_key='not_new')
+        if self.history_start is not None and not ml.enough_history(data, self.sbs_model.list_mf_rules):
+            # В окне history_days нет истории до новых транзакций, например если пользователь долго не загружал выписки.
+            # Догруженная история убирается при следующем refresh
+            self.load_history()
+            not_new = self.transactions[~self.transactions['is_new']]
+            data = self.__preprocessing_for_ml(not_new, cache_key='not_new')
+        is_new = self.transactions[self.transactions['is_new']]
 
         start_date = pd.to_datetime(not_new.tail(1)['date'].values[0])
         end_date = pd.to_datetime(is_new.tail(1)['date'].values[0])
 
         predicted_events = self.predict_events(start_date, end_date)
 
-        data = self.__preprocessing_for_ml(not_new)
-
         predicted_transactions = self.sbs_model.predict(
             data, end_date).to_frame()
 
+        daily_balance = self.get_daily_balance(end_date=end_date)['balance']
+        previous_balance = daily_balance[:start_date]
+
         merged_transactions = self.__merge_of_predicts(
-            predicted_events, predicted_transactions, not_new['balance'].iloc[-1])
+            predicted_events, predicted_transactions, start_date)
 
         merged_transactions = merged_transactions[['balance']]
         merged_transactions.columns = ['predicted_b']
 
-        real_full_transactions = is_new.set_index(
-            'date')[['balance']].resample('1D').last()
-        real_full_transactions.columns = ['reab_b']
+        real_full_transactions = daily_balance[start_date.floor(
+            'D') + relativedelta(days=1):].to_frame('reab_b')
 
-        previous_week = not_new.set_index(
-            'date')[['balance']].resample('1D').last().tail(7)
-        previous_week.columns = ['reab_b']
+        previous_week = previous_balance.tail(7).to_frame('reab_b')
         previous_week['predicted_b'] = previous_week['reab_b']
 
         comparison = pd.concat([
@@ -126,6 +363,29 @@ class User:
 
         return comparison
 
+    def get_accuracy_records(self, comparison):
+        '''Превращает результат get_comparison_data в записи журнала точности прогноза, см. Accuracy.
+
+        Args:
+            comparison: датафрейм с колонками ['reab_b', 'predicted_b'].
+
+        Returns:
+            Датафрейм с колонками ['user_id', 'model_version', 'date', 'horizon', 'real_b', 'predicted_b'],
+            по одной строке на каждый спрогнозированный день. horizon - номер дня прогноза, начиная с 1.
+        '''
+        not_new = self.transactions[~self.transactions['is_new']]
+        start_date = pd.to_datetime(not_new['date'].max()).floor('D')
+        data = comparison[comparison.index > start_date].dropna()
+
+        return pd.DataFrame({
+            'user_id': self.id,
+            'model_version': getattr(self.sbs_model, 'version_id', None),
+            'date': data.index.date,
+            'horizon': (data.index - start_date).days,
+            'real_b': data['reab_b'].astype(float).values,
+            'predicted_b': data['predicted_b'].astype(float).values,
+        })
+
     def predict_full(self, end_date):
         '''Прогнозирует транзакции. Регулярные и предсказанные транзакции складываются.
 
@@ -133,13 +393,79 @@ class User:
             end_date: дата до которой строить прогноз.
 
         Returns:
-            Датафрейм транзакций с колонками ['amount', 'balance']
+            Датафрейм транзакций с колонками ['amount', 'balance'], где balance - общий баланс по всем счетам.
+            Баланс по каждому счету сохраняется в predicted_balances.
         '''
-        data = self.__preprocessing_for_ml(self.transactions)
         self.predicted_transactions = self.sbs_model.predict(
-            data, end_date).to_frame()
+            self.__model_data(), end_date).to_frame()
+
+        return self.__merge_of_predicts(self.predicted_events, self.predicted_transactions)
 
-        return self.__merge_of_predicts(self.predicted_events, self.predicted_transactions, self.transactions['balance'].iloc[-1])
+    def predict_categories(self, end_date, top_k=8):
+        '''Прогнозирует расходы модели по категориям. Ряды top_k категорий прогнозируются вместе одной моделью
+        CategoryModel и согласуются с прогнозом общих расходов модели sbs_model.
+
+        Args:
+            end_date: дата до которой строить прогноз.
+            top_k: количество категорий с наибольшими расходами, остальные объединяются в одну.
+
+        Returns:
+            Датафрейм прогноза с ежедневным индексом, колонки - категории.
+        '''
+        key = (self.data_version, top_k)
+        if self.__category_model is None or self.__category_model[0] != key:
+            history = ml.category_matrix(
+                self.transactions, self.regular_list, top_k)
+            self.__category_model = (
+                key, history, ml.CategoryModel().fit(history))
+        _, history, model = self.__category_model
+
+        total = self.sbs_model.predict(self.__model_data(), end_date)
+        if history.empty:
+            return pd.DataFrame([], index=total.index)
+        shares = history.sum() / history.values.sum()
+
+        return ml.reconcile_categories(model.predict(history, end_date), total, shares)
+
+    def predict_bands(self, before_date=None, n_paths=2000):
+        '''Строит вероятностный прогноз общего баланса, на основе последнего прогноза predict_full.
+
+        Args:
+            before_date: дата, до которой считать вероятность опуститься ниже нуля. Если None, весь прогноз.
+            n_paths: количество симулируемых траекторий.
+
+        Returns:
+            Словарь формата {'bands', 'p_below_zero'}
+            bands: датафрейм перцентилей баланса, колонки 'p5', 'p25', 'p50', 'p75', 'p95'.
+            p_below_zero: вероятность того, что баланс опустится ниже нуля до before_date.
+        '''
+        residuals = getattr(self.sbs_model, 'residuals', None)
+        if residuals is None:
+            # Модель обучена до появления остатков в SbsModel или дообучена через partial_fit
+            residuals = self.sbs_model.get_residuals(self.__model_data())
+            self.sbs_model.residuals = residuals
+
+        model_amounts = self.predicted_transactions['amount'].resample(
+            '1D').sum()
+        event_amounts = self.predicted_events.set_index('date')['amount'].resample(
+            '1D').sum()
+        index = model_amounts.index.union(event_amounts.index)
+        index = pd.date_range(index.min(), index.max(), freq='D')
+        model_amounts = model_amounts.reindex(index, fill_value=0)
+        event_amounts = event_amounts.reindex(index, fill_value=0)
+
+        bands, paths = fc.simulate_balance(
+            model_amounts,
+            event_amounts,
+            self.get_daily_balance()['balance'].iloc[-1],
+            residuals[self.sbs_model.target_column],
+            n_paths
+        )
+
+        return {
+            'bands': bands,
+            'p_below_zero': fc.probability_below(paths, bands.index, before_date)
+        }
 
     def fit_new_model(self, db_engine):
         '''Создает, учит и сохраняет модель для пользователя.
@@ -153,15 +479,117 @@ class User:
             event_count: всего событий в базе.
             ml_event_count: события участвующие в обучении модели.
         '''
+        sbs_model, report = self.train_model()
+        db_engine.upload_model(
+            self.id, sbs_model, event_count=report['event_count'], ml_event_count=report['ml_event_count'])
+        self.set_model(sbs_model)
+
+        return report
+
+    def train_model(self):
+        '''Обучает новую модель с параметрами текущей, не заменяя текущую.
+        Текущая модель может в это время использоваться для прогнозов, см. Scheduler.retrain_models.
+
+        Returns:
+            Кортеж (модель, отчет о обучении), отчет как у fit_new_model.
+        '''
+        start_time = time.time()
+        # Модель обучается на всей истории, которая загружается только на время обучения
+        transactions = self.get_transactions()
+        # Порог выбросов сохраняется с моделью, чтобы update_model строил новые дни ряда с ним же
+        threshold = ml.outlier_threshold(transactions, self.regular_list)
+        data = self.__preprocessing_for_ml(transactions, threshold=threshold)
+
+        parameters = self.__get_default_parameters(
+        ) if self.sbs_model is None else self.sbs_model.get_parameters()
+        sbs_model = ml.SbsModel(**parameters).fit(
+            data, source=(transactions, self.regular_list), threshold=threshold)
+
+        return sbs_model, {'time': time.time() - start_time, 'event_count': len(transactions), 'ml_event_count': len(data)}
+
+    def enough_history(self):
+        '''Проверяет, хватает ли истории для обучения модели, см. ml.enough_history. Если не хватает истории
+        в окне history_days, проверяется вся история.'''
+        list_mf_rules = self.__get_default_parameters(
+        )['list_mf_rules'] if self.sbs_model is None else self.sbs_model.list_mf_rules
+        data = self.__preprocessing_for_ml(
+            self.transactions, cache_key='transactions')
+        if ml.enough_history(data, list_mf_rules):
+            return True
+        if self.history_start is None:
+            return False
+        return ml.enough_history(self.__preprocessing_for_ml(self.get_transactions(), cache_key='history'), list_mf_rules)
+
+    def set_model(self, sbs_model):
+        '''Заменяет модель пользователя.'''
+        self.sbs_model = sbs_model
+        self.data_version += 1
+
+    def update_model(self, db_engine):
+        '''Дообучает модель пользователя на новых днях истории и сохраняет ее, см. SbsModel.partial_fit.
+        Загружается и сверяется только история начиная с SbsModel.partial_start или с самой старой новой транзакции.
+        Если модели еще нет или дообучить ее нельзя, обучает новую на всей истории.
+
+        Args:
+            db_engine: объект для работы с базой данных.
+
+        Returns:
+            Отчет о обучении модели, как у fit_new_model, с дополнительным ключом 'partial':
+            True, если модель дообучена, False, если выполнено полное обучение.
+            None, если модели нет, а истории для обучения пока недостаточно.
+        '''
+        if self.sbs_model is None:
+            if not self.enough_history():
+                return None
+            return dict(self.fit_new_model(db_engine), partial=False)
+
         start_time = time.time()
-        data = self.__preprocessing_for_ml(self.transactions)
+        start_date = self.sbs_model.partial_start()
+        partial = False
+        if start_date is not None:
+            is_new = self.transactions[self.transactions['is_new']] if 'is_new' in self.transactions.columns else \
+                self.transactions.iloc[:0]
+            if not is_new.empty:
+                # Новые транзакции за замороженные дни не совпадут с хэшами дней, и модель обучится заново
+                start_date = min(start_date, is_new['date'].min().floor('D'))
+            transactions = self.get_transactions(start_date)
+            data = self.__preprocessing_for_ml(
+                transactions, threshold=self.sbs_model.statistics['threshold'])
+            if not data.empty:
+                # Ряд должен начинаться ровно с start_date, даже если в первые дни не было расходов
+                data = data.reindex(pd.date_range(
+                    start_date, data.index[-1], freq='D'), fill_value=0)
+                partial = self.sbs_model.partial_fit(
+                    data, source=(transactions, self.regular_list), refit=False)
+
+        if partial:
+            event_count, ml_event_count = self.sbs_model.history_counts(
+                data, transactions)
+            self.data_version += 1
+            report = {'time': time.time() - start_time,
+                      'event_count': event_count, 'ml_event_count': ml_event_count}
+        else:
+            sbs_model, report = self.train_model()
+            self.set_model(sbs_model)
 
-        self.sbs_model = self.__fit_model(data, self.sbs_model)
+        db_engine.upload_model(self.id, self.sbs_model, event_count=report['event_count'],
+                               ml_event_count=report['ml_event_count'], partial=partial)
 
-        time_passed = time.time() - start_time
-        db_engine.upload_model(self.id, self.sbs_model)
+        return dict(report, partial=partial)
 
-        return {'time': time_passed, 'event_count': len(self.transactions), 'ml_event_count': len(data)}
+    def discover_regular(self):
+        '''Ищет в истории транзакций повторяющиеся платежи, для которых еще нет регулярных событий.
+        Результат кэшируется до изменения данных пользователя.
+
+        Returns:
+            Датафрейм предложений, см. Discovery.discover_regular.
+        '''
+        if self.__discovered is None or self.__discovered[0] != self.data_version:
+            transactions = self.get_transactions(
+                date.today() - relativedelta(years=3))
+            self.__discovered = (self.data_version, Discovery.discover_regular(
+                transactions, self.regular_list))
+        return self.__discovered[1]
 
     def add_regular(self, db_engine, start_date, end_date, delta, description, amount, search_f, arg_sf, adjust_price, adjust_date, follow_overdue):
         '''Добавляет регулярное событие.
@@ -200,14 +628,16 @@ class User:
             'adjust_date': adjust_date,
             'follow_overdue': follow_overdue
         }
-        db_index = db_engine.add_event('regular', new_row)
-        new_row['db_id'] = db_index
+        new_row['db_id'], new_row['updated_at'] = db_engine.add_event(
+            'regular', new_row, return_updated_at=True)
         del new_row['user_id']
+        self.__advance_watermark('regular', pd.DataFrame([new_row]))
 
         self.regular_list = pd.concat([
             self.regular_list,
             pd.DataFrame([new_row])
         ], axis=0).reset_index(drop=True)
+        self.data_version += 1
 
     def add_onetime(self, db_engine, date, amount, description):
         '''Добавляет однократное событие.
@@ -220,9 +650,10 @@ class User:
         '''
         new_row = {'user_id': self.id, 'description': description,
                    'amount': amount, 'date': date}
-        db_index = db_engine.add_event('onetime', new_row)
-        new_row['db_id'] = db_index
+        new_row['db_id'], new_row['updated_at'] = db_engine.add_event(
+            'onetime', new_row, return_updated_at=True)
         del new_row['user_id']
+        self.__advance_watermark('onetime', pd.DataFrame([new_row]))
 
         onetime_transactions = pd.concat([
             self.onetime_transactions,
@@ -230,6 +661,7 @@ class User:
         ], axis=0).reset_index(drop=True)
 
         self.onetime_transactions = onetime_transactions
+        self.data_version += 1
 
     def add_accounts(self, db_engine, account_type, description, credit_limit=0, discharge_day=0):
         '''Добавляет счет.
@@ -248,9 +680,10 @@ class User:
             new_row = {'user_id': self.id, 'type': account_type, 'description': description,
                        'credit_limit': credit_limit, 'discharge_day': discharge_day}
 
-        db_index = db_engine.add_event('accounts', new_row)
-        new_row['db_id'] = db_index
+        new_row['db_id'], new_row['updated_at'] = db_engine.add_event(
+            'accounts', new_row, return_updated_at=True)
         del new_row['user_id']
+        self.__advance_watermark('accounts', pd.DataFrame([new_row]))
 
         accounts = pd.concat([
             self.accounts,
@@ -258,6 +691,7 @@ class User:
         ], axis=0).reset_index(drop=True)
 
         self.accounts = accounts
+        self.data_version += 1
 
     def delete_regular(self, db_engine, id):
         '''Удаляет регулярное событие.
@@ -271,6 +705,7 @@ class User:
         db_engine.delete_event('regular', db_id)
 
         self.regular_list = self.regular_list.drop(id).reset_index(drop=True)
+        self.data_version += 1
 
     def delete_onetime(self, db_engine, id):
         '''Удаляет однократное событие.
@@ -285,6 +720,7 @@ class User:
 
         self.onetime_transactions = self.onetime_transactions.drop(
             id).reset_index(drop=True)
+        self.data_version += 1
 
     def edit_regular(self, db_engine, id, parameter: str, new_value):
         '''Удаляет регулярное событие.
@@ -297,6 +733,7 @@ class User:
         db_engine.edit_event('regular', db_id, parameter, new_value)
 
         self.regular_list.loc[id, parameter] = new_value
+        self.data_version += 1
 
     def __predict_regular_events(self, g_start_date, g_end_date, window_price=3, uniform_distribution=False):
         new_regular_events = self.regular_list.copy()
@@ -348,6 +785,9 @@ class User:
                         f'When searching for the start date, the maximum number of iterations was exceeded\n{r_event}')
 
                 new_start = r_event['start_date'] + d_date * j
+            # Номер повторения new_start. Даты считаются от start_date, а не от new_start,
+            # иначе при интервале с месяцами день смещается, как в 31 января + 1 месяц
+            start_j = j
 
             # Проверка на просрочку
             if (r_event['follow_overdue'] and j > 0):
@@ -367,7 +807,7 @@ class User:
                     # Посчитать сколько должно быть регулярок между стартовой датой r_event['start_date'] и начальной датой поиска g_start_date.
                     # Вычесть из них сколько по факту было.
                     count_overdue = j - sum(self.__get_markers_regular(
-                        self.transactions[self.transactions['date'] >= pd.to_datetime(r_event['start_date'])], r_event))
+                        self.get_transactions(r_event['start_date']), r_event))
                     # Если число положительное, то есть просрочки.
                     if (count_overdue > 0):
                         for i_overdue in range(count_overdue):
@@ -381,8 +821,9 @@ class User:
 
                     # Если отрицательное, то есть оплата зарание. Нужно обновить стартовую дату.
                     elif (count_overdue < 0):
+                        start_j = j - count_overdue
                         new_start = r_event['start_date'] + \
-                            d_date * (j - count_overdue)
+                            d_date * start_j
 
             j = 0
             date = new_start  # + d_date * j
@@ -399,83 +840,129 @@ class User:
                 if j == j_limit:
                     raise Exception(
                         f'The maximum number of iterations has been exceeded\n{r_event}')
-                date = new_start + d_date * j
+                date = r_event['start_date'] + d_date * (start_j + j)
 
         df_events = pd.DataFrame(result, columns=[
                                  'date', 'amount', 'category', 'description', 'is_overdue']).sort_values('date').reset_index(drop=True)
         df_events['date'] = pd.to_datetime(df_events['date'])
         return df_events
 
-    def __preprocessing_for_ml(self, data, q=0.16):
-        cleared_df = data.copy()
-        cleared_df = self.__drop_paired(cleared_df, 'amount')
-
-        # Выделяет только расходы
-        markers = cleared_df['amount'] < 0
-
-        for i in self.regular_list.index:
-            markers = markers & ~self.__get_markers_regular(
-                cleared_df, self.regular_list.loc[i])
-        cleared_df = cleared_df[markers]
-
-        cleared_df = self.__drop_outliers(cleared_df, q)
-        cleared_df = cleared_df.set_index('date')
-
+    def __preprocessing_for_ml(self, data, q=0.16, cache_key=None, threshold=None):
         if self.sbs_model is None:
             column_adding_method = self.__get_default_parameters()[
                 'column_adding_method']
         else:
             column_adding_method = self.sbs_model.column_adding_method
 
+        key = (cache_key, self.data_version, q, column_adding_method, threshold)
+        if cache_key is not None and key in self.__preprocessing_cache:
+            return self.__preprocessing_cache[key]
+
         if column_adding_method:
-            cleared_df = self.__calculate_features(
+            def features(cleared_df): return self.__calculate_features(
                 cleared_df, method=column_adding_method)
         else:
-            cleared_df = cleared_df[['amount']]
+            features = None
+
+        result = ml.preprocessing_for_ml(
+            data, self.regular_list, q, features, threshold)
+
+        if cache_key is not None:
+            # Результаты прошлых версий данных больше не понадобятся
+            self.__preprocessing_cache = {
+                k: v for k, v in self.__preprocessing_cache.items() if k[1] == self.data_version}
+            self.__preprocessing_cache[key] = result
 
-        return cleared_df.resample('1D').sum()
+        return result
+
+    def __model_data(self):
+        '''Возвращает предобработанную историю для прогноза модели. Если в окне history_days истории
+        не хватает для признаков модели, например если пользователь долго не загружал выписки,
+        используется вся история, которая в transactions не сохраняется.'''
+        data = self.__preprocessing_for_ml(
+            self.transactions, cache_key='transactions')
+        if self.history_start is not None and not ml.enough_history(data, self.sbs_model.list_mf_rules):
+            data = self.__preprocessing_for_ml(
+                self.get_transactions(), cache_key='history')
+        return data
 
     def __add_and_merge_transactions(self, account_id, new_transactions, new_balance, db_engine):
-        old_transactions = self.transactions
-        old_transactions['is_new'] = False
-        new_transactions = new_transactions.copy()
-        new_transactions['is_new'] = True
-
-        full_tr = pd.concat([old_transactions, new_transactions]).drop_duplicates(
-            subset=['date', 'account_id', 'amount']).sort_values('date')
-
-        if len(full_tr[full_tr['is_new']]) > 0:
-            new_start_date = full_tr[full_tr['is_new']].iloc[0]['date']
-            if (len(full_tr[(~full_tr['is_new']) & (full_tr['account_id'] == account_id)]) > 0) and \
-                    (full_tr[(~full_tr['is_new']) & (full_tr['account_id'] == account_id)
-                             ].iloc[-1]['date'] > new_start_date):
-                db_engine.delete_transactions(
-                    self.id, account_id,
-                    full_tr[full_tr['is_new']].iloc[0]['date'])
-
-                full_tr = pd.concat([old_transactions[old_transactions['date'] < new_start_date],
-                                    new_transactions]).drop_duplicates(
-                    subset=['date', 'account_id', 'amount']).sort_values('date')
-
-            full_tr.loc[full_tr['is_new'], 'balance'] = self.__get_balance_past(
-                new_balance, full_tr.loc[full_tr['is_new'], 'amount'])
-            full_tr.loc[full_tr['is_new'], 'is_del'] = False
-
-            data_for_db = full_tr.loc[full_tr['is_new'],
-                                      ['date', 'account_id', 'amount', 'category', 'description', 'balance']].copy()
-            data_for_db['user_id'] = self.id
-            data_for_db = data_for_db.to_dict(orient='records')
-
-            sql_ret = db_engine.add_event('transactions', data_for_db)
-            full_tr.loc[full_tr['is_new'], 'db_id'] = range(
-                sql_ret, len(full_tr[full_tr['is_new']]) + sql_ret)
-            full_tr = full_tr.astype({
+        if new_transactions.empty:
+            return
+
+        # Файл может перекрывать даты старше загруженного окна
+        self.load_history(new_transactions['date'].min())
+
+        new_transactions = new_transactions.drop_duplicates(
+            subset=['date', 'account_id', 'amount']).sort_values('date', kind='stable')
+        new_start_date = new_transactions['date'].iloc[0]
+        new_end_date = new_transactions['date'].iloc[-1]
+
+        new_transactions = new_transactions.assign(
+            balance=self.__get_balance_past(new_balance, new_transactions['amount']),
+            is_del=False,
+            is_new=True,
+        )
+
+        data_for_db = new_transactions[['date', 'account_id', 'amount', 'category', 'description', 'balance']].copy()
+        data_for_db['user_id'] = self.id
+        data_for_db = data_for_db.to_dict(orient='records')
+
+        # Транзакции счета за даты из файла заменяются транзакциями из файла, остальные не затрагиваются
+        written = db_engine.replace_transactions(
+            self.id, account_id, new_start_date, new_end_date, data_for_db, return_updated_at=True)
+        new_transactions['db_id'] = [db_id for db_id, _ in written]
+        new_transactions['updated_at'] = pd.to_datetime(
+            [updated_at for _, updated_at in written])
+        self.__advance_watermark('transactions', new_transactions)
+
+        old_transactions = self.transactions.assign(is_new=False)
+        overlap = (old_transactions['account_id'] == account_id) & \
+            (old_transactions['date'] >= new_start_date) & (old_transactions['date'] <= new_end_date)
+
+        full_tr = pd.concat([old_transactions[~overlap], new_transactions]).sort_values(
+            'date', kind='stable').astype({
                 'db_id': int,
                 'is_del': bool,
                 'is_new': bool,
             })
 
-            self.transactions = full_tr.reset_index(drop=True)
+        self.transactions = full_tr.reset_index(drop=True)
+        self.data_version += 1
+        self.__update_daily_aggregates(
+            db_engine, account_id, new_start_date)
+
+    def __update_daily_aggregates(self, db_engine, account_id, start_date=None, transactions=None):
+        if transactions is None:
+            transactions = self.get_transactions(start_date)
+        transactions = transactions[transactions['account_id'] == account_id]
+        if start_date is None:
+            start_date = transactions['date'].min()
+        start_date = pd.to_datetime(start_date).floor('D')
+        transactions = transactions[transactions['date'] >= start_date]
+
+        new_aggregates = ml.daily_aggregates(transactions)
+        db_engine.replace_daily_aggregates(
+            self.id, account_id, start_date, new_aggregates)
+
+        old_aggregates = self.daily_aggregates[~(
+            (self.daily_aggregates['account_id'] == account_id) & (self.daily_aggregates['date'] >= start_date))]
+        self.daily_aggregates = pd.concat([old_aggregates, new_aggregates]).sort_values(
+            ['date', 'account_id']).reset_index(drop=True)
+
+    def __advance_watermark(self, table, rows):
+        '''Сдвигает отметку загруженных изменений после записи строк в базу этим пользователем,
+        чтобы refresh не загружал их повторно.'''
+        self.__watermarks[table] = self.__get_watermark(
+            rows, self.__watermarks[table])
+
+    def __get_watermark(self, data, previous=(0, pd.Timestamp(0))):
+        last_id, last_updated = previous
+        if len(data) > 0:
+            last_id = max(last_id, int(data['db_id'].max()))
+            if 'updated_at' in data.columns and data['updated_at'].notna().any():
+                last_updated = max(last_updated, data['updated_at'].max())
+        return last_id, last_updated
 
     def __get_balance_past(self, start, amounts):
         result = amounts.cumsum()
@@ -484,19 +971,6 @@ class User:
     def __get_balance_future(self, start, amounts):
         return amounts.cumsum() + start
 
-    def __drop_paired(self, data: pd.DataFrame, by: str):
-        sort_values = data[by].sort_values()
-        abs_values = sort_values.abs()
-        c1 = sort_values.groupby(abs_values).transform(pd.Series.cumsum) > 0
-        c2 = sort_values[::-
-                         1].groupby(abs_values).transform(pd.Series.cumsum) < 0
-
-        return data[c1 | c2]
-
-    def __drop_outliers(self, data, q=0.16):
-        data = data[data['amount'] > data['amount'].quantile(q)]
-        return data
-
     def __get_default_parameters(self):
         return {
             'target_column': 'amount',
@@ -504,13 +978,6 @@ class User:
             'list_mf_rules': {'amount': [{'column': 'amount', 'lag': [2, 4], 'rm': [2, 1, 4, 3]}]}
         }
 
-    def __fit_model(self, data, sbs_model=None):
-        if sbs_model is None:
-            sbs_model = ml.SbsModel(**self.__get_default_parameters())
-
-        sbs_model.fit(data)
-        return sbs_model
-
     def __encoder_in_sum(self, data, target_column, sum_column, top_size, sort_ascending=True):
         result = data.groupby(target_column)[sum_column].sum(
         ).sort_values(ascending=sort_ascending)[:top_size]
@@ -573,13 +1040,41 @@ class User:
         raise Exception(
             f'The search function /"{event["search_f"]}/" does not exist')
 
-    def __merge_of_predicts(self, predicted_events, predicted_transactions, start_balance):
+    def __merge_of_predicts(self, predicted_events, predicted_transactions, start_date=None):
+        event_amounts = predicted_events.set_index('date')[['amount']]
         merged_transactions = pd.concat([
-            predicted_events.set_index('date')[['amount']],
+            event_amounts,
             predicted_transactions
         ]).resample('1D').sum()
-
-        merged_transactions['balance'] = self.__get_balance_future(
-            start_balance, merged_transactions['amount'])
+        event_amounts = event_amounts['amount'].resample('1D').sum().reindex(
+            merged_transactions.index, fill_value=0)
+
+        history = self.daily_aggregates
+        if start_date is not None:
+            history = history[history['date'] <=
+                              pd.to_datetime(start_date).floor('D')]
+        start_balance = history.groupby('account_id')['balance'].last()
+        spend_share = history[history['date'] > history['date'].max() - relativedelta(
+            days=90)].groupby('account_id')['spend'].sum()
+
+        self.predicted_balances, merged_transactions['balance'] = fc.project_accounts(
+            merged_transactions['amount'] - event_amounts,
+            event_amounts,
+            start_balance,
+            self.accounts,
+            spend_share,
+            self.__get_primary_account(history)
+        )
 
         return merged_transactions
+
+    def __get_primary_account(self, history):
+        debit = self.accounts.loc[self.accounts['type']
+                                  == fc.ACCOUNT_DEBIT, 'db_id']
+        if len(debit) == 0:
+            return None
+
+        # Основной счет - дебетовый счет, на который приходит больше всего доходов
+        income = history.groupby('account_id')['income'].sum().reindex(
+            debit.values).fillna(0)
+        return income.idxmax()
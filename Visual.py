@@ -6,26 +6,54 @@ import seaborn as sns
 from datetime import date, datetime
 # import dataframe_image as dfi # dataframe-image==0.1.1
 import io
+import threading
+import functools
+import Tables
+import PlotCache
 
 
-FORMATTERS = {
-    'date': lambda x: x.strftime('%d.%m.%Y'),
-    'start_date': lambda x: x.strftime('%d.%m.%Y'),
-    'end_date': lambda x: x.strftime('%d.%m.%Y') if not (pd.isna(x)) else 'NaT',
-    'amount': "{:.2f}".format,
-    # 'description': "{:<17}".format,
-}
+# pyplot хранит состояние глобально, графики из разных потоков рисуются по очереди
+PLOT_LOCK = threading.Lock()
+
+# Параметры оформления графиков, входят в ключ кэша картинок
+PLOT_STYLE = {'font_scale': 1.4, 'style': 'whitegrid', 'figsize': (19.5, 9)}
+PLOT_CACHE = PlotCache.PlotCache()
+
+
+def locked_plot(plot_func):
+    @functools.wraps(plot_func)
+    def wrapper(*args, **kwargs):
+        with PLOT_LOCK:
+            return plot_func(*args, **kwargs)
+    return wrapper
 
 
-def transactions_plot(transactions):
+def cached_plot(plot_func):
+    '''Берет график из PLOT_CACHE, если он уже строился для тех же данных и оформления.'''
+    @functools.wraps(plot_func)
+    def wrapper(*args, **kwargs):
+        key = PlotCache.plot_key(plot_func.__name__, args, kwargs, PLOT_STYLE)
+        return PLOT_CACHE.get_or_render(key, lambda: plot_func(*args, **kwargs))
+    return wrapper
+
+
+@cached_plot
+@locked_plot
+def transactions_plot(transactions, bands=None):
     formatter = DateFormatter('%d.%m.%Y')
 
-    sns.set(font_scale=1.4, style="whitegrid")
-    plt.rcParams['figure.figsize'] = (19.5, 9)
+    sns.set(font_scale=PLOT_STYLE['font_scale'], style=PLOT_STYLE['style'])
+    plt.rcParams['figure.figsize'] = PLOT_STYLE['figsize']
 
     ax = sns.lineplot(data=transactions['balance'], linewidth=4.)
     ax.xaxis.set_major_formatter(formatter)
 
+    if bands is not None:
+        ax.fill_between(bands.index, bands['p5'], bands['p95'],
+                        facecolor='b', alpha=.15)
+        ax.fill_between(bands.index, bands['p25'], bands['p75'],
+                        facecolor='b', alpha=.3)
+
     ax.hlines(transactions['balance'].min(), transactions.index[0],
               transactions.index[-1], color='r', linewidth=3, linestyle='--')
     ax.text(
@@ -45,13 +73,15 @@ def transactions_plot(transactions):
     return plot_b
 
 
+@cached_plot
+@locked_plot
 def comparison_plot(comparison):
     data = comparison.copy()
     data.columns = ['Реальный баланс', 'Прогноз баланса']
     formatter = DateFormatter('%d.%m.%Y')
 
-    sns.set(font_scale=1.4, style="whitegrid")
-    plt.rcParams['figure.figsize'] = (19.5, 9)
+    sns.set(font_scale=PLOT_STYLE['font_scale'], style=PLOT_STYLE['style'])
+    plt.rcParams['figure.figsize'] = PLOT_STYLE['figsize']
 
     ax = sns.lineplot(data=data, linewidth=4)
     ax.fill_between(comparison.index,
@@ -81,68 +111,94 @@ def comparison_plot(comparison):
 #     return open(image_full_name, 'rb')
 
 
-def show_table(data, columns):
-    return '<pre>' + data[columns].to_string(
-        formatters={key: FORMATTERS[key] for key in columns if key in FORMATTERS}) + '</pre>'
-
+def show_table(data, columns, title='', cache_key=None, limit=Tables.MESSAGE_LIMIT):
+    return Tables.render_pages(title, data, columns, cache_key, limit)
 
-def show_row(data, index, columns):
-    result = data.loc[[index], columns].copy()
-    formatters = {key: FORMATTERS[key] for key in columns if key in FORMATTERS}
 
-    result[list(formatters)] = result.apply(formatters)
-    return '<pre>' + result.transpose().to_string() + '</pre>'
+def show_row(data, index, columns, title=''):
+    return Tables.render_row(title, data, index, columns)
 
 
-def show_events(events):
-    result = events.copy()
+def show_events(events, limit=Tables.MESSAGE_LIMIT):
+    result = events[['amount', 'description']]
     result.index = result.index.strftime('%d.%m.%Y')
-    return 'Регулярные транзакции\n        ' + show_table(result, columns=['amount', 'description'])
+    return show_table(result, ['amount', 'description'],
+                      'Регулярные транзакции\n        ', limit=limit)
 
 
-def show_regular(regular, only_relevant, columns, index=None):
-    result = regular.copy()
+def show_regular(regular, only_relevant, columns, index=None, cache_key=None):
     if index is None:
+        result = regular
         if only_relevant:
             result = result[(result['end_date'].isna()) | (
                 result['end_date'] >= date.today())]
-        return 'Регулярные транзакции\n        ' + show_table(result, columns)
+            cache_key = cache_key and cache_key + (date.today(),)
+        return show_table(result, columns, 'Регулярные транзакции\n        ', cache_key)
     else:
-        return f'Регулярная транзакция\n\n        ' + show_row(result, index, columns)
+        return [show_row(regular, index, columns, 'Регулярная транзакция\n\n        ')]
 
 
-def show_onetime(onetime, only_relevant, columns, index=None):
-    result = onetime.copy()
+def show_discovered(proposals, columns=['description', 'amount', 'period'], cache_key=None):
+    return show_table(proposals, columns, 'Найденные регулярные транзакции\n        ', cache_key)
+
+
+def show_onetime(onetime, only_relevant, columns, index=None, cache_key=None):
     if index is None:
+        result = onetime
         if only_relevant:
             result = result[result['date'] >= datetime.today()]
-        return 'Разовые транзакции\n        ' + show_table(result, columns)
+            cache_key = cache_key and cache_key + (date.today(),)
+        return show_table(result, columns, 'Разовые транзакции\n        ', cache_key)
     else:
-        return f'Разовая транзакция\n\n        ' + show_row(result, index, columns)
+        return [show_row(onetime, index, columns, 'Разовая транзакция\n\n        ')]
 
 
-def show_accounts(accounts, columns, index=None):
+def show_accounts(accounts, columns, index=None, cache_key=None):
     if index is None:
-        return 'Счета\n        ' + show_table(accounts, columns)
+        return show_table(accounts, columns, 'Счета\n        ', cache_key)
     else:
-        return f'Счет\n\n        ' + show_row(accounts, index, columns)
+        return [show_row(accounts, index, columns, 'Счет\n\n        ')]
 
 
 def successful_adding_transactions(transactions):
     return f"В базу успешно добавлено {len(transactions[transactions['is_new']])} транзакций.\nРазница прогноза и фактического баланса:"
 
 
-def predict_info(events, predicted_transactions):
+def predict_info(events, predicted_transactions, p_below_zero=None):
     data = events.copy()
     data.loc[data['is_overdue'], 'description'] = data.loc[data['is_overdue'],
                                                            'description'] + ' \u2757'  # ❗
-    table = show_events(data)
-    return table + f"\n\n\nДополнительно к этим транзакциям, средний расход в день составляет: {predicted_transactions['amount'].mean():.2f}"
+    # Оставляет место для текста после таблицы
+    pages = show_events(data, Tables.MESSAGE_LIMIT - 300)
+    result = pages[-1] + f"\n\n\nДополнительно к этим транзакциям, средний расход в день составляет: {predicted_transactions['amount'].mean():.2f}"
+    if p_below_zero is not None:
+        result += f"\n\nВероятность того, что баланс опустится ниже нуля: {p_below_zero:.0%}"
+    return pages[:-1] + [result]
+
+
+def category_breakdown(categories):
+    '''Выводит прогноз расходов по категориям: сумму за весь период и долю от общих расходов.
+
+    Args:
+        categories: датафрейм прогноза по категориям, см. User.predict_categories.
+
+    Returns:
+        Список страниц сообщения.
+    '''
+    if len(categories.columns) == 0:
+        return ['Прогноз расходов по категориям\n\nНедостаточно данных о расходах']
+
+    amounts = categories.sum().sort_values()
+    total = amounts.sum()
+    result = pd.DataFrame({'amount': amounts.values}, index=amounts.index)
+    result['share'] = (amounts / total if total != 0 else amounts * 0).map('{:.0%}'.format).values
+    return show_table(result, ['amount', 'share'], 'Прогноз расходов по категориям\n        ')
 
 
 HELP_MESSAGE = {
     '/regular add': 'Для добавления новой регулярной транзакции введите команду <code>/regular add</code>, а затем, через пробел, укажите:\nначальную дату или начальную-конечную дату\nчерез запятую, без пробела, количество лет, месяцев и дней между транзакциями\nкомментарий\nсумму\n\nПример:\n<pre>/regular add 30.12.2200-30.12.3001 0,1,0 -6500.00 "Рассрочка за холодильник"</pre>\n<pre>/regular add 30.12 0,0,30 -450 "Мобильная связь"</pre>',
     '/regular del': 'Для удаления регулярной транзакции введите команду <code>/regular del</code>, а затем, укажите номер транзакции или несколько номеров, через запятую, без пробелов.\n\nПример:\n<pre>/regular del 17</pre>\n<pre>/regular del 17,18,25</pre>',
+    '/regular discover': 'Бот ищет в истории транзакций платежи, которые повторяются каждую неделю, месяц, квартал или год, и предлагает добавить их как регулярные транзакции. Чтобы добавить найденные транзакции, введите команду <code>/regular discover add</code>, а затем, укажите номер или несколько номеров, через запятую, без пробелов.\n\nПример:\n<pre>/regular discover</pre>\n<pre>/regular discover add 0,2</pre>',
 
     '/onetime add': 'Для добавления новой разовой транзакции введите команду <code>/onetime add</code>, а затем, через пробел, укажите дату, сумму и комментарий.\n\nПример:\n<pre>/onetime add 30.12.2200 -652.50 "Вернуть долг"</pre>',
     '/onetime del': 'Для удаления разовой транзакции введите команду <code>/onetime del</code>, а затем, укажите номер транзакции или несколько номеров, через запятую, без пробелов.\n\nПример:\n<pre>/onetime del 17</pre>\n<pre>/onetime del 17,18,25</pre>',
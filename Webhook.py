@@ -0,0 +1,379 @@
+import asyncio
+import collections
+import hmac
+import json
+import logging
+import ssl
+import sys
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import Sharding
+
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 1 << 20
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+               405: 'Method Not Allowed', 413: 'Payload Too Large', 429: 'Too Many Requests'}
+
+
+class WebhookServer:
+    '''HTTP сервер на asyncio, принимающий обновления Telegram через webhook.
+
+    Обновление принимается, только если заголовок X-Telegram-Bot-Api-Secret-Token совпадает с секретом.
+    Telegram отправляет webhook только по HTTPS: сервер либо запускается с ssl_context, см. start,
+    либо работает за прокси, который завершает TLS и передает запросы по HTTP.
+    Принятые обновления ставятся в ограниченную очередь и обрабатываются не более чем max_concurrency
+    потоками, обновления одного пользователя - строго по очереди. Если очередь заполнена, сервер отвечает 429
+    и Telegram повторит отправку позже.
+
+    Attributes:
+        processed: количество обработанных обновлений.
+        rejected: количество обновлений, отклоненных из-за заполненной очереди.
+        error_count: количество обновлений, обработка которых завершилась ошибкой.
+        latencies: время в секундах от получения до окончания обработки последних обновлений.
+    '''
+
+    def __init__(self, handler, secret_token, path='/webhook', max_concurrency=8, queue_size=100, retry_after=1, record_path=None):
+        '''
+        Args:
+            handler: функция обработки обновления в виде словаря. Выполняется в пуле потоков.
+            secret_token: секрет, переданный Telegram в set_webhook.
+            path: путь webhook.
+            max_concurrency: максимальное количество одновременно обрабатываемых обновлений.
+            queue_size: максимальное количество принятых, но еще не обработанных обновлений.
+            retry_after: значение заголовка Retry-After при ответе 429.
+            record_path: файл, в который записываются принятые обновления для replay. Если None, не записываются.
+        '''
+        self.processed = 0
+        self.rejected = 0
+        self.error_count = 0
+        self.latencies = collections.deque(maxlen=100000)
+        self.__handler = handler
+        self.__secret_token = secret_token.encode()
+        self.__path = path
+        self.__max_concurrency = max_concurrency
+        self.__queue_size = queue_size
+        self.__retry_after = retry_after
+        self.__record_path = record_path
+        self.__queue = None
+        self.__server = None
+        self.__workers = []
+        self.__executor = None
+        self.__user_locks = {}
+        self.__user_pending = collections.Counter()
+
+    async def start(self, host='0.0.0.0', port=8443, ssl_context=None):
+        '''Запускает сервер и обработчики очереди.
+
+        Args:
+            host: адрес для входящих соединений.
+            port: порт.
+            ssl_context: ssl.SSLContext с сертификатом сервера. Если None, сервер принимает HTTP.
+        '''
+        self.__queue = asyncio.Queue(self.__queue_size)
+        self.__executor = ThreadPoolExecutor(
+            max_workers=self.__max_concurrency)
+        self.__workers = [asyncio.create_task(self.__worker())
+                          for _ in range(self.__max_concurrency)]
+        self.__server = await asyncio.start_server(self.__handle_connection, host, port, ssl=ssl_context)
+
+    async def stop(self):
+        '''Перестает принимать соединения, дожидается обработки принятых обновлений и останавливает обработчики.'''
+        self.__server.close()
+        await self.__server.wait_closed()
+        await self.__queue.join()
+
+        for worker in self.__workers:
+            worker.cancel()
+        await asyncio.gather(*self.__workers, return_exceptions=True)
+        self.__executor.shutdown()
+
+    async def __handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_SIZE:
+                    writer.write(self.__response(413))
+                    await writer.drain()
+                    break
+
+                body = await reader.readexactly(length)
+                writer.write(self.__response(
+                    self.__accept(method, path, headers, body)))
+                await writer.drain()
+
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def __accept(self, method, path, headers, body):
+        if path != self.__path:
+            return 404
+        if method != 'POST':
+            return 405
+        if not hmac.compare_digest(headers.get('x-telegram-bot-api-secret-token', '').encode(), self.__secret_token):
+            return 403
+
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return 400
+        if not isinstance(update, dict) or not isinstance(update.get('update_id'), int):
+            return 400
+
+        try:
+            self.__queue.put_nowait((time.monotonic(), update))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return 429
+
+        if self.__record_path is not None:
+            with open(self.__record_path, 'a') as f:
+                f.write(json.dumps(update) + '\n')
+        return 200
+
+    def __response(self, status):
+        headers = f'HTTP/1.1 {status} {STATUS_TEXT[status]}\r\nContent-Length: 0\r\n'
+        if status == 429:
+            headers += f'Retry-After: {self.__retry_after}\r\n'
+        return (headers + '\r\n').encode()
+
+    async def __worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            received, update = await self.__queue.get()
+            user_id = Sharding.get_update_user_id(update)
+            lock = self.__user_locks.setdefault(user_id, asyncio.Lock())
+            self.__user_pending[user_id] += 1
+
+            try:
+                async with lock:
+                    await loop.run_in_executor(self.__executor, self.__handler, update)
+            except Exception:
+                self.error_count += 1
+                logger.exception(
+                    f'Webhook failed to process update {update["update_id"]}')
+            finally:
+                self.__user_pending[user_id] -= 1
+                if self.__user_pending[user_id] == 0:
+                    del self.__user_pending[user_id]
+                    del self.__user_locks[user_id]
+
+                self.latencies.append(time.monotonic() - received)
+                self.processed += 1
+                self.__queue.task_done()
+
+
+def server_ssl_context(cert_path, key_path):
+    '''Создает ssl.SSLContext сервера из сертификата и закрытого ключа в формате PEM.'''
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(cert_path, key_path)
+    return ssl_context
+
+
+def run_webhook(token, db_settings, url, secret_token, port=8443, max_concurrency=8, queue_size=100, settings=None,
+                cert_path=None, key_path=None):
+    '''Регистрирует webhook в Telegram и обрабатывает обновления до остановки процесса.
+
+    Telegram принимает только https адрес webhook на портах 443, 80, 88 или 8443. Если передан cert_path,
+    сервер сам завершает TLS, а сертификат загружается в Telegram, что нужно для самоподписанного сертификата.
+    Иначе сервер принимает HTTP, и перед ним должен стоять прокси, завершающий TLS (например, nginx).
+
+    Args:
+        token: токен бота.
+        db_settings: параметры подключения к базе данных.
+        url: публичный адрес webhook.
+        secret_token: секрет для проверки запросов от Telegram.
+        port: локальный порт сервера.
+        max_concurrency: максимальное количество одновременно обрабатываемых обновлений.
+        queue_size: максимальное количество принятых, но еще не обработанных обновлений.
+        settings: словарь настроек бота для обработчиков, см. Handlers.setup.
+        cert_path: файл сертификата сервера в формате PEM. Если None, TLS завершает прокси.
+        key_path: файл закрытого ключа сертификата в формате PEM.
+    '''
+    from telegram import Bot
+
+    if urllib.parse.urlsplit(url).scheme != 'https':
+        raise Exception(f'Telegram accepts only https webhook url, got /"{url}/"')
+    ssl_context = server_ssl_context(cert_path, key_path) if cert_path else None
+
+    handler = Sharding.BotHandler(token, db_settings, settings)(0, 1)
+    if cert_path:
+        with open(cert_path, 'rb') as certificate:
+            Bot(token).set_webhook(url, certificate=certificate, max_connections=max_concurrency,
+                                   api_kwargs={'secret_token': secret_token})
+    else:
+        Bot(token).set_webhook(url, max_connections=max_concurrency,
+                               api_kwargs={'secret_token': secret_token})
+
+    async def serve():
+        server = WebhookServer(handler, secret_token, path=urllib.parse.urlsplit(url).path or '/',
+                               max_concurrency=max_concurrency, queue_size=queue_size)
+        await server.start(port=port, ssl_context=ssl_context)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await server.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+def latency_report(latencies):
+    '''Считает перцентили задержек.
+
+    Args:
+        latencies: задержки в секундах.
+
+    Returns:
+        Словарь формата {'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'}
+    '''
+    values = sorted(latencies)
+    if len(values) == 0:
+        return {'count': 0}
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(p / 100. * len(values)))] * 1000
+
+    return {
+        'count': len(values),
+        'mean_ms': sum(values) / len(values) * 1000,
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'max_ms': values[-1] * 1000,
+    }
+
+
+def load_updates(path):
+    '''Загружает обновления, записанные WebhookServer с record_path.
+
+    Args:
+        path: файл, одно обновление в формате JSON на строку.
+
+    Returns:
+        Список обновлений в виде словарей.
+    '''
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def replay(updates, host, port, secret_token, path='/webhook', connections=20, ssl_context=None):
+    '''Отправляет обновления на webhook сервер так же, как это делает Telegram.
+    При ответе 429 обновление отправляется повторно после паузы из Retry-After.
+
+    Args:
+        updates: список обновлений в виде словарей.
+        host: адрес сервера.
+        port: порт сервера.
+        secret_token: секрет webhook.
+        path: путь webhook.
+        connections: количество одновременных соединений.
+        ssl_context: ssl.SSLContext клиента для подключения по HTTPS. Если None, по HTTP.
+
+    Returns:
+        Кортеж (latencies, statuses):
+        latencies: задержки HTTP ответов в секундах.
+        statuses: количество ответов с каждым кодом.
+    '''
+    latencies = []
+    statuses = collections.Counter()
+    updates = iter(updates)
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port, ssl=ssl_context)
+        for update in updates:
+            body = json.dumps(update).encode()
+            request = (f'POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+                       f'Content-Length: {len(body)}\r\nX-Telegram-Bot-Api-Secret-Token: {secret_token}\r\n\r\n').encode() + body
+
+            while True:
+                start_time = time.monotonic()
+                writer.write(request)
+                await writer.drain()
+
+                status = int((await reader.readline()).split()[1])
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                await reader.readexactly(int(headers.get('content-length', 0)))
+
+                latencies.append(time.monotonic() - start_time)
+                statuses[status] += 1
+                if status != 429:
+                    break
+                await asyncio.sleep(float(headers.get('retry-after', 1)))
+
+        writer.close()
+
+    await asyncio.gather(*[client() for _ in range(connections)])
+    return latencies, statuses
+
+
+def load_test(updates, handler, connections=20, max_concurrency=8, queue_size=100, port=18443):
+    '''Поднимает локальный webhook сервер, воспроизводит на нем обновления и замеряет задержки.
+
+    Args:
+        updates: список обновлений в виде словарей, например из load_updates или Sharding.fake_updates.
+        handler: функция обработки обновления.
+        connections: количество одновременных соединений клиента.
+        max_concurrency: максимальное количество одновременно обрабатываемых обновлений.
+        queue_size: размер очереди сервера.
+        port: локальный порт.
+
+    Returns:
+        Словарь формата {'time', 'http', 'end_to_end', 'statuses', 'error_count'}
+        http: задержки HTTP ответов, см. latency_report.
+        end_to_end: задержки от получения обновления сервером до окончания его обработки, см. latency_report.
+    '''
+    secret_token = 'load-test'
+
+    async def run():
+        server = WebhookServer(handler, secret_token, max_concurrency=max_concurrency,
+                               queue_size=queue_size, retry_after=0.05)
+        await server.start('127.0.0.1', port)
+        start_time = time.time()
+        latencies, statuses = await replay(updates, '127.0.0.1', port, secret_token, connections=connections)
+        await server.stop()
+
+        return {
+            'time': time.time() - start_time,
+            'http': latency_report(latencies),
+            'end_to_end': latency_report(server.latencies),
+            'statuses': dict(statuses),
+            'error_count': server.error_count,
+        }
+
+    return asyncio.run(run())
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        updates = load_updates(sys.argv[1])
+    else:
+        updates = list(Sharding.fake_updates(100, 2000, random_state=0))
+    print(load_test(updates, Sharding.FakeHandler()(0, 1)))
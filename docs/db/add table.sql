@@ -10,12 +10,19 @@ CREATE TABLE IF NOT EXISTS icyb.transactions (
     description character varying(85) COLLATE pg_catalog."default" NOT NULL,
     balance numeric(9, 2) NOT NULL,
     is_del boolean NOT NULL DEFAULT false,
+    updated_at timestamp without time zone NOT NULL DEFAULT now(),
     PRIMARY KEY (id)
 ) TABLESPACE pg_default;
 
 ALTER TABLE
     icyb.transactions OWNER to postgres;
 
+CREATE INDEX IF NOT EXISTS transactions_user_date_idx ON icyb.transactions (user_id, date) WHERE NOT is_del;
+
+CREATE INDEX IF NOT EXISTS transactions_user_account_date_idx ON icyb.transactions (user_id, account_id, date) WHERE NOT is_del;
+
+CREATE INDEX IF NOT EXISTS transactions_user_updated_at_idx ON icyb.transactions (user_id, updated_at);
+
 CREATE TABLE IF NOT EXISTS icyb.regular (
     id serial NOT NULL,
     user_id integer NOT NULL,
@@ -30,19 +37,23 @@ CREATE TABLE IF NOT EXISTS icyb.regular (
     d_days integer NOT NULL,
     adjust_price boolean NOT NULL DEFAULT false,
     adjust_date boolean NOT NULL DEFAULT false,
-    follow_overdue boolean NOT NULL DEFAULT false;
-
-PRIMARY KEY (id)
+    follow_overdue boolean NOT NULL DEFAULT false,
+    is_del boolean NOT NULL DEFAULT false,
+    updated_at timestamp without time zone NOT NULL DEFAULT now(),
+    PRIMARY KEY (id)
 ) TABLESPACE pg_default;
 
 ALTER TABLE
     icyb.regular OWNER to postgres;
 
+CREATE INDEX IF NOT EXISTS regular_user_idx ON icyb.regular (user_id) WHERE NOT is_del;
+
 CREATE TABLE IF NOT EXISTS icyb.dictionary_categories (
     id serial NOT NULL,
     user_id integer NOT NULL,
     key character varying(61) COLLATE pg_catalog."default" NOT NULL,
     value character varying(61) COLLATE pg_catalog."default" NOT NULL,
+    match_type character varying(6) NOT NULL DEFAULT 'exact',
     PRIMARY KEY (id)
 ) TABLESPACE pg_default;
 
@@ -55,21 +66,31 @@ CREATE TABLE IF NOT EXISTS icyb.onetime (
     description character varying(25),
     amount numeric(8, 2) NOT NULL,
     date date NOT NULL,
+    is_del boolean NOT NULL DEFAULT false,
+    updated_at timestamp without time zone NOT NULL DEFAULT now(),
     PRIMARY KEY (id)
 ) TABLESPACE pg_default;
 
 ALTER TABLE
     IF EXISTS icyb.onetime OWNER to postgres;
 
+CREATE INDEX IF NOT EXISTS onetime_user_date_idx ON icyb.onetime (user_id, date) WHERE NOT is_del;
+
 CREATE TABLE IF NOT EXISTS icyb.sbs_models (
     id serial NOT NULL,
     user_id integer NOT NULL,
-    dump bytea NOT NULL
+    dump bytea NOT NULL,
+    created_at timestamp without time zone DEFAULT now(),
+    event_count integer,
+    ml_event_count integer,
+    partial boolean NOT NULL DEFAULT false
 );
 
 ALTER TABLE
     IF EXISTS icyb.sbs_models OWNER to postgres;
 
+CREATE INDEX IF NOT EXISTS sbs_models_user_id_idx ON icyb.sbs_models (user_id, id DESC);
+
 
 CREATE TABLE IF NOT EXISTS icyb.accounts (
     id serial NOT NULL,
@@ -78,6 +99,7 @@ CREATE TABLE IF NOT EXISTS icyb.accounts (
     description character varying(25) COLLATE,
     credit_limit numeric(8, 2),
     discharge_day smallint,
+    updated_at timestamp without time zone NOT NULL DEFAULT now(),
     PRIMARY KEY (id)
 ) TABLESPACE pg_default;
 
@@ -85,6 +107,52 @@ ALTER TABLE
     IF EXISTS icyb.accounts OWNER to postgres;
 
 
+CREATE TABLE IF NOT EXISTS icyb.daily_aggregates (
+    user_id integer NOT NULL,
+    account_id integer NOT NULL,
+    date date NOT NULL,
+    spend numeric(10, 2) NOT NULL DEFAULT 0,
+    income numeric(10, 2) NOT NULL DEFAULT 0,
+    balance numeric(9, 2) NOT NULL,
+    PRIMARY KEY (user_id, account_id, date)
+) TABLESPACE pg_default;
+
+ALTER TABLE
+    IF EXISTS icyb.daily_aggregates OWNER to postgres;
+
+
+CREATE TABLE IF NOT EXISTS icyb.discovery_notices (
+    user_id integer NOT NULL,
+    description character varying(25) NOT NULL,
+    period character varying(15) NOT NULL,
+    created_at timestamp without time zone NOT NULL DEFAULT now(),
+    PRIMARY KEY (user_id, description, period)
+) TABLESPACE pg_default;
+
+ALTER TABLE
+    IF EXISTS icyb.discovery_notices OWNER to postgres;
+
+
+CREATE TABLE IF NOT EXISTS icyb.forecast_accuracy (
+    id bigserial NOT NULL,
+    user_id integer NOT NULL,
+    model_version integer,
+    created_at timestamp without time zone NOT NULL DEFAULT now(),
+    date date NOT NULL,
+    horizon smallint NOT NULL,
+    real_b numeric(12, 2) NOT NULL,
+    predicted_b numeric(12, 2) NOT NULL,
+    PRIMARY KEY (id)
+) TABLESPACE pg_default;
+
+ALTER TABLE
+    IF EXISTS icyb.forecast_accuracy OWNER to postgres;
+
+CREATE INDEX IF NOT EXISTS forecast_accuracy_user_created_at_idx ON icyb.forecast_accuracy (user_id, created_at);
+
+CREATE INDEX IF NOT EXISTS forecast_accuracy_created_at_idx ON icyb.forecast_accuracy (created_at);
+
+
 CREATE TABLE IF NOT EXISTS icyb.shopping_list (
     id serial NOT NULL,
     user_id integer NOT NULL,
@@ -0,0 +1,33 @@
+import pandas as pd
+import pytest
+import Accuracy
+
+
+class FailingDBEngine:
+    def __init__(self):
+        self.fail = True
+        self.uploaded = 0
+
+    def upload_forecast_accuracy(self, records):
+        if self.fail:
+            raise Exception('connection refused')
+        self.uploaded += len(records)
+
+
+def make_records(n):
+    return pd.DataFrame({'user_id': 1, 'model_version': 1, 'date': pd.Timestamp('2024-01-01'),
+                         'horizon': range(n), 'real_b': 0., 'predicted_b': 0.})
+
+
+def test_add_does_not_raise_when_flush_fails():
+    log = Accuracy.AccuracyLog(batch_size=5)
+    db_engine = FailingDBEngine()
+
+    log.add(db_engine, make_records(10))
+    assert log.written == 0
+    with pytest.raises(Exception):
+        log.flush(db_engine)
+
+    db_engine.fail = False
+    assert log.flush(db_engine) == 10
+    assert db_engine.uploaded == 10
@@ -0,0 +1,52 @@
+import pandas as pd
+from Categories import CategoryRules, MATCH_EXACT, MATCH_PREFIX, MATCH_REGEX
+
+
+def test_rule_order():
+    rules = CategoryRules([
+        ('Пятерочка', 'Продукты', MATCH_EXACT),
+        ('Пят', 'Разное', MATCH_PREFIX),
+        ('Пятер', 'Магазины', MATCH_PREFIX),
+        ('ерочка', 'Регулярное', MATCH_REGEX),
+    ])
+
+    assert rules.match('Пятерочка') == 'Продукты'
+    assert rules.match('Пятерочка 123') == 'Магазины'
+    assert rules.match('Пятница') == 'Разное'
+    assert rules.match('Вечерочка') == 'Регулярное'
+    assert rules.match('Магнит') is None
+    assert rules.match(None) is None
+
+
+def test_regex_rules_with_groups():
+    rules = CategoryRules([
+        ('Такси', 'Транспорт', MATCH_PREFIX),
+        (r'(\d)\1', 'Повтор', MATCH_REGEX),
+        (r'(?P<shop>ab)c', 'Магазин 1', MATCH_REGEX),
+        (r'(?P<shop>xy)z', 'Магазин 2', MATCH_REGEX),
+        ('кафе', 'Кафе', MATCH_REGEX),
+    ])
+
+    assert rules.match('x55') == 'Повтор'
+    assert rules.match('x56') is None
+    assert rules.match('-abc') == 'Магазин 1'
+    assert rules.match('-xyz') == 'Магазин 2'
+    assert rules.match('Такси 55') == 'Транспорт'
+    assert rules.match('кафе 55') == 'Повтор'
+    assert rules.match('Обед в кафе') == 'Кафе'
+
+
+def test_regex_rules_with_inline_flags():
+    rules = CategoryRules([('Такси', 'Транспорт', MATCH_PREFIX), ('(?i)кафе', 'Кафе', MATCH_REGEX), ('[', 'x', MATCH_REGEX)])
+
+    assert rules.rule_count == 3
+    assert rules.match('Обед в КАФЕ') == 'Кафе'
+    assert rules.match('Такси') == 'Транспорт'
+    assert rules.match('Метро Такси') is None
+
+
+def test_apply():
+    rules = CategoryRules([('Такси', 'Транспорт', MATCH_PREFIX)])
+    data = pd.DataFrame({'description': ['Такси 1', 'Кафе', None], 'category': ['Разное', 'Еда', 'Разное']})
+
+    assert rules.apply(data)['category'].tolist() == ['Транспорт', 'Еда', 'Разное']
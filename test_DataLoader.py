@@ -0,0 +1,100 @@
+import json
+import os
+from datetime import date
+import numpy as np
+import pandas as pd
+import pytest
+import sqlalchemy as sqla
+import DataLoader as dl
+from Benchmark import generate_parser_inputs
+from LoadTest import FakeDBEngine
+from Users import User
+
+
+def test_amount_parser():
+    assert dl.amount_parser('1 234,50') == 1234.5
+    assert dl.amount_parser("-12`000.5 руб") == -12000.5
+    assert np.isnan(dl.amount_parser('нет суммы'))
+
+
+def test_ru_datetime_parser_series_matches_scalar():
+    _, dates = generate_parser_inputs(2000)
+    dates = pd.concat([dates, pd.Series(['29.02.2024', '31.02.2024', '1.1.2024 10:00', 'abc', '', '12,05'])],
+                      ignore_index=True)
+
+    expected = pd.to_datetime(dates.map(dl.ru_datetime_parser))
+    pd.testing.assert_series_equal(dl.ru_datetime_parser_series(dates), expected, check_names=False)
+
+
+# Параметры DB_Engine без schema в формате JSON, например {"host": "localhost", "port": 5432, ...}.
+# Тест создает и удаляет собственную схему
+TEST_DB = os.getenv('ICYB_TEST_DB')
+
+NOTIFICATION_REGULAR = [
+    # Конец месяца: 31 января + 1 месяц = 29 февраля
+    {'user_id': 1, 'description': 'Подписка', 'amount': -299., 'start_date': date(2024, 1, 31),
+     'end_date': None, 'd_years': 0, 'd_months': 1, 'd_days': 0},
+    {'user_id': 1, 'description': 'Страховка', 'amount': -8000., 'start_date': date(2020, 2, 29),
+     'end_date': None, 'd_years': 1, 'd_months': 0, 'd_days': 0},
+    {'user_id': 1, 'description': 'Кружок', 'amount': -1500., 'start_date': date(2024, 3, 1),
+     'end_date': date(2024, 6, 1), 'd_years': 0, 'd_months': 0, 'd_days': 14},
+    {'user_id': 2, 'description': 'Аренда', 'amount': -30000., 'start_date': date(2023, 12, 20),
+     'end_date': None, 'd_years': 0, 'd_months': 1, 'd_days': 15},
+    {'user_id': 2, 'description': 'Зарплата', 'amount': 50000., 'start_date': date(2025, 1, 5),
+     'end_date': None, 'd_years': 0, 'd_months': 1, 'd_days': 0},
+]
+NOTIFICATION_SKIPPED = [
+    {'user_id': 2, 'description': 'Удален', 'amount': -100., 'start_date': date(2024, 1, 1),
+     'end_date': None, 'd_years': 0, 'd_months': 0, 'd_days': 7, 'is_del': True},
+    {'user_id': 2, 'description': 'Коммуналка', 'amount': -5000., 'start_date': date(2024, 1, 10),
+     'end_date': None, 'd_years': 0, 'd_months': 1, 'd_days': 0, 'adjust_price': True},
+]
+NOTIFICATION_ONETIME = [
+    {'user_id': 1, 'description': 'Долг', 'amount': -1000., 'date': date(2024, 5, 5)},
+    {'user_id': 2, 'description': 'Возврат', 'amount': 700., 'date': date(2025, 5, 5)},
+]
+
+
+@pytest.fixture
+def db_engine():
+    settings = json.loads(TEST_DB)
+    db_engine = dl.DB_Engine(**settings, schema='icyb_test')
+    with db_engine.connector.begin() as connection:
+        connection.execute(sqla.sql.text('DROP SCHEMA IF EXISTS icyb_test CASCADE'))
+        connection.execute(sqla.sql.text('CREATE SCHEMA icyb_test'))
+        for table in ('regular', 'onetime'):
+            db_engine.tables[table].create(connection)
+    yield db_engine
+    with db_engine.connector.begin() as connection:
+        connection.execute(sqla.sql.text('DROP SCHEMA icyb_test CASCADE'))
+
+
+@pytest.mark.skipif(TEST_DB is None, reason='ICYB_TEST_DB is not set')
+def test_notification_events_match_predict_events(db_engine):
+    flags = {'search_f': 'dont_search', 'arg_sf': '', 'adjust_price': False, 'adjust_date': False,
+             'follow_overdue': False, 'is_del': False}
+    with db_engine.connector.begin() as connection:
+        connection.execute(db_engine.tables['regular'].insert(),
+                           [{**flags, **r} for r in NOTIFICATION_REGULAR + NOTIFICATION_SKIPPED])
+        connection.execute(db_engine.tables['onetime'].insert(),
+                           [{'is_del': False, **r} for r in NOTIFICATION_ONETIME])
+
+    fake_engine = FakeDBEngine()
+    fake_engine.add_event('regular', [{**flags, **r} for r in NOTIFICATION_REGULAR])
+    fake_engine.add_event('onetime', NOTIFICATION_ONETIME)
+
+    start_date, end_date = pd.Timestamp('2024-01-01'), pd.Timestamp('2025-06-30')
+    events = db_engine.download_notification_events(start_date, end_date)
+
+    # predict_events включает start_date и исключает end_date, как в Manager.daily_notice
+    half_day = pd.Timedelta(hours=12)
+    expected = pd.concat([
+        User(user_id, fake_engine).predict_events(start_date - half_day, end_date + half_day).assign(user_id=user_id)
+        for user_id in (1, 2)
+    ])[['user_id', 'date', 'amount', 'description']]
+
+    assert len(events) > len(NOTIFICATION_REGULAR) + len(NOTIFICATION_ONETIME)
+    pd.testing.assert_frame_equal(
+        events.sort_values(['user_id', 'date', 'description']).reset_index(drop=True),
+        expected.sort_values(['user_id', 'date', 'description']).reset_index(drop=True),
+        check_dtype=False)
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from DialogStore import DialogState, DialogStateStore
+
+
+@pytest.fixture(params=['memory', 'dbm'])
+def store(request, tmp_path):
+    return DialogStateStore(path=None if request.param == 'memory' else str(tmp_path / 'dialogs'))
+
+
+def test_set_and_get(store):
+    store.set(1, DialogState('/accounts', 'add', {'prefix_command': ['Карта', 'credit']}))
+
+    state = store.get(1)
+    assert (state.cmd, state.step, state.args) == ('/accounts', 'add', {'prefix_command': ['Карта', 'credit']})
+    store.pop(1)
+    assert store.get(1) is None
+
+
+def test_rejects_args_not_serializable(store):
+    with pytest.raises(Exception, match='JSON'):
+        store.set(1, DialogState('/regular', 'edit_parameter', {'id_event': np.int64(3), 'parameter': 'amount'}))
+    with pytest.raises(Exception, match='JSON'):
+        store.set(1, DialogState('/regular', 'add', {'date': object()}))
+    assert store.get(1) is None
+
+
+def test_expired_states_are_removed(store):
+    store.ttl = -1
+    store.set(1, DialogState('/onetime'))
+    assert store.cleanup() == 1
+    assert store.get(1) is None
@@ -0,0 +1,69 @@
+import pandas as pd
+import Discovery
+from Benchmark import generate_histories
+
+
+def test_discover_regular_finds_generated_payments():
+    history = generate_histories(5)
+    proposals = Discovery.discover_regular(history)
+
+    periods = proposals.groupby(['user_id', proposals['description'].str.split().str[0]])['period'].agg(list)
+    for user_id in range(5):
+        assert periods[user_id, 'Зарплата'] == ['2 раза в месяц'] * 2
+        assert periods[user_id, 'Подписка'] == ['месяц']
+        assert periods[user_id, 'Страховка'] == ['год']
+    # Случайные покупки не предлагаются
+    assert len(proposals) == 4 * 5
+
+    salary = proposals[(proposals['user_id'] == 0) & (proposals['description'] == 'Зарплата')]
+    assert sorted(salary['start_date'].dt.day) == [5, 20]
+    assert (salary['search_f'] == 'amount_description').all()
+
+
+def test_discover_regular_for_one_user_matches_all_users():
+    history = generate_histories(3)
+    proposals = Discovery.discover_regular(history)
+
+    for user_id in range(3):
+        one_user = Discovery.discover_regular(history[history['user_id'] == user_id].drop('user_id', axis=1))
+        assert 'user_id' not in one_user.columns
+        pd.testing.assert_frame_equal(
+            one_user, proposals[proposals['user_id'] == user_id].drop('user_id', axis=1).reset_index(drop=True))
+
+
+def test_covered_keys():
+    regular = pd.DataFrame({
+        'user_id': [1, 1, 2],
+        'description': ['Подписка', 'Такси', 'Кофе'],
+        'search_f': ['amount_description', 'amount<_description', 'dont_search'],
+        'arg_sf': ['Подписка 12', '-500,Яндекс.Такси', None],
+    })
+
+    keys = Discovery.covered_keys(regular)
+    assert set(keys) == {(1, 'подписка'), (1, 'такси'), (1, 'яндекс такси'), (2, 'кофе')}
+    assert len(Discovery.covered_keys(None)) == 0
+
+
+def test_discover_regular_skips_covered_descriptions():
+    history = generate_histories(2)
+    regular = pd.DataFrame({
+        'user_id': [0],
+        'description': ['Зарплата'],
+        'search_f': ['description'],
+        'arg_sf': ['Зарплата'],
+    })
+
+    proposals = Discovery.discover_regular(history, regular)
+    assert set(proposals.loc[proposals['user_id'] == 0, 'description'].str.split().str[0]) == {'Подписка', 'Страховка'}
+    assert (proposals.loc[proposals['user_id'] == 1, 'description'] == 'Зарплата').sum() == 2
+
+
+def test_discover_regular_tolerance():
+    # Платеж раз в месяц, перенесенный на 6 дней, не попадает в допуск месяца по умолчанию
+    dates = pd.to_datetime(['2024-01-10', '2024-02-10', '2024-03-16', '2024-04-10', '2024-05-16', '2024-06-10'])
+    history = pd.DataFrame({'date': dates, 'amount': -1000., 'description': 'Спортзал'})
+
+    assert Discovery.discover_regular(history).empty
+    proposals = Discovery.discover_regular(history, tolerance=6)
+    assert proposals['period'].tolist() == ['месяц']
+    assert proposals['start_date'].tolist() == [pd.Timestamp('2024-06-10')]
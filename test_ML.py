@@ -0,0 +1,191 @@
+from collections import Counter
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+import ML as ml
+from LoadTest import generate_transactions
+from Users import User
+from test_Users import make_user
+
+LIST_MF_RULES = {'amount': [{'column': 'amount', 'lag': [2, 4], 'rm': [2, 1, 4, 3]}]}
+
+
+REGULAR_LIST = pd.DataFrame([
+    ('description', 'Метро,Перевод', 0.),
+    ('amount_description', 'Подписка', -299.),
+    ('amount<_description', '-3000,Ozon', 0.),
+    ('amount<_description', '-1000,Ozon', 0.),
+    ('amount_category', 'Аптеки', -450.),
+    ('amount<_category', '-2000,Рестораны', 0.),
+    ('dont_search', 'Пятерочка', 0.),
+], columns=['search_f', 'arg_sf', 'amount'])
+
+
+def make_model():
+    return ml.SbsModel('amount', False, LIST_MF_RULES)
+
+
+def make_series(days, random_state=0):
+    '''Создает ежедневный ряд расходов с недельной сезонностью.'''
+    rng = np.random.default_rng(random_state)
+    index = pd.date_range('2023-01-01', periods=days, freq='D')
+    amount = -500 - 200 * (index.dayofweek >= 5) + rng.normal(0, 100, days)
+    return pd.DataFrame({'amount': amount}, index=index)
+
+
+def assert_same_models(model, expected, data):
+    '''Сравнивает прогнозы моделей на признаках ряда data. Лаги и скользящие средние правил линейно зависимы,
+    поэтому сами коэффициенты определены только с точностью до вырожденных направлений.'''
+    for column, mf_rules in LIST_MF_RULES.items():
+        x = expected.make_features(data, mf_rules).dropna().drop(LIST_MF_RULES.keys(), axis=1).values
+        np.testing.assert_allclose(model.models[column].predict(x), expected.models[column].predict(x), rtol=1e-8)
+
+
+def test_partial_fit_matches_fit_on_series():
+    data = make_series(400)
+    model = make_model().fit(data[:300])
+
+    assert model.partial_fit(data[:350])
+    assert model.partial_fit(data)
+    assert_same_models(model, make_model().fit(data), data)
+
+
+def test_partial_fit_refits_changed_series():
+    data = make_series(400)
+    model = make_model().fit(data[:300])
+
+    changed = data.copy()
+    changed.iloc[10, 0] -= 1000
+    assert not model.partial_fit(changed)
+    assert_same_models(model, make_model().fit(changed), changed)
+
+
+def test_update_model_matches_fit_on_full_history():
+    db_engine, account_id, rng = make_user(days_ago=20, history_days=400)
+    user = User(1, db_engine)
+    user.fit_new_model(db_engine)
+    threshold = user.sbs_model.statistics['threshold']
+
+    new = generate_transactions(datetime.today() - relativedelta(days=19), 19, rng, account_id)
+    new['balance'] = new['amount'].cumsum() + 10000
+    new['user_id'] = 1
+    db_engine.add_event('transactions', new.to_dict(orient='records'))
+    user = User(1, db_engine, history_days=60)
+
+    downloads = []
+    download_transactions = db_engine.download_transactions
+    db_engine.download_transactions = lambda *args: downloads.append(args) or download_transactions(*args)
+    report = user.update_model(db_engine)
+    assert report['partial']
+    # Последние дни уже в окне пользователя, старая история не загружается
+    assert downloads == []
+
+    transactions = user.get_transactions()
+    data = ml.preprocessing_for_ml(transactions, user.regular_list, threshold=threshold)
+    assert_same_models(user.sbs_model, make_model().fit(data), data)
+    assert report['event_count'] == len(transactions)
+    assert report['ml_event_count'] == len(data)
+
+
+def make_transactions(days=200, random_state=0):
+    '''Создает историю транзакций с возвратами покупок, нулевыми суммами и платежами регулярных событий.'''
+    rng = np.random.default_rng(random_state)
+    data = generate_transactions(datetime(2023, 1, 1), days, rng)
+    # Возвращаются покупки с уникальной суммой: какую из одинаковых покупок исключать, прежняя реализация выбирала
+    # по порядку сортировки, см. test_drop_paired_markers_keeps_same_amounts_as_legacy
+    purchases = data[(data['amount'] < 0) & ~data['amount'].duplicated(keep=False)].sample(30, random_state=random_state)
+    refunds = purchases.assign(amount=-purchases['amount'], date=purchases['date'] + pd.Timedelta(days=3))
+    extra = pd.DataFrame({
+        'date': pd.date_range('2023-01-10', periods=6, freq='MS'),
+        'account_id': 0,
+        'amount': [-299., -299., -450., 0., -299., -450.],
+        'category': ['Подписки', 'Подписки', 'Аптеки', 'Прочее', 'Подписки', 'Аптеки'],
+        'description': ['Подписка', 'Подписка', 'Аптека', 'Ноль', 'Подписка', 'Аптека'],
+    })
+    return pd.concat([data, refunds, extra]).sort_values('date', kind='stable').reset_index(drop=True)
+
+
+def legacy_markers_regular(data, event):
+    '''Поиск транзакций одного регулярного события, как в User до векторизации.'''
+    if event['search_f'] == 'description':
+        return data['description'].isin(event['arg_sf'].split(','))
+    elif event['search_f'] == 'amount_description':
+        return (data['description'] == event['arg_sf']) & (data['amount'] == event['amount'])
+    elif event['search_f'] == 'amount<_description':
+        arg_sf = event['arg_sf'].split(',')
+        return (data['description'] == arg_sf[1]) & (data['amount'] < int(arg_sf[0]))
+    elif event['search_f'] == 'amount_category':
+        return (data['category'] == event['arg_sf']) & (data['amount'] == event['amount'])
+    elif event['search_f'] == 'amount<_category':
+        arg_sf = event['arg_sf'].split(',')
+        return (data['category'] == arg_sf[1]) & (data['amount'] < int(arg_sf[0]))
+    return pd.Series(False, index=data.index)
+
+
+def legacy_drop_paired(data):
+    sort_values = data['amount'].sort_values(kind='stable')
+    abs_values = sort_values.abs()
+    c1 = sort_values.groupby(abs_values).transform(pd.Series.cumsum) > 0
+    c2 = sort_values[::-1].groupby(abs_values).transform(pd.Series.cumsum) < 0
+    return data[c1 | c2]
+
+
+def legacy_preprocessing(data, regular_list, q=0.16):
+    '''Подготовка истории для модели, как в User до векторизации.'''
+    cleared_df = legacy_drop_paired(data)
+    markers = cleared_df['amount'] < 0
+    for i in regular_list.index:
+        markers = markers & ~legacy_markers_regular(cleared_df, regular_list.loc[i])
+    cleared_df = cleared_df[markers]
+    cleared_df = cleared_df[cleared_df['amount'] > cleared_df['amount'].quantile(q)]
+    return cleared_df.set_index('date')[['amount']].resample('1D').sum()
+
+
+def test_drop_paired_markers():
+    amounts = [-100., 100., -100., -50., 0., 50., 50., -30.]
+    expected = [False, False, True, False, False, False, True, True]
+    assert ml.drop_paired_markers(amounts).tolist() == expected
+    assert ml.drop_paired_markers([]).tolist() == []
+
+
+def test_drop_paired_markers_keeps_same_amounts_as_legacy():
+    data = make_transactions()
+    refund = data[(data['amount'] > 0) & (data['description'] != 'Зарплата')].iloc[:1]
+    data = pd.concat([data] + [refund.assign(amount=-refund['amount'])] * 2, ignore_index=True)
+    # Порядок внутри одинаковых сумм у прежней реализации зависел от сортировки, сравниваются оставшиеся суммы
+    kept = data['amount'][ml.drop_paired_markers(data['amount'])]
+    assert Counter(kept) == Counter(legacy_drop_paired(data)['amount'])
+    assert len(kept) < (data['amount'] != 0).sum()
+
+
+def test_preprocessing_matches_legacy():
+    data = make_transactions()
+    regular_markers = np.zeros(len(data), dtype=bool)
+    for i in REGULAR_LIST.index:
+        regular_markers |= legacy_markers_regular(data, REGULAR_LIST.loc[i]).values
+    np.testing.assert_array_equal(ml.regular_markers(data, REGULAR_LIST), regular_markers)
+
+    expected = legacy_preprocessing(data, REGULAR_LIST)
+    pd.testing.assert_frame_equal(ml.preprocessing_for_ml(data, REGULAR_LIST), expected, check_freq=False)
+
+    categories = ml.category_matrix(data, REGULAR_LIST, top_k=3)
+    np.testing.assert_allclose(categories.sum(axis=1).values, expected['amount'].values)
+
+
+def test_reconcile_categories_sums_to_total():
+    rng = np.random.default_rng(0)
+    index = pd.date_range('2024-01-01', periods=30, freq='D')
+    categories = pd.DataFrame(-rng.exponential(100, (30, 3)), index=index, columns=['a', 'b', 'c'])
+    categories.iloc[[3, 10]] = 0
+    total = pd.Series(-rng.exponential(300, 30), index=index)
+    shares = pd.Series({'c': .5, 'b': .3, 'a': .2})
+
+    result = ml.reconcile_categories(categories, total, shares)
+
+    np.testing.assert_allclose(result.sum(axis=1).values, total.values)
+    # Пропорции прогноза категорий сохраняются, в дни с нулевым прогнозом используются доли
+    np.testing.assert_allclose(result.iloc[0] / result.iloc[0].sum(), categories.iloc[0] / categories.iloc[0].sum())
+    np.testing.assert_allclose(result.iloc[3].values, total.iloc[3] * np.array([.2, .3, .5]))
+    # Дни без общего прогноза считаются нулевыми
+    assert (ml.reconcile_categories(categories, total[:20], shares).iloc[20:] == 0).all().all()
@@ -0,0 +1,80 @@
+import pandas as pd
+import pytest
+from Benchmark import generate_histories
+from LoadTest import FakeBot, FakeDBEngine
+from Manager import UserManager
+from test_Users import make_user
+
+
+def test_add_category_rule():
+    db_engine, _, _ = make_user(days_ago=0)
+    manager = UserManager(FakeBot(), None, db_engine=db_engine)
+
+    assert manager.add_category_rule(1, 'prefix', 'Поездки', 'Яндекс') > 0
+    assert (manager.get_user(1).transactions['description'] == 'Яндекс.Такси').any()
+    assert (manager.get_user(1).transactions.query('description == "Яндекс.Такси"')['category'] == 'Поездки').all()
+    # Повторное правило ничего не меняет
+    assert manager.add_category_rule(1, 'prefix', 'Поездки', 'Яндекс') == 0
+
+    with pytest.raises(Exception):
+        manager.add_category_rule(1, 'regex', 'Такси', '(')
+    with pytest.raises(Exception):
+        manager.add_category_rule(1, 'contains', 'Такси', 'Яндекс')
+
+
+def test_get_page():
+    db_engine, _, _ = make_user(days_ago=0)
+    dialog = UserManager(FakeBot(), None, db_engine=db_engine).get_dialog(1, '/regular')
+
+    assert dialog.get_page(['all', 'page', '2']) == 2
+    assert dialog.get_page(['page', 'x']) == 0
+    assert dialog.get_page(['page', '-1']) == 0
+    assert dialog.get_page(['page']) == 0
+
+
+class FailingBot(FakeBot):
+    '''Не доставляет сообщения пользователям из failed.'''
+
+    def __init__(self, failed):
+        super().__init__()
+        self.failed = failed
+        self.chats = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.failed:
+            raise Exception('Forbidden: bot was blocked by the user')
+        self.chats.append(chat_id)
+
+
+def test_discovery_notices_only_for_delivered_users():
+    db_engine = FakeDBEngine()
+    history = generate_histories(2, days=400)
+    history['date'] = history['date'] + (pd.Timestamp.today().floor('D') - history['date'].max())
+    history['user_id'] += 1
+    db_engine.add_event('transactions', history.assign(account_id=0, balance=0.).to_dict(orient='records'))
+
+    bot = FailingBot(failed={2})
+    manager = UserManager(bot, None, db_engine=db_engine)
+    manager.discover_regular_notice()
+    assert set(bot.chats) == {1}
+    assert set(db_engine.discovery_notices['user_id']) == {1}
+
+    bot.failed = set()
+    bot.chats = []
+    manager.discover_regular_notice()
+    assert set(bot.chats) == {2}
+    assert set(db_engine.discovery_notices['user_id']) == {1, 2}
+
+
+def test_evict_idle_users():
+    db_engine, _, _ = make_user(days_ago=0)
+    manager = UserManager(FakeBot(), None, db_engine=db_engine, user_ttl=3600)
+    user = manager.get_user(1)
+
+    assert manager.evict_idle_users() == 0
+    assert manager.get_user(1) is user
+
+    manager.user_ttl = -1
+    assert manager.evict_idle_users() == 1
+    assert 1 not in manager.user_dict
+    assert manager.get_user(1) is not user
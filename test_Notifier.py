@@ -0,0 +1,31 @@
+import pytest
+from telegram.error import BadRequest, NetworkError, Unauthorized
+from Notifier import NotificationDispatcher
+
+
+class FlakyBot:
+    '''Бросает ошибки из errors по очереди, затем отправляет сообщение.'''
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return text
+
+
+@pytest.mark.parametrize('error', [BadRequest('Chat not found'), Unauthorized('Forbidden: bot was blocked by the user')])
+def test_permanent_errors_are_not_retried(error):
+    bot = FlakyBot([error])
+    with pytest.raises(type(error)):
+        NotificationDispatcher(bot, backoff=0).send(1, 'text')
+    assert bot.calls == 1
+
+
+def test_network_errors_are_retried():
+    bot = FlakyBot([NetworkError('timeout'), NetworkError('timeout')])
+    assert NotificationDispatcher(bot, backoff=0).send(1, 'text') == 'text'
+    assert bot.calls == 3
@@ -0,0 +1,15 @@
+import pandas as pd
+import Scheduler
+from test_Users import make_user
+
+
+def test_retrain_skips_users_without_enough_history():
+    db_engine, _, _ = make_user(days_ago=0, history_days=3)
+    db_engine.download_retrain_candidates = lambda: pd.DataFrame({
+        'user_id': [1], 'event_count': [10], 'model_created_at': [pd.NaT], 'model_event_count': [None]})
+
+    report = Scheduler.retrain_models(Scheduler.StandaloneManager(db_engine), rate=None)
+
+    assert report['error_count'] == 0
+    assert report['not_enough_history'] == 1
+    assert report['uploaded'] == 0
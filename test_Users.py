@@ -0,0 +1,85 @@
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+from LoadTest import FakeDBEngine, generate_transactions, write_tinkoff_csv
+from Users import User
+
+
+def make_user(days_ago, history_days=180, random_state=0):
+    '''Создает в FakeDBEngine пользователя, последняя транзакция которого была days_ago дней назад.'''
+    db_engine = FakeDBEngine()
+    rng = np.random.default_rng(random_state)
+    account_id = db_engine.add_event(
+        'accounts', {'user_id': 1, 'type': 1, 'description': 'Основной'})
+    start_date = datetime.today() - relativedelta(days=days_ago + history_days)
+    history = generate_transactions(start_date, history_days, rng, account_id)
+    history['balance'] = history['amount'].cumsum() + 10000
+    history['user_id'] = 1
+    db_engine.add_event('transactions', history.to_dict(orient='records'))
+
+    return db_engine, account_id, rng
+
+
+def test_predict_for_user_without_history_in_window():
+    db_engine, _, _ = make_user(days_ago=500)
+    user = User(1, db_engine)
+    assert user.transactions.empty
+
+    user.fit_new_model(db_engine)
+    end_date = datetime.today() + relativedelta(months=3)
+    user.predict_events(pd.Timestamp(datetime.today()), end_date)
+    prediction = user.predict_full(end_date)
+
+    assert len(prediction) > 0
+    assert prediction['balance'].notna().all()
+    # Вся история нужна только на время прогноза
+    assert user.transactions.empty
+
+
+def test_upload_for_user_without_history_in_window(tmp_path):
+    db_engine, account_id, rng = make_user(days_ago=500)
+    user = User(1, db_engine)
+    user.fit_new_model(db_engine)
+
+    upload = generate_transactions(
+        datetime.today() - relativedelta(days=14), 14, rng, account_id)
+    path = str(tmp_path / 'upload.csv')
+    write_tinkoff_csv(upload, path)
+    user.load_from_file(db_engine, path, account_id, 10000.)
+
+    comparison = user.get_comparison_data()
+    records = user.get_accuracy_records(comparison)
+
+    assert comparison['predicted_b'].notna().any()
+    assert len(records) > 0
+    assert user.update_model(db_engine) is not None
+
+
+def test_recategorize_ignores_missing_categories():
+    db_engine, _, _ = make_user(days_ago=0)
+    db_engine.tables['transactions']['category'] = None
+    user = User(1, db_engine)
+
+    assert user.recategorize(db_engine) == 0
+    db_engine.add_category_rule(1, 'Метро', 'Транспорт')
+    assert user.recategorize(db_engine) == (user.transactions['description'] == 'Метро').sum() > 0
+
+
+def test_refresh_skips_own_writes():
+    db_engine, _, _ = make_user(days_ago=0)
+    user = User(1, db_engine)
+    user.add_onetime(db_engine, pd.Timestamp.today().floor('D'), -100., 'Долг')
+
+    requested = []
+
+    def download_changes(table, user_id, last_id, last_updated):
+        requested.append((table, last_id))
+        # База отдает записанную строку повторно, как в пределах DataLoader.CHANGES_LAG
+        return user.onetime_transactions.assign(is_del=False) if table == 'onetime' else \
+            getattr(user, 'regular_list' if table == 'regular' else table).iloc[0:0]
+    db_engine.download_changes = download_changes
+
+    assert user.refresh(db_engine)['onetime'] == 0
+    assert dict(requested)['onetime'] == user.onetime_transactions['db_id'].max()
+    assert len(user.onetime_transactions) == 1
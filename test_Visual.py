@@ -0,0 +1,27 @@
+import pandas as pd
+import Tables
+import Visual
+
+
+def test_predict_info_sends_all_pages():
+    events = pd.DataFrame({
+        'amount': -100.,
+        'description': [f'Событие {i}' for i in range(300)],
+        'is_overdue': False,
+    }, index=pd.date_range('2030-01-01', periods=300, freq='D'))
+    pages = Visual.predict_info(events, pd.DataFrame({'amount': [-50., -150.]}), p_below_zero=.25)
+
+    assert len(pages) > 1
+    assert all(len(page) <= Tables.MESSAGE_LIMIT for page in pages)
+    assert all(any(f'Событие {i}' in page for page in pages) for i in (0, 150, 299))
+    assert 'Показана' not in ''.join(pages)
+    assert '-100.00' in pages[-1] and '25%' in pages[-1]
+
+
+def test_category_breakdown_pages():
+    assert Visual.category_breakdown(pd.DataFrame(index=[0])) == [
+        'Прогноз расходов по категориям\n\nНедостаточно данных о расходах']
+    categories = pd.DataFrame({f'Категория {i}': [-10. * (i + 1)] for i in range(200)})
+    pages = Visual.category_breakdown(categories)
+    assert len(pages) > 1
+    assert any('Категория 199' in page for page in pages)
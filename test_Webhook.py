@@ -0,0 +1,35 @@
+import asyncio
+import shutil
+import ssl
+import subprocess
+import pytest
+import Webhook
+
+
+def test_server_accepts_updates_over_tls(tmp_path):
+    if shutil.which('openssl') is None:
+        pytest.skip('openssl is not installed')
+    cert_path, key_path = str(tmp_path / 'cert.pem'), str(tmp_path / 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-keyout', key_path, '-out', cert_path], check=True, capture_output=True)
+    client_context = ssl.create_default_context(cafile=cert_path)
+    client_context.check_hostname = False
+
+    handled = []
+    updates = [{'update_id': i, 'message': {'from': {'id': i % 3}}} for i in range(10)]
+
+    async def run():
+        server = Webhook.WebhookServer(handled.append, 'secret')
+        await server.start('127.0.0.1', 18444, ssl_context=Webhook.server_ssl_context(cert_path, key_path))
+        _, statuses = await Webhook.replay(updates, '127.0.0.1', 18444, 'secret', connections=2,
+                                           ssl_context=client_context)
+        await server.stop()
+        return statuses
+
+    assert asyncio.run(run()) == {200: 10}
+    assert sorted(u['update_id'] for u in handled) == list(range(10))
+
+
+def test_run_webhook_requires_https():
+    with pytest.raises(Exception, match='https'):
+        Webhook.run_webhook('token', {}, 'http://example.com/webhook', 'secret')